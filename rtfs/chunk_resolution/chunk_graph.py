@@ -1,9 +1,10 @@
 from networkx import MultiDiGraph, node_link_graph, node_link_data, DiGraph
 from pathlib import Path
 from llama_index.core.schema import BaseNode
-from typing import List, Tuple, Dict
+from typing import Iterable, List, Tuple, Dict
 import os
 from collections import deque
+from functools import cached_property
 
 from rtfs.utils import dfs_json
 from rtfs.scope_resolution.capture_refs import capture_refs
@@ -49,13 +50,17 @@ class ChunkGraph(ClusterGraph):
         self._repo_graph = RepoGraph(repo_path)
         self._file2scope = defaultdict(set)
         self._chunkmap: Dict[Path, List[ChunkNode]] = defaultdict(list)
-        self._lm: BaseModel = OpenAIModel()
+
+    # Only created when a graph actually queries the LLM
+    @cached_property
+    def _lm(self) -> BaseModel:
+        return OpenAIModel()
 
     # TODO: design decisions
     # turn import => export mapping into a function
     # implement tqdm for chunk by chunk processing
     @classmethod
-    def from_chunks(cls, repo_path: Path, chunks: List[BaseNode], skip_tests=True):
+    def from_chunks(cls, repo_path: Path, chunks: Iterable[BaseNode], skip_tests=True):
         """
         Build chunk (import) to chunk (export) mapping by associating a chunk with
         the list of scopes, and then using the scope -> scope mapping provided in RepoGraph
@@ -115,6 +115,8 @@ class ClusterNode(Node):
     title: str = ""
     summary: str = ""
     key_variables: List[str] = field(default_factory=list)
+    # content_hash of the content the summary was generated from
+    summary_hash: str = ""
 
     # def dict(self):
     #     return {
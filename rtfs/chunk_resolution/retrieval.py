@@ -0,0 +1,194 @@
+from collections import defaultdict
+from dataclasses import dataclass
+from logging import getLogger
+from typing import Dict, List, Set, Tuple
+
+import networkx as nx
+import numpy as np
+
+from .graph import ChunkEdgeKind, ClusterEdgeKind, NodeKind
+
+logger = getLogger(__name__)
+
+# Weight of each relation between chunks when walking the graph. Parallel edges
+# between the same chunks add up, and edges are walked in both directions since
+# both the caller and the callee of a hit are relevant to it
+RETRIEVAL_EDGE_WEIGHTS = {
+    ChunkEdgeKind.ImportFrom: 1.0,
+    ChunkEdgeKind.CallTo: 1.0,
+    ClusterEdgeKind.ChunkToCluster: 0.5,
+}
+
+
+@dataclass
+class RetrievedChunk:
+    id: str
+    file_path: str
+    span_ids: List[str]
+    tokens: int
+    score: float
+
+
+class GraphRetriever:
+    """
+    Expands search hits to the chunks related to them in a ChunkGraph. Candidates
+    are the chunks within max_depth call or import edges of a hit, or in the same
+    cluster, ranked by personalized PageRank from the hits. The transition matrix
+    is built once per graph, in CSR form, with clusters as intermediate nodes so
+    siblings are connected without an edge per pair
+    """
+
+    DAMPING = 0.85
+    MAX_ITERATIONS = 50
+    TOLERANCE = 1e-6
+
+    def __init__(self, graph: nx.MultiDiGraph):
+        self.nodes: List[str] = []
+        self.chunks: Dict[str, RetrievedChunk] = {}
+        self._span_chunks: Dict[Tuple[str, str], List[int]] = defaultdict(list)
+
+        for node_id, data in graph.nodes(data=True):
+            kind = data.get("kind")
+            if kind == NodeKind.Chunk:
+                metadata = data["metadata"]
+                if not isinstance(metadata, dict):
+                    metadata = metadata.to_json()
+                self.chunks[node_id] = RetrievedChunk(
+                    id=node_id,
+                    file_path=metadata["file_path"],
+                    span_ids=metadata["span_ids"],
+                    tokens=metadata["tokens"],
+                    score=0.0,
+                )
+            elif kind != NodeKind.Cluster:
+                continue
+
+            self.nodes.append(node_id)
+
+        self._index = {node_id: i for i, node_id in enumerate(self.nodes)}
+        self._is_chunk = np.array([node_id in self.chunks for node_id in self.nodes])
+        for node_id, chunk in self.chunks.items():
+            for span_id in chunk.span_ids:
+                self._span_chunks[(chunk.file_path, span_id)].append(
+                    self._index[node_id]
+                )
+
+        weights: Dict[Tuple[int, int], float] = defaultdict(float)
+        for src, dst, kind in graph.edges(data="kind"):
+            weight = RETRIEVAL_EDGE_WEIGHTS.get(kind)
+            if weight is None or src not in self._index or dst not in self._index:
+                continue
+
+            src, dst = self._index[src], self._index[dst]
+            weights[(src, dst)] += weight
+            weights[(dst, src)] += weight
+
+        n = len(self.nodes)
+        edges = sorted(weights.items())
+        rows = np.array([src for (src, _), _ in edges], dtype=np.int64)
+        self._indices = np.array([dst for (_, dst), _ in edges], dtype=np.int64)
+        self._indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=n), out=self._indptr[1:])
+
+        # Row normalized, so each row holds the transition probabilities of a node
+        values = np.array([weight for _, weight in edges], dtype=np.float64)
+        out_weights = np.bincount(rows, weights=values, minlength=n)
+        self._rows = rows
+        self._probs = values / out_weights[rows] if len(values) else values
+        self._dangling = out_weights == 0
+
+        logger.info(f"Built retrieval matrix of {n} nodes and {len(edges)} edges")
+
+    @classmethod
+    def from_json(cls, graph_json: Dict) -> "GraphRetriever":
+        return cls(nx.node_link_graph(graph_json["link_data"]))
+
+    def chunks_for_span(self, file_path: str, span_id: str) -> List[str]:
+        return [self.nodes[i] for i in self._span_chunks.get((file_path, span_id), [])]
+
+    def retrieve(
+        self, seeds: Dict[str, float], max_depth: int = 2, max_tokens: int = 4000
+    ) -> List[RetrievedChunk]:
+        """
+        Chunks related to the seed chunks, weighted by relevance, by descending
+        personalized PageRank, up to max_tokens. Seeds are candidates themselves
+        """
+        seeds = {
+            self._index[node_id]: weight
+            for node_id, weight in seeds.items()
+            if node_id in self._index and weight > 0
+        }
+        if not seeds:
+            return []
+
+        candidates = self._neighborhood(seeds.keys(), max_depth)
+        scores = self._pagerank(seeds)
+
+        retrieved = []
+        total_tokens = 0
+        for i in sorted(candidates, key=lambda i: scores[i], reverse=True):
+            chunk = self.chunks[self.nodes[i]]
+            if total_tokens + chunk.tokens > max_tokens and retrieved:
+                continue
+
+            total_tokens += chunk.tokens
+            retrieved.append(
+                RetrievedChunk(
+                    id=chunk.id,
+                    file_path=chunk.file_path,
+                    span_ids=chunk.span_ids,
+                    tokens=chunk.tokens,
+                    score=float(scores[i]),
+                )
+            )
+        return retrieved
+
+    def _neighbors(self, i: int) -> np.ndarray:
+        return self._indices[self._indptr[i] : self._indptr[i + 1]]
+
+    def _neighborhood(self, seeds: Set[int], max_depth: int) -> Set[int]:
+        """
+        Chunks within max_depth hops of the seeds. Going through a cluster to its
+        chunks counts as a single hop
+        """
+        visited = set(seeds)
+        frontier = list(seeds)
+        for _ in range(max_depth):
+            next_frontier = []
+            for i in frontier:
+                for j in self._neighbors(i):
+                    j = int(j)
+                    if not self._is_chunk[j]:
+                        next_frontier.extend(
+                            int(k) for k in self._neighbors(j) if k not in visited
+                        )
+                    elif j not in visited:
+                        next_frontier.append(j)
+
+            frontier = [i for i in dict.fromkeys(next_frontier) if i not in visited]
+            visited.update(frontier)
+
+        return {i for i in visited if self._is_chunk[i]}
+
+    def _pagerank(self, seeds: Dict[int, float]) -> np.ndarray:
+        n = len(self.nodes)
+        personalization = np.zeros(n)
+        for i, weight in seeds.items():
+            personalization[i] = weight
+        personalization /= personalization.sum()
+
+        scores = personalization.copy()
+        for _ in range(self.MAX_ITERATIONS):
+            spread = np.bincount(
+                self._indices, weights=self._probs * scores[self._rows], minlength=n
+            )
+            # Nodes without edges teleport back to the seeds
+            restart = 1 - self.DAMPING + self.DAMPING * scores[self._dangling].sum()
+            next_scores = self.DAMPING * spread + restart * personalization
+
+            converged = np.abs(next_scores - scores).sum() < self.TOLERANCE
+            scores = next_scores
+            if converged:
+                break
+
+        return scores
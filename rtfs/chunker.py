@@ -1,64 +1,159 @@
 from pathlib import Path
 import os
-from typing import Dict, List
+import logging
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, IO, Iterator, List, Optional, Tuple
 import mimetypes
 import fnmatch
-from pathlib import Path
 import json
 
 from llama_index.core import SimpleDirectoryReader
+from llama_index.core.schema import BaseNode, Document
 from rtfs.moatless.epic_split import EpicSplitter
+from rtfs.moatless.chunk_cache import ChunkCache, ChunkCacheStats
 from rtfs.moatless.settings import IndexSettings
 from rtfs.chunk_resolution.chunk_graph import ChunkGraph
+from rtfs.config import CHUNK_CACHE_DIR
 
+logger = logging.getLogger(__name__)
 
-def chunk(repo_path: str, persist_dir: str = "") -> ChunkGraph:
-    def file_metadata_func(file_path: str) -> Dict:
-        test_patterns = [
-            "**/test/**",
-            "**/tests/**",
-            "**/test_*.py",
-            "**/*_test.py",
-        ]
-        category = (
-            "test"
-            if any(fnmatch.fnmatch(file_path, pattern) for pattern in test_patterns)
-            else "implementation"
-        )
-
-        return {
-            "file_path": file_path,
-            "file_name": os.path.basename(file_path),
-            "file_type": mimetypes.guess_type(file_path)[0],
-            "category": category,
-        }
+# Max number of files being split per worker before the reader blocks
+MAX_PENDING_PER_WORKER = 2
 
-    reader = SimpleDirectoryReader(
-        input_dir=repo_path,
-        file_metadata=file_metadata_func,
-        filename_as_id=True,
-        required_exts=[".py"],  # TODO: Shouldn't be hardcoded and filtered
-        recursive=True,
+# Splitter of the current worker process, set by _init_worker
+_worker_splitter: Optional[EpicSplitter] = None
+
+
+def file_metadata_func(file_path: str) -> Dict:
+    test_patterns = [
+        "**/test/**",
+        "**/tests/**",
+        "**/test_*.py",
+        "**/*_test.py",
+    ]
+    category = (
+        "test"
+        if any(fnmatch.fnmatch(file_path, pattern) for pattern in test_patterns)
+        else "implementation"
     )
 
-    settings = IndexSettings()
-    docs = reader.load_data()
+    return {
+        "file_path": file_path,
+        "file_name": os.path.basename(file_path),
+        "file_type": mimetypes.guess_type(file_path)[0],
+        "category": category,
+    }
 
-    splitter = EpicSplitter(
+
+def create_splitter(repo_path: str, settings: IndexSettings) -> EpicSplitter:
+    return EpicSplitter(
         min_chunk_size=settings.min_chunk_size,
         chunk_size=settings.chunk_size,
         hard_token_limit=settings.hard_token_limit,
         max_chunks=settings.max_chunks,
         comment_strategy=settings.comment_strategy,
+        merge_strategy=settings.merge_strategy,
         repo_path=repo_path,
+        chunk_cache=(
+            ChunkCache(settings.chunk_cache_dir) if settings.chunk_cache_dir else None
+        ),
     )
 
-    prepared_nodes = splitter.get_nodes_from_documents(docs, show_progress=True)
-    chunk_graph = ChunkGraph.from_chunks(Path(repo_path), prepared_nodes)
+
+def _pop_cache_stats(splitter: EpicSplitter) -> ChunkCacheStats:
+    if splitter.chunk_cache:
+        return splitter.chunk_cache.pop_stats()
+    return ChunkCacheStats()
+
+
+def _init_worker(repo_path: str, settings: IndexSettings):
+    global _worker_splitter
+    _worker_splitter = create_splitter(repo_path, settings)
+
+
+def _split_documents(
+    documents: List[Document],
+) -> Tuple[List[BaseNode], ChunkCacheStats]:
+    nodes = _worker_splitter.get_nodes_from_documents(documents)
+    return nodes, _pop_cache_stats(_worker_splitter)
+
+
+def iter_chunks(
+    repo_path: str,
+    settings: Optional[IndexSettings] = None,
+    num_workers: int = 0,
+) -> Iterator[BaseNode]:
+    """
+    Lazily reads, parses and splits the repo one file at a time. With workers, at most
+    MAX_PENDING_PER_WORKER files per worker are in flight, so memory stays bounded
+    when the consumer is slower than the splitting. Chunks are yielded in file order.
+    Without settings, parsed chunks are cached in CHUNK_CACHE_DIR
+    """
+    settings = settings or IndexSettings(chunk_cache_dir=CHUNK_CACHE_DIR)
+    reader = SimpleDirectoryReader(
+        input_dir=repo_path,
+        file_metadata=file_metadata_func,
+        filename_as_id=True,
+        required_exts=[".py"],  # TODO: Shouldn't be hardcoded and filtered
+        recursive=True,
+    )
+
+    cache_stats = ChunkCacheStats()
+
+    if not num_workers:
+        splitter = create_splitter(repo_path, settings)
+        for documents in reader.iter_data(show_progress=True):
+            yield from splitter.get_nodes_from_documents(documents)
+        cache_stats.merge(_pop_cache_stats(splitter))
+    else:
+        with ProcessPoolExecutor(
+            max_workers=num_workers,
+            initializer=_init_worker,
+            initargs=(repo_path, settings),
+        ) as executor:
+            pending = deque()
+            for documents in reader.iter_data(show_progress=True):
+                pending.append(executor.submit(_split_documents, documents))
+                if len(pending) >= num_workers * MAX_PENDING_PER_WORKER:
+                    nodes, stats = pending.popleft().result()
+                    cache_stats.merge(stats)
+                    yield from nodes
+
+            while pending:
+                nodes, stats = pending.popleft().result()
+                cache_stats.merge(stats)
+                yield from nodes
+
+    if settings.chunk_cache_dir:
+        logger.info(str(cache_stats))
+
+
+def _persist_chunks(nodes: Iterator[BaseNode], f: IO) -> Iterator[BaseNode]:
+    for node in nodes:
+        f.write(json.dumps(node.dict()) + "\n")
+        yield node
+
+
+def chunk(
+    repo_path: str,
+    persist_dir: str = "",
+    num_workers: int = 0,
+    chunk_cache_dir: Optional[str] = CHUNK_CACHE_DIR,
+) -> ChunkGraph:
+    """
+    Chunks the repo into a ChunkGraph. If persist_dir is set, the chunks are appended
+    to it as JSON lines while they are added to the graph. Files unchanged since
+    they were chunked into chunk_cache_dir are not parsed again
+    """
+    nodes = iter_chunks(
+        repo_path,
+        IndexSettings(chunk_cache_dir=chunk_cache_dir),
+        num_workers=num_workers,
+    )
 
     if persist_dir:
-        node_dict = [node.dict() for node in prepared_nodes]
         with open(persist_dir, "w") as f:
-            f.write(json.dumps(node_dict))
+            return ChunkGraph.from_chunks(Path(repo_path), _persist_chunks(nodes, f))
 
-    return chunk_graph
+    return ChunkGraph.from_chunks(Path(repo_path), nodes)
@@ -1,4 +1,5 @@
 import importlib.resources as pkg_resources
+import os
 
 LANGUAGE = "python"
 LANG_MODULE = pkg_resources.files(f"rtfs") / "languages" / LANGUAGE
@@ -16,3 +17,25 @@ NAMESPACE_DELIMETERS = {"python": "."}
 SYS_MODULES_LIST = LANG_MODULE / "sys_modules.json"
 
 THIRD_PARTY_MODULES_LIST = LANG_MODULE / "third_party_modules.json"
+
+# Caches and other data written by rtfs, instead of the working directory
+DATA_DIR = os.getenv("RTFS_DATA_DIR", os.path.join(os.path.expanduser("~"), ".rtfs"))
+
+# Directory of the parsed chunk cache, see rtfs.moatless.chunk_cache. Unset disables
+# it
+CHUNK_CACHE_DIR = os.getenv("CHUNK_CACHE_DIR") or None
+
+# Persistent cache of summarize/categorize LLM responses, see rtfs.llm_cache
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", os.path.join(DATA_DIR, "llm_cache.sqlite"))
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+
+# LLM clients shared by all models, see rtfs.llm_client. "fake" answers offline
+LLM_BACKEND = os.getenv("LLM_BACKEND", "openai")
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", 64))
+FAKE_LLM_LATENCY = float(os.getenv("FAKE_LLM_LATENCY", 0.5))
+
+# Dollar budgets for LLM calls per process and per user, reset every
+# LLM_COST_WINDOW seconds, see rtfs.llm_governor. 0 means unlimited
+LLM_TOTAL_COST_LIMIT = float(os.getenv("LLM_TOTAL_COST_LIMIT", 0))
+LLM_USER_COST_LIMIT = float(os.getenv("LLM_USER_COST_LIMIT", 0))
+LLM_COST_WINDOW = int(os.getenv("LLM_COST_WINDOW", 24 * 60 * 60))
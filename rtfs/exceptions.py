@@ -4,3 +4,7 @@ class LLMValidationError(Exception):
 
 class ContextLengthExceeded(Exception):
     pass
+
+
+class CostLimitExceededError(Exception):
+    pass
@@ -1,6 +1,7 @@
 from pathlib import Path
 from typing import List, Dict, Tuple
 from collections import defaultdict
+from functools import cached_property
 from networkx import MultiDiGraph
 
 from rtfs.fs import RepoFs
@@ -31,7 +32,11 @@ class FileGraph:
         self._graph = MultiDiGraph()
         self._repo_graph = RepoGraph(repo_path)
         self._file2scope = defaultdict(set)
-        self._lm: BaseModel = OpenAIModel()
+
+    # Only created when a graph actually queries the LLM
+    @cached_property
+    def _lm(self) -> BaseModel:
+        return OpenAIModel()
 
     @classmethod
     def from_repo(cls, repo_path: Path):
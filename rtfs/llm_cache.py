@@ -0,0 +1,104 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from hashlib import sha256
+from typing import Optional, Type
+
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+
+class LLMCache:
+    """
+    Persistent cache of structured LLM responses in SQLite, keyed by the model, the
+    prompt and the response format schema. Least recently used responses are evicted
+    once they take up more than max_bytes. The database is opened on first use
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(model: str, prompt: str, response_format: Type[BaseModel]) -> str:
+        prompt_hash = sha256(prompt.encode("utf-8", "surrogatepass")).hexdigest()
+        schema = json.dumps(response_format.model_json_schema(), sort_keys=True)
+        schema_hash = sha256(schema.encode()).hexdigest()
+        return sha256(f"{model}\0{prompt_hash}\0{schema_hash}".encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT response FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            conn.execute(
+                "UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key)
+            )
+            conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, model: str, response: str):
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (key, model, response, len(response.encode()), time.time()),
+            )
+            self._evict(conn)
+            conn.commit()
+
+    def _evict(self, conn: sqlite3.Connection):
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()
+        excess = total[0] - self.max_bytes
+        if excess <= 0:
+            return
+
+        evicted = []
+        for key, size in conn.execute(
+            "SELECT key, size FROM responses ORDER BY last_used"
+        ):
+            evicted.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+
+        conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        logger.info(f"Evicted {len(evicted)} responses from LLM cache {self.path}")
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            dirname = os.path.dirname(self.path)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    model TEXT NOT NULL,
+                    response TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_used REAL NOT NULL
+                )
+                """
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)"
+            )
+        return self._conn
@@ -0,0 +1,196 @@
+import asyncio
+import hashlib
+import threading
+import time
+import weakref
+from types import SimpleNamespace
+from typing import Any, Coroutine, Dict, Optional, Tuple, TypeVar
+
+import httpx
+from anthropic import Anthropic
+from anthropic import DefaultHttpxClient as AnthropicHttpxClient
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient, OpenAI
+
+from rtfs.config import LLM_BACKEND, FAKE_LLM_LATENCY, LLM_MAX_CONNECTIONS
+
+T = TypeVar("T")
+
+# Clients are shared by every model in the process, so all requests go through the
+# same pooled HTTP connections instead of a new pool per model instance
+_lock = threading.Lock()
+_clients: Dict[Tuple, Any] = {}
+
+# httpx async connection pools can only be used from the event loop they were
+# created on, so async clients are kept per loop
+_async_clients: (
+    "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Tuple, Any]]"
+) = weakref.WeakKeyDictionary()
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=LLM_MAX_CONNECTIONS,
+        max_keepalive_connections=LLM_MAX_CONNECTIONS,
+    )
+
+
+def get_openai_client(api_key: str, base_url: Optional[str] = None) -> OpenAI:
+    if LLM_BACKEND == "fake":
+        return fake_llm()
+
+    key = ("openai", api_key, base_url)
+    with _lock:
+        if key not in _clients:
+            _clients[key] = OpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                http_client=DefaultHttpxClient(limits=_limits()),
+            )
+        return _clients[key]
+
+
+def get_async_openai_client(
+    api_key: str, base_url: Optional[str] = None
+) -> AsyncOpenAI:
+    """
+    Client for the running event loop, so must be called from a coroutine
+    """
+    if LLM_BACKEND == "fake":
+        return fake_llm(asynchronous=True)
+
+    loop = asyncio.get_running_loop()
+    key = ("openai", api_key, base_url)
+    with _lock:
+        clients = _async_clients.setdefault(loop, {})
+        if key not in clients:
+            clients[key] = AsyncOpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                http_client=DefaultAsyncHttpxClient(limits=_limits()),
+            )
+        return clients[key]
+
+
+def get_anthropic_client(api_key: str) -> Anthropic:
+    if LLM_BACKEND == "fake":
+        return fake_llm()
+
+    key = ("anthropic", api_key)
+    with _lock:
+        if key not in _clients:
+            _clients[key] = Anthropic(
+                api_key=api_key,
+                http_client=AnthropicHttpxClient(limits=_limits()),
+            )
+        return _clients[key]
+
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+
+    with _lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=_loop.run_forever, name="llm-event-loop", daemon=True
+            ).start()
+        return _loop
+
+
+def run_sync(coro: Coroutine[Any, Any, T]) -> T:
+    """
+    Runs coro on the event loop shared by all sync callers and waits for the
+    result. Unlike creating a loop per call, the loop and the async clients bound to
+    it are reused, and it works from threads that already run an event loop
+    """
+    loop = _get_loop()
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        raise RuntimeError("run_sync called from the LLM event loop, await instead")
+
+    return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+
+class FakeLLM:
+    """
+    Offline stand-in for the OpenAI and Anthropic clients, used when LLM_BACKEND is
+    "fake". Every prompt is answered after FAKE_LLM_LATENCY seconds with a yaml
+    block derived from the prompt, so throughput can be measured without the API
+    """
+
+    def __init__(self, latency: float = FAKE_LLM_LATENCY, asynchronous: bool = False):
+        self.latency = latency
+        self.calls = 0
+
+        create = self._acreate if asynchronous else self._create
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=create))
+        self.messages = SimpleNamespace(create=create)
+
+    def _content(self, messages) -> Tuple[str, str]:
+        self.calls += 1
+
+        prompt = "\n".join(message["content"] for message in messages)
+        prompt_hash = hashlib.sha256(prompt.encode("utf-8", "surrogatepass"))
+        content = (
+            f"```yaml\nprompt_hash: {prompt_hash.hexdigest()[:16]}\n"
+            f"prompt_chars: {len(prompt)}\n```"
+        )
+        return prompt, content
+
+    def _usage(self, prompt: str, content: str) -> SimpleNamespace:
+        # Rough token counts, tiktoken needs network access to load its encodings
+        input_tokens, output_tokens = len(prompt) // 4, len(content) // 4
+        return SimpleNamespace(
+            prompt_tokens=input_tokens,
+            completion_tokens=output_tokens,
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+        )
+
+    def _response(self, messages, **kwargs):
+        prompt, content = self._content(messages)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+            content=[SimpleNamespace(text=content)],
+            usage=self._usage(prompt, content),
+        )
+
+    def _chunks(self, messages, **kwargs):
+        """
+        Streamed response, a chunk per line and a last chunk with the usage
+        """
+        prompt, content = self._content(messages)
+        for line in content.splitlines(keepends=True):
+            delta = SimpleNamespace(content=line)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=delta)], usage=None)
+        yield SimpleNamespace(choices=[], usage=self._usage(prompt, content))
+
+    def _create(self, messages, stream=False, **kwargs):
+        time.sleep(self.latency)
+        if stream:
+            return self._chunks(messages, **kwargs)
+        return self._response(messages, **kwargs)
+
+    async def _acreate(self, messages, stream=False, **kwargs):
+        await asyncio.sleep(self.latency)
+        if stream:
+            return self._astream(messages, **kwargs)
+        return self._response(messages, **kwargs)
+
+    async def _astream(self, messages, **kwargs):
+        for chunk in self._chunks(messages, **kwargs):
+            await asyncio.sleep(0)
+            yield chunk
+
+
+def fake_llm(asynchronous: bool = False) -> FakeLLM:
+    key = ("fake", asynchronous)
+    with _lock:
+        if key not in _clients:
+            _clients[key] = FakeLLM(asynchronous=asynchronous)
+        return _clients[key]
@@ -0,0 +1,133 @@
+import logging
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, Optional
+
+from rtfs.config import LLM_COST_WINDOW, LLM_TOTAL_COST_LIMIT, LLM_USER_COST_LIMIT
+from rtfs.exceptions import CostLimitExceededError
+from rtfs.rate_limit import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+# Rough number of characters per token, for estimating the tokens of a prompt
+# before it is sent
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(prompt: str) -> int:
+    return len(prompt) // CHARS_PER_TOKEN
+
+
+class LLMGovernor:
+    """
+    Process-wide limits for LLM calls. Each model gets a RateLimiter for its
+    requests and tokens per minute, shared by every caller, so calls over the limit
+    queue instead of failing with 429s. Spend is tracked for the process and per
+    user, and calls are refused once a dollar budget is spent, since waiting won't
+    free it up until the cost window resets
+    """
+
+    def __init__(
+        self,
+        total_cost_limit: float = 0.0,
+        user_cost_limit: float = 0.0,
+        cost_window: int = 24 * 60 * 60,
+    ):
+        self.total_cost_limit = total_cost_limit
+        self.user_cost_limit = user_cost_limit
+        self.cost_window = cost_window
+
+        self.total_cost = 0.0
+        self.user_costs: Dict[str, float] = defaultdict(float)
+        self.rejected = 0
+
+        self._limiters: Dict[str, RateLimiter] = {}
+        self._window_start = time.monotonic()
+        self._lock = threading.Lock()
+
+    def limiter(
+        self,
+        model: str,
+        requests_per_minute: Optional[int] = None,
+        tokens_per_minute: Optional[int] = None,
+    ) -> RateLimiter:
+        """
+        Limiter shared by all calls to model. The limits are set by the first caller
+        """
+        with self._lock:
+            if model not in self._limiters:
+                self._limiters[model] = RateLimiter(
+                    requests_per_minute, tokens_per_minute
+                )
+            return self._limiters[model]
+
+    def acquire(self, limiter: RateLimiter, tokens: int, user: Optional[str] = None):
+        self.check_budget(user)
+        limiter.acquire(tokens)
+
+    async def acquire_async(
+        self, limiter: RateLimiter, tokens: int, user: Optional[str] = None
+    ):
+        self.check_budget(user)
+        await limiter.acquire_async(tokens)
+
+    def check_budget(self, user: Optional[str] = None):
+        with self._lock:
+            self._reset_window()
+
+            if self.total_cost_limit and self.total_cost >= self.total_cost_limit:
+                self.rejected += 1
+                logger.warning(
+                    f"Cost {self.total_cost:.2f} exceeds limit {self.total_cost_limit:.2f}"
+                )
+                raise CostLimitExceededError("Total cost limit exceeded")
+
+            if (
+                user
+                and self.user_cost_limit
+                and self.user_costs[user] >= self.user_cost_limit
+            ):
+                self.rejected += 1
+                logger.warning(
+                    f"Cost {self.user_costs[user]:.2f} of {user} exceeds limit "
+                    f"{self.user_cost_limit:.2f}"
+                )
+                raise CostLimitExceededError("User cost limit exceeded")
+
+    def record(self, cost: float, user: Optional[str] = None):
+        with self._lock:
+            self._reset_window()
+            self.total_cost += cost
+            if user:
+                self.user_costs[user] += cost
+
+    def metrics(self) -> Dict:
+        with self._lock:
+            metrics = {
+                "total_cost": self.total_cost,
+                "total_cost_limit": self.total_cost_limit,
+                "user_cost_limit": self.user_cost_limit,
+                "users": len(self.user_costs),
+                "rejected": self.rejected,
+                "window_remaining": max(
+                    0, self.cost_window - (time.monotonic() - self._window_start)
+                ),
+            }
+            limiters = dict(self._limiters)
+
+        metrics["models"] = {
+            model: limiter.metrics() for model, limiter in limiters.items()
+        }
+        return metrics
+
+    def _reset_window(self):
+        if time.monotonic() - self._window_start < self.cost_window:
+            return
+
+        self.total_cost = 0.0
+        self.user_costs.clear()
+        self._window_start = time.monotonic()
+
+
+llm_governor = LLMGovernor(LLM_TOTAL_COST_LIMIT, LLM_USER_COST_LIMIT, LLM_COST_WINDOW)
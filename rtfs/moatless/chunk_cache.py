@@ -0,0 +1,84 @@
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass
+from hashlib import sha256
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Bump when the parser or splitter output changes so stale entries are not served
+CHUNK_CACHE_VERSION = "1"
+
+
+@dataclass
+class ChunkCacheStats:
+    hits: int = 0
+    misses: int = 0
+    time_saved: float = 0.0
+
+    def merge(self, other: "ChunkCacheStats"):
+        self.hits += other.hits
+        self.misses += other.misses
+        self.time_saved += other.time_saved
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __str__(self):
+        return (
+            f"Chunk cache: {self.hits}/{self.hits + self.misses} files hit "
+            f"({self.hit_rate:.0%}), saved {self.time_saved:.2f} seconds"
+        )
+
+
+class ChunkCache:
+    """
+    On-disk cache of the chunks produced for a file, keyed by the file content,
+    the splitter settings and CHUNK_CACHE_VERSION. Entries store the rendered chunk
+    content and chunk metadata, not the document metadata, so a file that moved
+    still hits the cache.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        self.stats = ChunkCacheStats()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, content: str, settings_hash: str) -> str:
+        identity = f"{CHUNK_CACHE_VERSION}:{settings_hash}:{content}"
+        return sha256(identity.encode("utf-8", "surrogatepass")).hexdigest()
+
+    def get(self, key: str) -> Optional[List[Dict]]:
+        starttime = time.time()
+        try:
+            with open(self._path(key), "r") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            self.stats.misses += 1
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Failed to read chunk cache entry {key}: {e}")
+            self.stats.misses += 1
+            return None
+
+        self.stats.hits += 1
+        self.stats.time_saved += max(data["elapsed"] - (time.time() - starttime), 0)
+        return data["chunks"]
+
+    def put(self, key: str, chunks: List[Dict], elapsed: float):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"elapsed": elapsed, "chunks": chunks}, f)
+        os.replace(tmp_path, path)
+
+    def pop_stats(self) -> ChunkCacheStats:
+        stats, self.stats = self.stats, ChunkCacheStats()
+        return stats
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
@@ -1,6 +1,7 @@
 import re
+from bisect import bisect_left
 from enum import Enum
-from typing import List, Optional, Set
+from typing import Any, List, Optional, Set
 
 from pydantic import BaseModel, validator, Field, root_validator
 from typing_extensions import deprecated
@@ -276,6 +277,7 @@ class BlockSpan(BaseModel):
     initiating_block: "CodeBlock" = Field(
         default=None,
         description="The block that initiated the span.",
+        exclude=True,
     )
 
     @property
@@ -336,9 +338,10 @@ class CodeBlock(BaseModel):
     tokens: int = 0
     children: List["CodeBlock"] = []
     validation_errors: List[ValidationError] = []
-    parent: Optional["CodeBlock"] = None
-    previous: Optional["CodeBlock"] = None
-    next: Optional["CodeBlock"] = None
+    # Back-references are excluded so serialising a block doesn't walk the whole tree
+    parent: Optional["CodeBlock"] = Field(default=None, exclude=True)
+    previous: Optional["CodeBlock"] = Field(default=None, exclude=True)
+    next: Optional["CodeBlock"] = Field(default=None, exclude=True)
 
     @validator("type", pre=True, always=True)
     def validate_type(cls, v):
@@ -348,6 +351,33 @@ class CodeBlock(BaseModel):
 
     def __init__(self, **data):
         super().__init__(**data)
+        self._init_block()
+
+    @classmethod
+    def construct_block(cls, **data) -> "CodeBlock":
+        """
+        Creates a block without running pydantic validation. Used by the parser,
+        which already passes values of the right types, to avoid validating every
+        node of every parsed file.
+        """
+        if data.get("type") is None:
+            raise ValueError("Cannot create CodeBlock without type.")
+
+        block = cls.model_construct(**data)
+        block._init_block()
+        return block
+
+    def __setattr__(self, name: str, value: Any):
+        # The parser assigns fields of every block several times. Through pydantic,
+        # each assignment is also recorded in the set of fields set on the block,
+        # which grows to take more memory than the rest of the block. All fields
+        # are in __dict__, private attributes aren't
+        if name in self.__dict__:
+            self.__dict__[name] = value
+        else:
+            super().__setattr__(name, value)
+
+    def _init_block(self):
         for child in self.children:
             child.parent = self
 
@@ -380,6 +410,7 @@ class CodeBlock(BaseModel):
 
         self.children.insert(index, child)
         child.parent = self
+        self._invalidate_index()
 
     def insert_children(self, index: int, children: List["CodeBlock"]):
         for child in children:
@@ -390,6 +421,7 @@ class CodeBlock(BaseModel):
         self.children.append(child)
         self.span_ids.update(child.span_ids)
         child.parent = self
+        self._invalidate_index()
 
     def append_children(self, children: List["CodeBlock"]):
         for child in children:
@@ -403,6 +435,7 @@ class CodeBlock(BaseModel):
         )
         for child in children:
             child.parent = self
+        self._invalidate_index()
 
     def replace_child(self, index: int, child: "CodeBlock"):
         # TODO: Do a proper update of everything when replacing child blocks
@@ -412,9 +445,38 @@ class CodeBlock(BaseModel):
 
         self.children[index] = child
         child.parent = self
+        self._invalidate_index()
 
     def remove_child(self, index: int):
         del self.children[index]
+        self._invalidate_index()
+
+    def get_block_index(self) -> Optional["BlockIndex"]:
+        return None
+
+    def invalidate_index(self):
+        pass
+
+    def _root_block(self) -> "CodeBlock":
+        root = self
+        while root.parent:
+            root = root.parent
+        return root
+
+    def _invalidate_index(self):
+        self._root_block().invalidate_index()
+
+    def _find_block_index(self):
+        """
+        Returns the block index of the module and the position of this block in it,
+        or (None, None) if the block is not part of an indexed module
+        """
+        index = self._root_block().get_block_index()
+        if index:
+            position = index.position(self)
+            if position is not None:
+                return index, position
+        return None, None
 
     def sync_indentation(self, original_block: "CodeBlock", updated_block: "CodeBlock"):
         original_indentation_length = len(original_block.indentation) + len(
@@ -856,11 +918,26 @@ class CodeBlock(BaseModel):
 
     def find_spans_by_line_numbers(
         self, start_line: int, end_line: int = None
+    ) -> List[BlockSpan]:
+        if end_line is None:
+            end_line = start_line
+
+        index, position = self._find_block_index()
+        if index and index.sorted_lines:
+            children = index.blocks_in_lines(position, start_line, end_line)
+            return self._find_spans_by_line_numbers(
+                start_line, end_line, lambda block: children.get(id(block), [])
+            )
+
+        return self._find_spans_by_line_numbers(
+            start_line, end_line, lambda block: block.children
+        )
+
+    def _find_spans_by_line_numbers(
+        self, start_line: int, end_line: int, get_children
     ) -> List[BlockSpan]:
         spans = []
-        for child in self.children:
-            if end_line is None:
-                end_line = start_line
+        for child in get_children(self):
 
             if child.end_line < start_line:
                 continue
@@ -878,7 +955,9 @@ class CodeBlock(BaseModel):
                 ):
                     spans.append(child.belongs_to_span)
 
-            child_spans = child.find_spans_by_line_numbers(start_line, end_line)
+            child_spans = child._find_spans_by_line_numbers(
+                start_line, end_line, get_children
+            )
             for span in child_spans:
                 if span not in spans:
                     spans.append(span)
@@ -1041,6 +1120,10 @@ class CodeBlock(BaseModel):
         if not path:
             return self
 
+        index, position = self._find_block_index()
+        if index and id(self) in index.paths:
+            return index.block_by_path.get(index.paths[id(self)] + tuple(path))
+
         for child in self.children:
             if child.identifier == path[0]:
                 if len(path) == 1:
@@ -1051,13 +1134,24 @@ class CodeBlock(BaseModel):
         return None
 
     def find_blocks_by_span_id(self, span_id: str) -> List["CodeBlock"]:
+        index, position = self._find_block_index()
+        if index:
+            return [
+                index.blocks[p]
+                for p in index.span_range(
+                    span_id, position, index.subtree_end[position]
+                )
+            ]
+
+        return self._find_blocks_by_span_id(span_id)
+
+    def _find_blocks_by_span_id(self, span_id: str) -> List["CodeBlock"]:
         blocks = []
         if self.belongs_to_span and self.belongs_to_span.span_id == span_id:
             blocks.append(self)
 
         for child in self.children:
-            # TODO: Optimize to just check relevant children (by mapping spans?
-            blocks.extend(child.find_blocks_by_span_id(span_id))
+            blocks.extend(child._find_blocks_by_span_id(span_id))
 
         return blocks
 
@@ -1081,6 +1175,11 @@ class CodeBlock(BaseModel):
         return None
 
     def find_first_by_span_id(self, span_id: str) -> Optional["CodeBlock"]:
+        index, position = self._find_block_index()
+        if index:
+            positions = index.span_range(span_id, position, index.subtree_end[position])
+            return index.blocks[positions[0]] if positions else None
+
         if self.belongs_to_span and self.belongs_to_span.span_id == span_id:
             return self
 
@@ -1092,6 +1191,24 @@ class CodeBlock(BaseModel):
         return None
 
     def find_last_by_span_id(self, span_id: str) -> Optional["CodeBlock"]:
+        index, position = self._find_block_index()
+        if index:
+            positions = index.span_range(
+                span_id, position + 1, index.subtree_end[position]
+            )
+            if not positions:
+                return None
+
+            # Parents are checked before their children, so a parent in the span
+            # wins over the last block in the span
+            found = index.blocks[positions[-1]]
+            block = found.parent
+            while block is not self:
+                if block.belongs_to_span and block.belongs_to_span.span_id == span_id:
+                    found = block
+                block = block.parent
+            return found
+
         for child in reversed(self.children):
             if child.belongs_to_span and child.belongs_to_span.span_id == span_id:
                 return child
@@ -1172,6 +1289,19 @@ class CodeBlock(BaseModel):
         return self.find_blocks_with_types([block_type])
 
     def find_first_by_start_line(self, start_line: int) -> Optional["CodeBlock"]:
+        index, position = self._find_block_index()
+        if index and index.sorted_lines:
+            end = index.subtree_end[position]
+            first = bisect_left(index.start_lines, start_line, position + 1, end)
+
+            # Only the last block starting before start_line can be a leaf covering it
+            if first - 1 > position:
+                block = index.blocks[first - 1]
+                if not block.children and block.end_line >= start_line:
+                    return block
+
+            return index.blocks[first] if first < end else None
+
         for child in self.children:
             if child.start_line >= start_line:
                 return child
@@ -1,10 +1,12 @@
+import heapq
+import json
 import re
 import time
-from typing import Sequence, List, Optional, Any, Callable
+from typing import Sequence, List, Optional, Any, Callable, Dict
 from hashlib import sha256
 from enum import Enum
 
-from llama_index.core.bridge.pydantic import Field
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
 from llama_index.core.callbacks import CallbackManager
 from llama_index.core.node_parser import NodeParser, TextSplitter, TokenTextSplitter
 from llama_index.core.node_parser.node_utils import logger
@@ -16,8 +18,9 @@ from rtfs.moatless.codeblocks import (
     CodeBlock,
     CodeBlockType,
 )
+from rtfs.moatless.chunk_cache import ChunkCache
 from rtfs.moatless.parser.python import PythonParser
-from rtfs.moatless.settings import CommentStrategy
+from rtfs.moatless.settings import CommentStrategy, MergeStrategy
 
 
 class CodeNode(TextNode):
@@ -82,6 +85,10 @@ class EpicSplitter(NodeParser):
         default=100, description="Max number of chunks to split a document into."
     )
 
+    merge_strategy: MergeStrategy = Field(
+        default=MergeStrategy.LEGACY, description="Strategy to merge small chunks."
+    )
+
     min_chunk_size: int = Field(default=256, description="Min tokens to split code.")
 
     max_chunk_size: int = Field(default=2000, description="Max tokens in one chunk.")
@@ -96,6 +103,8 @@ class EpicSplitter(NodeParser):
         default=None, description="Callback to call when indexing a code block."
     )
 
+    _chunk_cache: Optional[ChunkCache] = PrivateAttr(default=None)
+
     # _fallback_code_splitter: Optional[TextSplitter] = PrivateAttr() TODO: Implement fallback when tree sitter fails
 
     def __init__(
@@ -111,11 +120,13 @@ class EpicSplitter(NodeParser):
         index_callback: Optional[Callable[[CodeBlock], None]] = None,
         repo_path: Optional[str] = None,
         comment_strategy: CommentStrategy = CommentStrategy.ASSOCIATE,
+        merge_strategy: MergeStrategy = MergeStrategy.LEGACY,
         # fallback_code_splitter: Optional[TextSplitter] = None,
         include_non_code_files: bool = True,
         tokenizer: Optional[Callable] = None,
         non_code_file_extensions: Optional[List[str]] = ["md", "txt"],
         callback_manager: Optional[CallbackManager] = None,
+        chunk_cache: Optional[ChunkCache] = None,
     ) -> None:
         callback_manager = callback_manager or CallbackManager([])
 
@@ -132,6 +143,7 @@ class EpicSplitter(NodeParser):
             index_callback=index_callback,
             repo_path=repo_path,
             comment_strategy=comment_strategy,
+            merge_strategy=merge_strategy,
             include_non_code_files=include_non_code_files,
             non_code_file_extensions=non_code_file_extensions,
             include_metadata=include_metadata,
@@ -139,6 +151,12 @@ class EpicSplitter(NodeParser):
             callback_manager=callback_manager,
         )
 
+        self._chunk_cache = chunk_cache
+
+    @property
+    def chunk_cache(self) -> Optional[ChunkCache]:
+        return self._chunk_cache
+
     @classmethod
     def class_name(cls):
         return "GhostcoderNodeParser"
@@ -156,6 +174,17 @@ class EpicSplitter(NodeParser):
         for node in nodes_with_progress:
             file_path = node.metadata.get("file_path")
             content = node.get_content()
+            file_starttime = time.time()
+
+            cache_key = None
+            if self._chunk_cache:
+                cache_key = self._chunk_cache.key(content, self._settings_hash())
+                entries = self._chunk_cache.get(cache_key)
+                if entries is not None:
+                    all_nodes.extend(
+                        self._create_code_node(entry, node) for entry in entries
+                    )
+                    continue
 
             try:
                 # TODO: Derive language from file extension
@@ -189,19 +218,41 @@ class EpicSplitter(NodeParser):
                 logger.info(f"Splitting file {file_path} in {len(chunks)} chunks")
 
             starttime = time.time_ns()
-            for chunk in chunks:
-                path_tree = self._create_path_tree(chunk)
-                content = self._to_context_string(codeblock, path_tree)
-                chunk_node = self._create_node(content, node, chunk=chunk)
-                if chunk_node:
-                    all_nodes.append(chunk_node)
+            contents = self._to_context_strings(
+                codeblock, [self._create_path_tree(chunk) for chunk in chunks]
+            )
+            entries = [
+                self._create_chunk_entry(chunk_content, chunk=chunk)
+                for chunk, chunk_content in zip(chunks, contents)
+            ]
+            all_nodes.extend(self._create_code_node(entry, node) for entry in entries)
             parse_time = time.time_ns() - starttime
             if parse_time > 1e9:
                 print(
                     f"Create nodes for file {file_path} took {parse_time / 1e9:.2f} seconds."
                 )
+
+            if cache_key:
+                self._chunk_cache.put(
+                    cache_key, entries, elapsed=time.time() - file_starttime
+                )
         return all_nodes
 
+    def _settings_hash(self) -> str:
+        """
+        Hash of the settings that change the produced chunks, used in chunk cache keys
+        """
+        settings = {
+            "chunk_size": self.chunk_size,
+            "min_chunk_size": self.min_chunk_size,
+            "max_chunk_size": self.max_chunk_size,
+            "hard_token_limit": self.hard_token_limit,
+            "max_chunks": self.max_chunks,
+            "comment_strategy": self.comment_strategy.value,
+            "merge_strategy": self.merge_strategy.value,
+        }
+        return sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
     def _chunk_contents(
         self, codeblock: Optional[CodeBlock] = None, file_path: Optional[str] = None
     ) -> List[CodeBlockChunk]:
@@ -344,6 +395,13 @@ class EpicSplitter(NodeParser):
         return self._merge_chunks(chunks)
 
     def _merge_chunks(self, chunks: List[CodeBlockChunk]) -> List[CodeBlockChunk]:
+        if self.merge_strategy == MergeStrategy.GREEDY:
+            return self._merge_chunks_greedy(chunks)
+        return self._merge_chunks_legacy(chunks)
+
+    def _merge_chunks_legacy(
+        self, chunks: List[CodeBlockChunk]
+    ) -> List[CodeBlockChunk]:
         while True:
             merged_chunks = []
             should_continue = False
@@ -410,6 +468,87 @@ class EpicSplitter(NodeParser):
 
         return chunks
 
+    def _merge_chunks_greedy(
+        self, chunks: List[CodeBlockChunk]
+    ) -> List[CodeBlockChunk]:
+        """
+        Merges chunks in O(n log n) instead of looping to a fixpoint.
+
+        A single left to right pass merges every chunk smaller than min_chunk_size
+        with its left neighbour (or a small left neighbour into the chunk) as long as
+        the result stays within hard_token_limit. If there are still more than
+        max_chunks chunks, the smallest adjacent pairs are merged through a heap
+        until max_chunks is reached or no pair fits within hard_token_limit.
+        """
+        merged: List[CodeBlockChunk] = []
+        merged_tokens: List[int] = []
+
+        for chunk in chunks:
+            tokens = count_chunk_tokens(chunk)
+            if (
+                merged
+                and (
+                    merged_tokens[-1] < self.min_chunk_size
+                    or tokens < self.min_chunk_size
+                )
+                and merged_tokens[-1] + tokens <= self.hard_token_limit
+            ):
+                merged[-1].extend(chunk)
+                merged_tokens[-1] += tokens
+            else:
+                merged.append(list(chunk))
+                merged_tokens.append(tokens)
+
+        if len(merged) <= self.max_chunks:
+            return merged
+
+        # Doubly linked list over the merged chunks, with a version per chunk to
+        # invalidate heap entries that refer to a chunk that has grown since
+        count = len(merged)
+        prev_idx = list(range(-1, count - 1))
+        next_idx = list(range(1, count + 1))
+        next_idx[-1] = -1
+        version = [0] * count
+
+        heap = []
+        for i in range(count - 1):
+            pair_tokens = merged_tokens[i] + merged_tokens[i + 1]
+            if pair_tokens <= self.hard_token_limit:
+                heap.append((pair_tokens, i, version[i], version[i + 1]))
+        heapq.heapify(heap)
+
+        while count > self.max_chunks and heap:
+            pair_tokens, i, left_version, right_version = heapq.heappop(heap)
+            j = next_idx[i]
+            if (
+                merged[i] is None
+                or j == -1
+                or version[i] != left_version
+                or version[j] != right_version
+            ):
+                continue
+
+            merged[i].extend(merged[j])
+            merged_tokens[i] = pair_tokens
+            merged[j] = None
+            version[i] += 1
+            count -= 1
+
+            next_idx[i] = next_idx[j]
+            if next_idx[i] != -1:
+                prev_idx[next_idx[i]] = i
+
+            for left, right in ((prev_idx[i], i), (i, next_idx[i])):
+                if left == -1 or right == -1:
+                    continue
+                new_tokens = merged_tokens[left] + merged_tokens[right]
+                if new_tokens <= self.hard_token_limit:
+                    heapq.heappush(
+                        heap, (new_tokens, left, version[left], version[right])
+                    )
+
+        return [chunk for chunk in merged if chunk is not None]
+
     def _create_path_tree(cls, blocks: List[CodeBlock]) -> PathTree:
         path_tree = PathTree()
         for block in blocks:
@@ -423,59 +562,101 @@ class EpicSplitter(NodeParser):
         )
 
     def _to_context_string(self, codeblock: CodeBlock, path_tree: PathTree) -> str:
-        contents = ""
-
-        if codeblock.pre_lines:
-            contents += "\n" * (codeblock.pre_lines - 1)
-            for i, line in enumerate(codeblock.content_lines):
-                if i == 0 and line:
-                    contents += "\n" + codeblock.indentation + line
-                elif line:
-                    contents += "\n" + line
-                else:
-                    contents += "\n"
-        else:
-            contents += codeblock.pre_code + codeblock.content
-
-        has_outcommented_code = False
-        for i, child in enumerate(codeblock.children):
-            child_tree = path_tree.child_tree(child.identifier)
-            if child_tree and child_tree.show:
-                if has_outcommented_code and child.type not in [
-                    CodeBlockType.COMMENT,
-                    CodeBlockType.COMMENTED_OUT_CODE,
-                ]:
-                    if codeblock.type not in [
-                        CodeBlockType.CLASS,
-                        CodeBlockType.MODULE,
-                        CodeBlockType.TEST_SUITE,
-                    ]:
-                        contents += child.create_commented_out_block(
-                            "... other code"
-                        ).to_string()
-                contents += self._to_context_string(
-                    codeblock=child, path_tree=child_tree
-                )
-                has_outcommented_code = False
-            elif child_tree:
-                contents += self._to_context_string(
-                    codeblock=child, path_tree=child_tree
-                )
-                has_outcommented_code = False
-            elif child.type not in [
-                CodeBlockType.COMMENT,
-                CodeBlockType.COMMENTED_OUT_CODE,
-            ]:
-                has_outcommented_code = True
+        return self._to_context_strings(codeblock, [path_tree])[0]
+
+    def _to_context_strings(
+        self, codeblock: CodeBlock, path_trees: List[PathTree]
+    ) -> List[str]:
+        """
+        Renders the context string of every path tree in a single walk of the module,
+        so each block's content is only rendered once no matter how many chunks show it.
+        """
+        buffers: List[List[str]] = [[] for _ in path_trees]
+        placeholders: Dict[str, str] = {}
+
+        self._render_context_strings(
+            codeblock,
+            {i: path_tree for i, path_tree in enumerate(path_trees)},
+            buffers,
+            placeholders,
+        )
 
-        if has_outcommented_code and codeblock.type not in [
+        return ["".join(buffer) for buffer in buffers]
+
+    def _render_context_strings(
+        self,
+        codeblock: CodeBlock,
+        path_trees: Dict[int, PathTree],
+        buffers: List[List[str]],
+        placeholders: Dict[str, str],
+    ):
+        contents = self._block_content(codeblock)
+        for i in path_trees:
+            buffers[i].append(contents)
+
+        show_placeholder = codeblock.type not in [
             CodeBlockType.CLASS,
             CodeBlockType.MODULE,
             CodeBlockType.TEST_SUITE,
-        ]:
-            contents += child.create_commented_out_block("... other code").to_string()
+        ]
+        has_outcommented_code = {i: False for i in path_trees}
+
+        child = None
+        for child in codeblock.children:
+            child_trees: Dict[int, PathTree] = {}
+            is_comment = child.type in [
+                CodeBlockType.COMMENT,
+                CodeBlockType.COMMENTED_OUT_CODE,
+            ]
 
-        return contents
+            for i, path_tree in path_trees.items():
+                child_tree = path_tree.child_tree(child.identifier)
+                if child_tree:
+                    if (
+                        child_tree.show
+                        and has_outcommented_code[i]
+                        and not is_comment
+                        and show_placeholder
+                    ):
+                        buffers[i].append(self._placeholder(child, placeholders))
+                    child_trees[i] = child_tree
+                    has_outcommented_code[i] = False
+                elif not is_comment:
+                    has_outcommented_code[i] = True
+
+            if child_trees:
+                self._render_context_strings(child, child_trees, buffers, placeholders)
+
+        if show_placeholder:
+            for i, outcommented in has_outcommented_code.items():
+                if outcommented:
+                    buffers[i].append(self._placeholder(child, placeholders))
+
+    def _block_content(self, codeblock: CodeBlock) -> str:
+        if not codeblock.pre_lines:
+            return codeblock.pre_code + codeblock.content
+
+        lines = ["\n" * (codeblock.pre_lines - 1)]
+        for i, line in enumerate(codeblock.content_lines):
+            if i == 0 and line:
+                lines.append("\n" + codeblock.indentation + line)
+            elif line:
+                lines.append("\n" + line)
+            else:
+                lines.append("\n")
+        return "".join(lines)
+
+    def _placeholder(self, codeblock: CodeBlock, placeholders: Dict[str, str]) -> str:
+        # Same output as codeblock.create_commented_out_block("... other code").to_string()
+        placeholder = placeholders.get(codeblock.indentation)
+        if placeholder is None:
+            placeholder = (
+                "\n"
+                + codeblock.indentation
+                + codeblock.create_comment("... other code")
+            )
+            placeholders[codeblock.indentation] = placeholder
+        return placeholder
 
     def _contains_block_paths(self, codeblock: CodeBlock, block_paths: List[List[str]]):
         return [
@@ -487,14 +668,20 @@ class EpicSplitter(NodeParser):
     def _create_node(
         self, content: str, node: BaseNode, chunk: Optional[CodeBlockChunk] = None
     ) -> Optional[TextNode]:
-        metadata = {}
-        metadata.update(node.metadata)
+        return self._create_code_node(self._create_chunk_entry(content, chunk), node)
 
-        node_id = node.id_
+    def _create_chunk_entry(
+        self, content: str, chunk: Optional[CodeBlockChunk] = None
+    ) -> Dict:
+        """
+        Everything about a chunk that only depends on the file content, so it can be
+        stored in the chunk cache and combined with the document later
+        """
+        entry = {}
 
         if chunk:
-            metadata["start_line"] = chunk[0].start_line
-            metadata["end_line"] = chunk[-1].end_line
+            entry["start_line"] = chunk[0].start_line
+            entry["end_line"] = chunk[-1].end_line
 
             # TODO: Change this when EpicSplitter is adjusted to use the span concept natively
             span_ids = set(
@@ -504,21 +691,35 @@ class EpicSplitter(NodeParser):
                     if block.belongs_to_span
                 ]
             )
-            metadata["span_ids"] = list(span_ids)
+            entry["span_ids"] = list(span_ids)
 
-            node_id += f"_{chunk[0].path_string()}_{chunk[-1].path_string()}"
+            entry["id_suffix"] = f"_{chunk[0].path_string()}_{chunk[-1].path_string()}"
+
+        entry["content"] = content.strip("\n")
+        entry["tokens"] = len(get_tokenizer()(entry["content"]))
+
+        return entry
+
+    def _create_code_node(self, entry: Dict, node: BaseNode) -> CodeNode:
+        metadata = {}
+        metadata.update(node.metadata)
+
+        node_id = node.id_
 
-        content = content.strip("\n")
+        if "id_suffix" in entry:
+            metadata["start_line"] = entry["start_line"]
+            metadata["end_line"] = entry["end_line"]
+            metadata["span_ids"] = entry["span_ids"]
+            node_id += entry["id_suffix"]
 
-        tokens = get_tokenizer()(content)
-        metadata["tokens"] = len(tokens)
+        metadata["tokens"] = entry["tokens"]
 
         excluded_embed_metadata_keys = node.excluded_embed_metadata_keys.copy()
         excluded_embed_metadata_keys.extend(["start_line", "end_line", "tokens"])
 
         return CodeNode(
             id_=node_id,
-            text=content,
+            text=entry["content"],
             metadata=metadata,
             excluded_embed_metadata_keys=excluded_embed_metadata_keys,
             excluded_llm_metadata_keys=node.excluded_llm_metadata_keys,
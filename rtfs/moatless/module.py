@@ -1,9 +1,13 @@
+import heapq
 import logging
-from typing import List, Optional, Dict, Set
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from typing import List, Optional, Dict, Set, Tuple
 
 from networkx import DiGraph
 from pydantic import (
     ConfigDict,
+    Field,
 )
 
 from rtfs.moatless.codeblocks import CodeBlock, CodeBlockType
@@ -11,6 +15,109 @@ from rtfs.moatless.codeblocks import BlockSpan, SpanType
 
 logger = logging.getLogger(__name__)
 
+# Strength of the relationships followed when show_spans expands related spans.
+# Spans are added in order of the product of the weights on the path to them.
+MODULE_INITIATION_WEIGHT = 1.0
+CLASS_INITIATION_WEIGHT = 1.0
+OUTGOING_REFERENCE_WEIGHT = 0.8
+INCOMING_REFERENCE_WEIGHT = 0.5
+
+
+class BlockIndex:
+    """
+    Lookup tables over all blocks in a module, in the same pre-order as the recursive
+    find methods on CodeBlock walk them. Subtrees are contiguous ranges of positions.
+    """
+
+    def __init__(self, module: CodeBlock):
+        self.blocks: List[CodeBlock] = []
+        self.subtree_end: List[int] = []
+        self.start_lines: List[int] = []
+        self.positions: Dict[int, int] = {}
+        self.span_positions: Dict[str, List[int]] = defaultdict(list)
+
+        # Paths as resolved by CodeBlock.find_by_path, which follows the first child
+        # with a matching identifier
+        self.paths: Dict[int, Tuple[str, ...]] = {}
+        self.block_by_path: Dict[Tuple[str, ...], CodeBlock] = {}
+
+        self._add(module, ())
+
+        # Bisect on start lines relies on blocks starting in pre-order
+        self.sorted_lines = all(
+            a <= b for a, b in zip(self.start_lines, self.start_lines[1:])
+        )
+
+    def _add(self, block: CodeBlock, path: Optional[Tuple[str, ...]]):
+        position = len(self.blocks)
+        self.blocks.append(block)
+        self.subtree_end.append(position + 1)
+        self.start_lines.append(block.start_line)
+        self.positions[id(block)] = position
+
+        if block.belongs_to_span:
+            self.span_positions[block.belongs_to_span.span_id].append(position)
+
+        if path is not None:
+            self.paths[id(block)] = path
+            self.block_by_path[path] = block
+
+        seen_identifiers = set()
+        for child in block.children:
+            child_path = None
+            if (
+                path is not None
+                and child.identifier is not None
+                and child.identifier not in seen_identifiers
+            ):
+                seen_identifiers.add(child.identifier)
+                child_path = path + (child.identifier,)
+
+            self._add(child, child_path)
+
+        self.subtree_end[position] = len(self.blocks)
+
+    def position(self, block: CodeBlock) -> Optional[int]:
+        position = self.positions.get(id(block))
+        if position is None or self.blocks[position] is not block:
+            return None
+        return position
+
+    def span_range(self, span_id: str, start: int, end: int) -> List[int]:
+        """
+        Positions of blocks in span_id between start and end
+        """
+        positions = self.span_positions.get(span_id, [])
+        return positions[bisect_left(positions, start) : bisect_left(positions, end)]
+
+    def blocks_in_lines(
+        self, position: int, start_line: int, end_line: int
+    ) -> Dict[int, List[CodeBlock]]:
+        """
+        Children by parent id of the blocks below position that overlap the lines
+        """
+        end = self.subtree_end[position]
+        first = bisect_left(self.start_lines, start_line, position + 1, end)
+        last = bisect_right(self.start_lines, end_line, position + 1, end)
+
+        # Blocks starting before the lines only overlap if they cover start_line,
+        # which is only the case for the last of them and its parents
+        overlapping = []
+        if first - 1 > position:
+            block = self.blocks[first - 1]
+            while block is not self.blocks[position]:
+                if block.end_line >= start_line:
+                    overlapping.append(block)
+                block = block.parent
+            overlapping.reverse()
+
+        overlapping.extend(self.blocks[first:last])
+
+        children = defaultdict(list)
+        for block in overlapping:
+            children[id(block.parent)].append(block)
+        return children
+
 
 class Module(CodeBlock):
     model_config = ConfigDict(arbitrary_types_allowed=True)
@@ -19,14 +126,99 @@ class Module(CodeBlock):
     content: str = None
     spans_by_id: Dict[str, BlockSpan] = {}
     language: Optional[str] = None
-    parent: Optional[CodeBlock] = None
+    parent: Optional[CodeBlock] = Field(default=None, exclude=True)
 
     _graph: DiGraph = None  # TODO: Move to central CodeGraph
+    _block_index: Optional[BlockIndex] = None
+    _index_stale: bool = False
+    _span_adjacency: Optional[Dict[str, Dict[str, float]]] = None
 
     def __init__(self, **data):
         data.setdefault("type", CodeBlockType.MODULE)
         super().__init__(**data)
 
+    def build_index(self):
+        self._block_index = BlockIndex(self)
+        self._index_stale = False
+
+    def get_block_index(self) -> Optional[BlockIndex]:
+        # Only rebuilt if it was built before, so blocks appended while parsing are
+        # looked up by walking the tree
+        if self._index_stale:
+            self.build_index()
+        return self._block_index
+
+    def invalidate_index(self):
+        self._span_adjacency = None
+        if self._block_index is not None:
+            self._block_index = None
+            self._index_stale = True
+
+    def get_span_adjacency(self) -> Dict[str, Dict[str, float]]:
+        """
+        Returns the related spans of each span with the strength of the relationship,
+        built once from the references in the module graph and the class structure
+        """
+        if self._span_adjacency is None:
+            self._span_adjacency = self._build_span_adjacency()
+        return self._span_adjacency
+
+    def _build_span_adjacency(self) -> Dict[str, Dict[str, float]]:
+        adjacency = defaultdict(dict)
+
+        def relate(span_id: str, related_span_id: str, weight: float):
+            if span_id != related_span_id:
+                related = adjacency[span_id]
+                related[related_span_id] = max(related.get(related_span_id, 0), weight)
+
+        for block in self.get_all_child_blocks():
+            if not block.belongs_to_span:
+                continue
+
+            span_id = block.belongs_to_span.span_id
+            path_string = block.path_string()
+            if self._graph is not None and path_string in self._graph:
+                for succ in self._graph.successors(path_string):
+                    related_block = self._graph.nodes[succ].get("block")
+                    if related_block and related_block.belongs_to_span:
+                        relate(
+                            span_id,
+                            related_block.belongs_to_span.span_id,
+                            OUTGOING_REFERENCE_WEIGHT,
+                        )
+
+                for pred in self._graph.predecessors(path_string):
+                    related_block = self._graph.nodes[pred].get("block")
+                    if related_block and related_block.belongs_to_span:
+                        relate(
+                            span_id,
+                            related_block.belongs_to_span.span_id,
+                            INCOMING_REFERENCE_WEIGHT,
+                        )
+
+            # Always add parent class initation span
+            if block.parent and block.parent.type == CodeBlockType.CLASS:
+                for class_child in block.parent.children:
+                    if (
+                        class_child.belongs_to_span
+                        and class_child.belongs_to_span.span_type == SpanType.INITATION
+                    ):
+                        relate(
+                            span_id,
+                            class_child.belongs_to_span.span_id,
+                            CLASS_INITIATION_WEIGHT,
+                        )
+
+        return adjacency
+
+    def _module_initiation_span_ids(self) -> List[str]:
+        return [
+            span.span_id
+            for span in self.spans_by_id.values()
+            if span.block_type == CodeBlockType.MODULE
+            and span.span_type == SpanType.INITATION
+        ]
+
     def find_span_by_id(self, span_id: str) -> Optional[BlockSpan]:
         return self.spans_by_id.get(span_id)
 
@@ -48,95 +240,89 @@ class Module(CodeBlock):
         show_related: bool = False,
         max_tokens: int = 2000,
     ) -> bool:
-
+        """
+        Makes the given spans visible. With show_related, related spans are added
+        strongest relationship first, then by distance from the given spans, as long
+        as they fit in max_tokens. Spans that don't fit are skipped.
+        """
         for span in self.spans_by_id.values():
             span.visible = False
 
-        checked_span_ids = set()
-        span_ids_to_check = []
+        visited_span_ids = set()
 
         tokens = 0
-        for span_id in span_ids:
+        for span_id in span_ids or []:
             span = self.spans_by_id.get(span_id)
             if not span:
                 return False
 
             tokens += span.tokens
-            checked_span_ids.add(span_id)
-            span_ids_to_check.append(span_id)
+            visited_span_ids.add(span_id)
             span.visible = True
 
         if not show_related:
             return True
 
+        adjacency = self.get_span_adjacency()
+
+        # Entries are (-strength, distance, order, span_id), order keeps it stable
+        queue = []
+        order = 0
+
+        def push_related(span_id: str, strength: float, distance: int):
+            nonlocal order
+            for related_span_id, weight in adjacency.get(span_id, {}).items():
+                if related_span_id not in visited_span_ids:
+                    heapq.heappush(
+                        queue,
+                        (-strength * weight, distance + 1, order, related_span_id),
+                    )
+                    order += 1
+
         # Add imports from module
-        for span in self.spans.values():
-            if (
-                span.span_type == SpanType.INITATION
-                and span.span_id not in checked_span_ids
-            ):
-                span_ids_to_check.append(span.span_id)
+        for span_id in self._module_initiation_span_ids():
+            if span_id not in visited_span_ids:
+                heapq.heappush(queue, (-MODULE_INITIATION_WEIGHT, 1, order, span_id))
+                order += 1
 
-        while span_ids_to_check:
-            span_id = span_ids_to_check.pop(0)
-            related_spans = self.find_related_spans(span_id)
+        for span_id in visited_span_ids.copy():
+            push_related(span_id, 1.0, 0)
 
-            print(f"Related spans: {len(related_spans)} for {span_id}")
+        skipped = 0
+        while queue and tokens < max_tokens:
+            negative_strength, distance, _, span_id = heapq.heappop(queue)
+            if span_id in visited_span_ids:
+                continue
 
-            # TODO: Go through priotiized related spans to make sure that the most relevant are added first
-            # TODO: Verify span token size
-            for span in related_spans:
-                if span.tokens + tokens > max_tokens:
-                    print(
-                        f"Max tokens reached: {span.tokens} + {tokens} > {max_tokens}"
-                    )
-                    return True
+            visited_span_ids.add(span_id)
+            span = self.spans_by_id.get(span_id)
+            if not span:
+                continue
 
-                span.visible = True
-                tokens += span.tokens
+            if span.tokens + tokens > max_tokens:
+                skipped += 1
+                continue
+
+            span.visible = True
+            tokens += span.tokens
+            logger.debug(
+                f"Show related span {span_id} (strength={-negative_strength:.2f}, "
+                f"distance={distance}, tokens={span.tokens}, total={tokens})"
+            )
 
-                if span.span_id not in checked_span_ids:
-                    checked_span_ids.add(span.span_id)
-                    span_ids_to_check.append(span.span_id)
+            push_related(span_id, -negative_strength, distance)
 
-        print(f"Max tokens reached {tokens} < {max_tokens}")
+        logger.debug(
+            f"Showing {tokens}/{max_tokens} tokens in {self.file_path}, "
+            f"skipped {skipped} related spans over budget"
+        )
 
         return True
 
     def find_related_span_ids(self, span_id: Optional[str] = None) -> Set[str]:
-        related_span_ids = set()
-
-        blocks = self.find_blocks_by_span_id(span_id)
-        for block in blocks:
-            # Find successors (outgoing relationships)
-            successors = list(self._graph.successors(block.path_string()))
-            for succ in successors:
-                node_data = self._graph.nodes[succ]
-                if "block" in node_data:
-                    span = node_data["block"].belongs_to_span
-                    related_span_ids.add(span.span_id)
-
-            # Find predecessors (incoming relationships)
-            predecessors = list(self._graph.predecessors(block.path_string()))
-            for pred in predecessors:
-                node_data = self._graph.nodes[pred]
-                if "block" in node_data:
-                    span = node_data["block"].belongs_to_span
-                    related_span_ids.add(span.span_id)
-
-            # Always add parent class initation span
-            if block.parent and block.parent.type == CodeBlockType.CLASS:
-                related_span_ids.add(block.belongs_to_span.span_id)
-                for class_child in block.parent.children:
-                    if class_child.belongs_to_span.span_type == SpanType.INITATION:
-                        related_span_ids.add(class_child.belongs_to_span.span_id)
+        related_span_ids = set(self.get_span_adjacency().get(span_id, {}))
 
         # Always add module initation span
-        for span in self.spans_by_id.values():
-            if (
-                span.block_type == CodeBlockType.MODULE
-                and span.span_type == SpanType.INITATION
-            ):
-                related_span_ids.add(span.span_id)
+        related_span_ids.update(self._module_initiation_span_ids())
 
         return related_span_ids
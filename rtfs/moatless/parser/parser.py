@@ -2,7 +2,7 @@ import logging
 import re
 from dataclasses import dataclass, field
 from importlib import resources
-from typing import List, Tuple, Optional, Callable
+from typing import Dict, List, Set, Tuple, Optional, Callable
 
 import networkx as nx
 from llama_index.core import get_tokenizer
@@ -41,6 +41,26 @@ class NodeMatch:
     query: str = None
 
 
+@dataclass
+class IdentifierCounter:
+    """
+    Tracks the identifiers of the children of a block per block type, so unique
+    identifiers can be assigned without scanning all siblings
+    """
+
+    counts: Dict[CodeBlockType, int] = field(default_factory=dict)
+    identifiers: Dict[CodeBlockType, Set[str]] = field(default_factory=dict)
+
+    def add(self, block: CodeBlock):
+        self.counts[block.type] = self.counts.get(block.type, 0) + 1
+        self.identifiers.setdefault(block.type, set()).add(block.identifier)
+
+    def unique_identifier(self, block: CodeBlock, identifier: str) -> str:
+        if identifier in self.identifiers.get(block.type, ()):
+            return f"{block.identifier}_{self.counts[block.type]}"
+        return identifier
+
+
 def _find_type(node: Node, type: str):
     for i, child in enumerate(node.children):
         if child.type == type:
@@ -98,6 +118,7 @@ class CodeParser:
         self.spans_by_id = {}
         self.comments_with_no_span = []
         self._span_counter = {}
+        self._path_strings = {}
         self._previous_block = None
 
         # TODO: Move this to CodeGraph
@@ -147,6 +168,7 @@ class CodeParser:
         file_path: Optional[str] = None,
         parent_block: Optional[CodeBlock] = None,
         current_span: Optional[BlockSpan] = None,
+        sibling_identifiers: Optional[IdentifierCounter] = None,
     ) -> Tuple[CodeBlock, Node, BlockSpan]:
         if node.type == "ERROR" or any(
             child.type == "ERROR" for child in node.children
@@ -179,7 +201,7 @@ class CodeParser:
         parameters = self.create_parameters(content_bytes, node_match, relationships)
 
         if parent_block:
-            code_block = CodeBlock(
+            code_block = CodeBlock.construct_block(
                 type=node_match.block_type,
                 identifier=identifier,
                 parent=parent_block,
@@ -215,16 +237,16 @@ class CodeParser:
                     identifier = code_block.type.value.lower()
 
             # Set a unique identifier on each code block
-            # TODO: Just count occurrences of the identifier
-            existing_identifiers = [
-                b.identifier for b in parent_block.children if b.type == code_block.type
-            ]
-            if identifier in existing_identifiers:
-                code_block.identifier = (
-                    f"{code_block.identifier}_{len(existing_identifiers)}"
+            code_block.identifier = sibling_identifiers.unique_identifier(
+                code_block, identifier
+            )
+
+            path_string = ".".join(
+                filter(
+                    None, [self._path_strings[id(parent_block)], code_block.identifier]
                 )
-            else:
-                code_block.identifier = identifier
+            )
+            self._path_strings[id(code_block)] = path_string
 
             if (
                 code_block.type == CodeBlockType.COMMENT
@@ -258,16 +280,14 @@ class CodeParser:
 
                 self.comments_with_no_span = []
 
-            self._graph.add_node(code_block.path_string(), block=code_block)
+            self._graph.add_node(path_string, block=code_block)
 
             for relationship in relationships:
-                self._graph.add_edge(
-                    code_block.path_string(), ".".join(relationship.path)
-                )
+                self._graph.add_edge(path_string, ".".join(relationship.path))
 
         else:
             current_span = None
-            code_block = Module(
+            code_block = Module.construct_block(
                 type=CodeBlockType.MODULE,
                 identifier=None,
                 file_path=file_path,
@@ -283,6 +303,7 @@ class CodeParser:
                 },
             )
             self._previous_block = code_block
+            self._path_strings[id(code_block)] = ""
 
         next_node = node_match.first_child
 
@@ -300,6 +321,7 @@ class CodeParser:
         )
 
         index = 0
+        child_identifiers = IdentifierCounter()
 
         while next_node:
             if (
@@ -318,12 +340,14 @@ class CodeParser:
                 level=level + 1,
                 parent_block=code_block,
                 current_span=current_span,
+                sibling_identifiers=child_identifiers,
             )
 
             if not current_span or child_span.span_id != current_span.span_id:
                 current_span = child_span
 
             code_block.append_child(child_block)
+            child_identifiers.add(child_block)
 
             index += 1
 
@@ -370,7 +394,7 @@ class CodeParser:
 
         # TODO: Find a way to remove the Space end block
         if level == 0 and not node.parent and node.end_byte > end_byte:
-            space_block = CodeBlock(
+            space_block = CodeBlock.construct_block(
                 type=CodeBlockType.SPACE,
                 identifier=None,
                 pre_code=content_bytes[end_byte : node.end_byte].decode(self.encoding),
@@ -680,6 +704,7 @@ class CodeParser:
         # TODO: make thread safe?
         self.spans_by_id = {}
         self._span_counter = {}
+        self._path_strings = {}
 
         # TODO: Should me moved to a central CodeGraph
         self._graph = nx.DiGraph()
@@ -692,6 +717,7 @@ class CodeParser:
         module.file_path = file_path
         module.language = self.language
         module._graph = self._graph
+        module.build_index()
         return module
 
     def get_content(self, node: Node, content_bytes: bytes) -> str:
@@ -837,7 +863,10 @@ class CodeParser:
                 CodeBlockTypeGroup.STRUCTURE
             )
 
-        span_id = structure_block.path_string()
+        span_id = self._path_strings.get(id(structure_block))
+        if span_id is None:
+            span_id = structure_block.path_string()
+
         if label and span_id:
             span_id += f":{label}"
         elif label and not span_id:
@@ -1,6 +1,7 @@
 import os
 import json
 from enum import Enum
+from typing import Optional
 
 from pydantic import BaseModel, Field
 
@@ -17,6 +18,15 @@ class CommentStrategy(Enum):
     EXCLUDE = "exclude"
 
 
+class MergeStrategy(Enum):
+
+    # Merge small chunks into their neighbours until a fixpoint is reached
+    LEGACY = "legacy"
+
+    # Merge in a single pass, then merge the smallest adjacent pairs until max_chunks is met
+    GREEDY = "greedy"
+
+
 class IndexSettings(BaseModel):
     embed_model: str = Field(
         default="text-embedding-3-small", description="The embedding model to use."
@@ -36,10 +46,19 @@ class IndexSettings(BaseModel):
         default=CommentStrategy.ASSOCIATE,
         description="Strategy on how comments will be indexed.",
     )
+    merge_strategy: MergeStrategy = Field(
+        default=MergeStrategy.LEGACY,
+        description="Strategy used to merge undersized chunks.",
+    )
+    chunk_cache_dir: Optional[str] = Field(
+        default=None,
+        description="Directory to cache parsed chunks in, keyed by file content.",
+    )
 
     def to_serializable_dict(self):
         data = self.dict()
         data["comment_strategy"] = data["comment_strategy"].value
+        data["merge_strategy"] = data["merge_strategy"].value
         return data
 
     def persist(self, persist_dir: str):
@@ -3,9 +3,8 @@ import asyncio
 import os
 import yaml
 
-from anthropic import Anthropic, RateLimitError
 from dataclasses import dataclass, fields
-from openai import BadRequestError, OpenAI, AzureOpenAI
+from openai import BadRequestError
 from simple_parsing.helpers import FrozenSerializable, Serializable
 from tenacity import (
     retry,
@@ -18,7 +17,15 @@ import yaml
 
 # from typing import Optional
 
-from openai import AsyncOpenAI
+from rtfs.config import LLM_BACKEND
+from rtfs.exceptions import CostLimitExceededError
+from rtfs.llm_governor import estimate_tokens, llm_governor
+from rtfs.rate_limit import RateLimiter
+from rtfs.llm_client import (
+    get_anthropic_client,
+    get_async_openai_client,
+    get_openai_client,
+)
 
 logger = logging.getLogger("test_results")
 
@@ -70,10 +77,6 @@ class ContextWindowExceededError(Exception):
     pass
 
 
-class CostLimitExceededError(Exception):
-    pass
-
-
 def num_tokens_from_string(string: str, encoding_name: str = "cl100k_base") -> int:
     """Returns the number of tokens in a text string."""
     encoding = tiktoken.get_encoding(encoding_name)
@@ -85,8 +88,14 @@ class BaseModel:
     MODELS = {}
     SHORTCUTS = {}
 
-    def __init__(self, args: ModelArguments = None):
+    # Provider limits, shared by all instances of a model. Models can override them
+    # with requests_per_minute and tokens_per_minute in MODELS
+    REQUESTS_PER_MINUTE = None
+    TOKENS_PER_MINUTE = None
+
+    def __init__(self, args: ModelArguments = None, user: str = None):
         self.args = args
+        self.user = user
         self.model_metadata = {}
         self.stats = APIStats()
 
@@ -109,6 +118,47 @@ class BaseModel:
                 f"Unregistered model ({args.model_name}). Add model name to MODELS metadata to {self.__class__}"
             )
 
+    @property
+    def limiter(self) -> RateLimiter:
+        return llm_governor.limiter(
+            self.api_model,
+            self.model_metadata.get("requests_per_minute", self.REQUESTS_PER_MINUTE),
+            self.model_metadata.get("tokens_per_minute", self.TOKENS_PER_MINUTE),
+        )
+
+    def acquire(self, prompt: str):
+        """
+        Checks the cost limits and waits until prompt fits in the rate limits
+        """
+        self.check_cost_limits()
+        llm_governor.acquire(self.limiter, estimate_tokens(prompt), self.user)
+
+    async def acquire_async(self, prompt: str):
+        self.check_cost_limits()
+        await llm_governor.acquire_async(
+            self.limiter, estimate_tokens(prompt), self.user
+        )
+
+    def check_cost_limits(self):
+        # Check whether total cost or instance cost limits have been exceeded
+        if (
+            self.args.total_cost_limit > 0
+            and self.stats.total_cost >= self.args.total_cost_limit
+        ):
+            logger.warning(
+                f"Cost {self.stats.total_cost:.2f} exceeds limit {self.args.total_cost_limit:.2f}"
+            )
+            raise CostLimitExceededError("Total cost limit exceeded")
+
+        if (
+            self.args.per_instance_cost_limit > 0
+            and self.stats.instance_cost >= self.args.per_instance_cost_limit
+        ):
+            logger.warning(
+                f"Cost {self.stats.instance_cost:.2f} exceeds limit {self.args.per_instance_cost_limit:.2f}"
+            )
+            raise CostLimitExceededError("Instance cost limit exceeded")
+
     def reset_stats(self, other: APIStats = None):
         if other is None:
             self.stats = APIStats(total_cost=self.stats.total_cost)
@@ -145,6 +195,7 @@ class BaseModel:
         self.stats.tokens_sent += input_tokens
         self.stats.tokens_received += output_tokens
         self.stats.api_calls += 1
+        llm_governor.record(cost, self.user)
 
         # Log updated cost values to std. out.
         # logger.info(
@@ -159,25 +210,6 @@ class BaseModel:
         #     f"total_cost={self.stats.total_cost:.2f}, "
         #     f"total_api_calls={self.stats.api_calls:_}"
         # )
-
-        # Check whether total cost or instance cost limits have been exceeded
-        # if (
-        #     self.args.total_cost_limit > 0
-        #     and self.stats.total_cost >= self.args.total_cost_limit
-        # ):
-        #     logger.warning(
-        #         f"Cost {self.stats.total_cost:.2f} exceeds limit {self.args.total_cost_limit:.2f}"
-        #     )
-        #     raise CostLimitExceededError("Total cost limit exceeded")
-
-        # if (
-        #     self.args.per_instance_cost_limit > 0
-        #     and self.stats.instance_cost >= self.args.per_instance_cost_limit
-        # ):
-        #     logger.warning(
-        #         f"Cost {self.stats.instance_cost:.2f} exceeds limit {self.args.per_instance_cost_limit:.2f}"
-        #     )
-        #     raise CostLimitExceededError("Instance cost limit exceeded")
         return cost
 
     async def query(self, prompt: str) -> str:
@@ -235,22 +267,27 @@ class AnthropicModel(BaseModel):
         "claude-sonnet-3.5": "claude-3-5-sonnet-20240620",
     }
 
-    def __init__(self, args: ModelArguments = None):
+    REQUESTS_PER_MINUTE = 50
+    TOKENS_PER_MINUTE = 40_000
+
+    def __init__(self, args: ModelArguments = None, user: str = None):
         if not args:
             # Set Anthropic key
             args = ModelArguments(
                 model_name="claude-sonnet-3.5", api_key=os.getenv("ANTHROPIC_API_KEY")
             )
 
-        super().__init__(args)
+        super().__init__(args, user)
 
-        self.api = Anthropic(api_key=self.args.api_key)
+    @property
+    def api(self):
+        return get_anthropic_client(self.args.api_key)
 
     @retry(
         wait=wait_random_exponential(min=1, max=15),
         reraise=True,
         stop=stop_after_attempt(15),
-        retry=retry_if_not_exception_type((RateLimitError,)),
+        retry=retry_if_not_exception_type((CostLimitExceededError,)),
     )
     def query(self, prompt: str) -> str:
         """
@@ -267,6 +304,7 @@ def anthropic_query(model: AnthropicModel, message) -> str:
     Query the Anthropic API with the given `history` and return the response.
     """
 
+    model.acquire(message)
     message = {"role": "user", "content": message}
 
     # Perform Anthropic API call
@@ -326,6 +364,11 @@ class OpenAIModel(BaseModel):
             "cost_per_input_token": 1e-06,
             "cost_per_output_token": 2e-06,
         },
+        "gpt-4o-2024-08-06": {
+            "max_context": 128_000,
+            "cost_per_input_token": 2.5e-06,
+            "cost_per_output_token": 1e-05,
+        },
         # TODO: correct this
         "deepseek-chat": {
             "max_context": 128_000,
@@ -346,10 +389,13 @@ class OpenAIModel(BaseModel):
         "deepseek-chat": "deepseek-chat",
     }
 
-    def __init__(self, args: ModelArguments = None):
+    REQUESTS_PER_MINUTE = 500
+    TOKENS_PER_MINUTE = 800_000
+
+    def __init__(self, args: ModelArguments = None, user: str = None):
         if not args:
             api_key = os.getenv("OPENAI_API_KEY")
-            if not api_key:
+            if not api_key and LLM_BACKEND != "fake":
                 raise ValueError("env OPENAI_API_KEY not set")
 
             args = ModelArguments(
@@ -357,19 +403,25 @@ class OpenAIModel(BaseModel):
                 api_key=os.getenv("OPENAI_API_KEY"),
             )
 
-        super().__init__(args)
-
-        self.async_client = AsyncOpenAI(api_key=args.api_key)
-        self.client = OpenAI(api_key=args.api_key)
+        super().__init__(args, user)
 
+        self.base_url = None
         # deepseek specific settings
         if args.model_name == "deepseek-chat":
-            print(args.api_key)
             print("Setting deepseek specific settings .....")
-            self.client.base_url = "https://api.deepseek.com"
+            self.base_url = "https://api.deepseek.com"
             # https://platform.deepseek.com/api-docs/#the-temperature-parameter
             self.args.temperature = 0.0
 
+    # Clients are shared across models and only created on first request
+    @property
+    def client(self):
+        return get_openai_client(self.args.api_key, self.base_url)
+
+    @property
+    def async_client(self):
+        return get_async_openai_client(self.args.api_key, self.base_url)
+
     def history_to_messages(
         self, history: list[dict[str, str]], is_demonstration: bool = False
     ) -> list[dict[str, str]]:
@@ -405,6 +457,7 @@ class OpenAIModel(BaseModel):
         Query the OpenAI API with the given `history` and return the response.
         """
 
+        self.acquire(prompt)
         try:
             # Perform OpenAI API call
             response = self.client.chat.completions.create(
@@ -432,6 +485,7 @@ class OpenAIModel(BaseModel):
         Query the OpenAI API with the given `history` and return the response.
         """
 
+        await self.acquire_async(prompt)
         try:
             # Perform OpenAI API call
             response = await self.async_client.chat.completions.create(
@@ -0,0 +1,132 @@
+import asyncio
+import threading
+import time
+from typing import Dict, Optional
+
+
+class RateLimiter:
+    """
+    Token bucket limiter for requests and tokens per minute, shared between threads.
+    Both buckets start full and refill continuously. A request larger than the
+    whole token bucket is let through once the bucket is full, so it can't block
+    forever
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: Optional[int] = None,
+        tokens_per_minute: Optional[int] = None,
+    ):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+
+        self._requests = float(requests_per_minute or 0)
+        self._tokens = float(tokens_per_minute or 0)
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+        # Metrics
+        self.requests = 0
+        self.tokens = 0
+        self.waiting = 0
+        self.wait_time = 0.0
+
+    def acquire(self, tokens: int = 0):
+        """
+        Blocks until a request with the given number of tokens fits in the limits
+        """
+        start = time.monotonic()
+        with self._lock:
+            wait = self._try_acquire(tokens)
+        if wait <= 0:
+            return
+
+        self._add_waiting(1)
+        try:
+            while wait > 0:
+                time.sleep(wait)
+                with self._lock:
+                    wait = self._try_acquire(tokens)
+        finally:
+            self._add_waiting(-1, time.monotonic() - start)
+
+    async def acquire_async(self, tokens: int = 0):
+        """
+        Like acquire, but waits without blocking the event loop
+        """
+        start = time.monotonic()
+        with self._lock:
+            wait = self._try_acquire(tokens)
+        if wait <= 0:
+            return
+
+        self._add_waiting(1)
+        try:
+            while wait > 0:
+                await asyncio.sleep(wait)
+                with self._lock:
+                    wait = self._try_acquire(tokens)
+        finally:
+            self._add_waiting(-1, time.monotonic() - start)
+
+    def metrics(self) -> Dict:
+        with self._lock:
+            self._refill()
+            return {
+                "requests_per_minute": self.requests_per_minute,
+                "tokens_per_minute": self.tokens_per_minute,
+                "available_requests": self._requests,
+                "available_tokens": self._tokens,
+                "requests": self.requests,
+                "tokens": self.tokens,
+                "waiting": self.waiting,
+                "wait_time": self.wait_time,
+            }
+
+    def _add_waiting(self, count: int, wait_time: float = 0.0):
+        with self._lock:
+            self.waiting += count
+            self.wait_time += wait_time
+
+    def _try_acquire(self, tokens: int) -> float:
+        """
+        Takes the request from the buckets and returns 0, or returns how long to wait
+        before trying again
+        """
+        self._refill()
+
+        wait = 0.0
+        if self.requests_per_minute and self._requests < 1:
+            wait = (1 - self._requests) * 60 / self.requests_per_minute
+
+        if self.tokens_per_minute:
+            needed = min(tokens, self.tokens_per_minute)
+            if self._tokens < needed:
+                wait = max(wait, (needed - self._tokens) * 60 / self.tokens_per_minute)
+
+        if wait > 0:
+            return wait
+
+        if self.requests_per_minute:
+            self._requests -= 1
+        if self.tokens_per_minute:
+            self._tokens -= min(tokens, self.tokens_per_minute)
+        self.requests += 1
+        self.tokens += tokens
+        return 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._last_refill
+        self._last_refill = now
+
+        if self.requests_per_minute:
+            self._requests = min(
+                self.requests_per_minute,
+                self._requests + elapsed * self.requests_per_minute / 60,
+            )
+        if self.tokens_per_minute:
+            self._tokens = min(
+                self.tokens_per_minute,
+                self._tokens + elapsed * self.tokens_per_minute / 60,
+            )
@@ -0,0 +1,50 @@
+import json
+import logging
+import os
+from hashlib import sha256
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Bump when the summarize prompt or model changes so stale summaries are not served
+SUMMARY_CACHE_VERSION = "1"
+
+
+def content_hash(child_content: str) -> str:
+    """
+    Hash of the content a cluster is summarized from, which includes the summaries
+    of its child clusters
+    """
+    identity = f"{SUMMARY_CACHE_VERSION}:{child_content}"
+    return sha256(identity.encode("utf-8", "surrogatepass")).hexdigest()
+
+
+class SummaryCache:
+    """
+    On-disk cache of cluster summaries keyed by content_hash, so clusters whose
+    content didn't change are not summarized again, across graphs and runs
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get(self, key: str) -> Optional[Dict]:
+        try:
+            with open(self._path(key), "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Failed to read summary cache entry {key}: {e}")
+            return None
+
+    def put(self, key: str, summary: Dict):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(summary, f)
+        os.replace(tmp_path, path)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
@@ -1,8 +1,15 @@
 import ell
-from typing import List
+import functools
+from dataclasses import dataclass
+from typing import List, Optional, Type
 from pydantic import BaseModel
 import tiktoken
+from rtfs.config import LLM_CACHE_PATH, LLM_CACHE_MAX_BYTES
 from rtfs.exceptions import ContextLengthExceeded
+from rtfs.llm_cache import LLMCache
+from rtfs.llm_governor import llm_governor
+from rtfs.models import OpenAIModel
+from rtfs.rate_limit import RateLimiter
 
 
 def num_tokens_from_string(string: str, encoding_name: str = "cl100k_base") -> int:
@@ -12,11 +19,75 @@ def num_tokens_from_string(string: str, encoding_name: str = "cl100k_base") -> i
     return num_tokens
 
 
+def trim_to_tokens(
+    string: str, max_tokens: int, encoding_name: str = "cl100k_base"
+) -> str:
+    """Returns the first max_tokens tokens of a text string."""
+    encoding = tiktoken.get_encoding(encoding_name)
+    return encoding.decode(encoding.encode(string)[:max_tokens])
+
+
 ell.init(
     store="logdir",
     autocommit=True,
 )
 
+SUMMARY_MODEL = "gpt-4o-2024-08-06"
+
+llm_cache = LLMCache(LLM_CACHE_PATH, LLM_CACHE_MAX_BYTES)
+
+
+@dataclass
+class CachedResponse:
+    parsed: BaseModel
+
+
+def cached_lmp(model: str, response_format: Type[BaseModel]):
+    """
+    Like ell.complex, but responses are served from llm_cache when the same prompt
+    was sent to the same model with the same response format before. Only calls
+    that miss the cache wait on the limiter, and their cost is recorded for user.
+    ell doesn't return the usage of a call, so the cost is estimated from the
+    tokens of the prompt and the response
+    """
+    costs = OpenAIModel.MODELS[model]
+
+    def decorator(prompt_fn):
+        lmp = ell.complex(model=model, response_format=response_format)(prompt_fn)
+
+        @functools.wraps(prompt_fn)
+        def wrapper(
+            *args,
+            limiter: Optional[RateLimiter] = None,
+            user: Optional[str] = None,
+            **kwargs,
+        ):
+            prompt = prompt_fn(*args, **kwargs)
+            key = llm_cache.key(model, prompt, response_format)
+            cached = llm_cache.get(key)
+            if cached is not None:
+                return CachedResponse(
+                    parsed=response_format.model_validate_json(cached)
+                )
+
+            input_tokens = num_tokens_from_string(prompt)
+            llm_governor.acquire(limiter or RateLimiter(), input_tokens, user)
+            response = lmp(*args, **kwargs)
+
+            response_json = response.parsed.model_dump_json()
+            llm_governor.record(
+                costs["cost_per_input_token"] * input_tokens
+                + costs["cost_per_output_token"]
+                * num_tokens_from_string(response_json),
+                user,
+            )
+            llm_cache.put(key, model, response_json)
+            return response
+
+        return wrapper
+
+    return decorator
+
 
 class CodeSummary(BaseModel):
     title: str
@@ -24,7 +95,7 @@ class CodeSummary(BaseModel):
     key_variables: str
 
 
-@ell.complex(model="gpt-4o-2024-08-06", response_format=CodeSummary)
+@cached_lmp(model=SUMMARY_MODEL, response_format=CodeSummary)
 def summarize(child_content) -> CodeSummary:
     SUMMARY_PROMPT = """
 The following chunks of code are grouped into the same feature.
@@ -65,7 +136,7 @@ class ClusterList(BaseModel):
         )
 
 
-@ell.complex(model="gpt-4o-2024-08-06", response_format=ClusterList)
+@cached_lmp(model=SUMMARY_MODEL, response_format=ClusterList)
 def categorize_clusters(clusters) -> ClusterList:
     REORGANIZE_CLUSTERS = """
 You are given a following a set of ungrouped clusters that encapsulate different features in the codebase. Take these clusters
@@ -96,7 +167,7 @@ Here are the ungrouped clusters:
         raise e
 
 
-@ell.complex(model="gpt-4o-2024-08-06", response_format=ClusterList)
+@cached_lmp(model=SUMMARY_MODEL, response_format=ClusterList)
 def categorize_missing(clusters, categories) -> ClusterList:
     categories = f"\n".join(
         [f"{i}. {category}" for i, category in enumerate(categories, 1)]
@@ -123,8 +194,6 @@ Remember, if:
         clusters=clusters,
     )
 
-    print(REORGANIZE_CLUSTERS)
-
     try:
         if num_tokens_from_string(REORGANIZE_CLUSTERS) > 128_000:
             raise ContextLengthExceeded()
@@ -1,26 +1,80 @@
+import logging
 import yaml
-from typing import Dict, List
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import cached_property
+from typing import Dict, List, Optional
 import random
 import os
 
+import networkx as nx
+from tenacity import (
+    retry,
+    stop_after_attempt,
+    wait_random_exponential,
+    retry_if_not_exception_type,
+)
+
 from ..chunk_resolution.graph import (
     ClusterNode,
     NodeKind,
     SummarizedChunk,
     ClusterEdgeKind,
     ClusterEdge,
+    ChunkEdgeKind,
 )
 from .lmp import (
     summarize as summarize_llm,
     categorize_clusters as recategorize_llm,
     categorize_missing,
 )
-from .lmp import ClusterList
+from .lmp import (
+    SUMMARY_MODEL,
+    ClusterList,
+    CodeSummary,
+    num_tokens_from_string,
+    trim_to_tokens,
+)
 
 from rtfs.graph import CodeGraph
+from rtfs.transforms.cluster import get_cluster_metadata
 from rtfs.utils import VerboseSafeDumper
 from rtfs.models import OpenAIModel, extract_yaml
-from rtfs.exceptions import LLMValidationError
+from rtfs.exceptions import (
+    LLMValidationError,
+    ContextLengthExceeded,
+    CostLimitExceededError,
+)
+from rtfs.llm_governor import llm_governor
+from rtfs.rate_limit import RateLimiter
+from .cache import SummaryCache, content_hash
+
+logger = logging.getLogger(__name__)
+
+# Max number of clusters summarized at the same time
+MAX_CONCURRENT_SUMMARIES = 8
+
+# Limits for the summarize requests, shared by all summarizers in the process
+SUMMARY_REQUESTS_PER_MINUTE = 500
+SUMMARY_TOKENS_PER_MINUTE = 800_000
+
+# Attempts per summarize request before summarization fails
+SUMMARY_RETRIES = 4
+
+# Max tokens of content in one summarize prompt. Bigger clusters are summarized in
+# parts, and the summaries of the parts are summarized into the cluster summary
+SUMMARY_TOKEN_BUDGET = 100_000
+
+# Max number of parts a cluster is summarized in. The lowest priority children
+# beyond that are left out
+MAX_SUMMARY_PARTS = 8
+
+# Max tokens of clusters in one categorize prompt. More clusters are categorized in
+# batches and the categories are merged
+CATEGORIZE_TOKEN_BUDGET = 50_000
+
+# Follow-up prompts for clusters left out of the categories before failing
+CATEGORIZE_RETRIES = 2
 
 
 def get_cluster_id():
@@ -28,9 +82,27 @@ def get_cluster_id():
 
 
 class Summarizer:
-    def __init__(self, graph: CodeGraph):
-        self._model = OpenAIModel()
+    def __init__(
+        self,
+        graph: CodeGraph,
+        max_workers: int = MAX_CONCURRENT_SUMMARIES,
+        rate_limiter: Optional[RateLimiter] = None,
+        summary_cache: Optional[SummaryCache] = None,
+        user: Optional[str] = None,
+    ):
         self.code_graph = graph
+        self.max_workers = max_workers
+        # Shared with every other summarizer in the process by default
+        self.rate_limiter = rate_limiter or llm_governor.limiter(
+            SUMMARY_MODEL, SUMMARY_REQUESTS_PER_MINUTE, SUMMARY_TOKENS_PER_MINUTE
+        )
+        self.summary_cache = summary_cache
+        # Spend of the LLM calls counts toward the cost limit of this user
+        self.user = user
+
+    @cached_property
+    def _model(self) -> OpenAIModel:
+        return OpenAIModel()
 
     # TODO: can generalize this to only generating summaries for parent nodes
     # this way we can use generic CodeGraph abstraction
@@ -38,103 +110,321 @@ class Summarizer:
     # we can make use of only the edge information -> tag special parent ch
     # actually... this is pointless?
 
-    # TODO: we can parallelize this
     # TODO: reimplement test_run
     def summarize(self):
-        for cluster_id, child_content in self._iterate_clusters_with_text():
-            summary_data = summarize_llm(child_content).parsed
-
-            print("updating node: ", cluster_id, "with summary: ", summary_data)
-            cluster_node = ClusterNode(id=cluster_id, **summary_data.dict())
-            self.code_graph.update_node(cluster_node)
-
-    def gen_categories(self):
         """
-        Attempts relabel of clusters. If relabel attempt misses any existing clusters, will iteratively
-        retry relabeling until all clusters are accounted for.
+        Summarizes clusters bottom up, concurrently, up to max_workers at a time. A
+        cluster is only summarized once all its child clusters are, since their
+        summaries are part of its content, so the prompts are the same as when
+        summarizing one cluster at a time. Each summary is written to the graph as
+        soon as it arrives.
+
+        Summaries are keyed by the content_hash of their content. Clusters whose
+        content didn't change since their last summary, or that are found in the
+        summary cache, are not summarized again. A changed child summary changes the
+        content of its parent, so only changed clusters and their ancestors are sent
+        to the LLM
         """
+        clusters = self._clusters_bottom_up()
+        parents = defaultdict(list)
+        waiting = {}
+        for cluster_id in clusters:
+            child_clusters = [
+                c
+                for c in self.code_graph.children(cluster_id)
+                if self.code_graph.get_node(c).kind == NodeKind.Cluster
+            ]
+            waiting[cluster_id] = len(child_clusters)
+            for child in child_clusters:
+                parents[child].append(cluster_id)
 
-        def cluster_yaml_str(cluster_nodes):
-            clusters_json = self._clusters_to_json(cluster_nodes)
-            for cluster in clusters_json:
-                cluster.pop("chunks")
-                cluster.pop("key_variables")
-
-            return yaml.dump(
-                clusters_json,
-                Dumper=VerboseSafeDumper,
-                sort_keys=False,
-            ), [cluster["title"] for cluster in clusters_json]
-
-        retries = 3
-        previous_clusters = []
-        cluster_yaml, og_clusters = self._clusters_to_yaml(
-            self.code_graph.filter_nodes({"kind": NodeKind.Cluster})
-        )
-        while retries > 0:
-            try:
-                generated_clusters: ClusterList = (
-                    recategorize_llm(cluster_yaml).parsed
-                    if retries == 3
-                    else categorize_missing(cluster_yaml, previous_clusters).parsed
-                )
-                generated_child_clusters = []
-                for category in generated_clusters.clusters:
-                    # why do I still get empty clusters?
-                    # useless ...
-                    if not category.children:
+        ready = deque(c for c in clusters if not waiting[c])
+        unchanged = cached = 0
+        error = None
+
+        def mark_done(cluster_id):
+            for parent in parents[cluster_id]:
+                waiting[parent] -= 1
+                if not waiting[parent]:
+                    ready.append(parent)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {}
+
+            def submit_ready():
+                nonlocal unchanged, cached
+                while ready:
+                    cluster_id = ready.popleft()
+                    children = self._cluster_children(cluster_id)
+                    child_content = "\n".join(c.get_content() for c in children)
+                    summary_hash = content_hash(child_content)
+
+                    cluster_node = self.code_graph.get_node(cluster_id)
+                    if cluster_node.summary_hash == summary_hash:
+                        unchanged += 1
+                        mark_done(cluster_id)
                         continue
 
-                    cluster_node = self.code_graph.find_node(
-                        {"kind": NodeKind.Cluster, "title": category.category}
+                    summary = (
+                        self.summary_cache.get(summary_hash)
+                        if self.summary_cache
+                        else None
                     )
-                    if not cluster_node:
-                        cluster_node = ClusterNode(
-                            id=get_cluster_id(),
-                            title=category.category,
-                            kind=NodeKind.Cluster,
-                        )
-                        self.code_graph.add_node(cluster_node)
-
-                    for child in category.children:
-                        # TODO: consider moving this function from chunkGraph to here
-                        child_node = self.code_graph.find_node(
-                            {"kind": NodeKind.Cluster, "title": child}
+                    if summary:
+                        cached += 1
+                        self._update_summary(
+                            cluster_id, CodeSummary(**summary), summary_hash
                         )
-                        if not child_node:
-                            print("Childnode not found: ", child)
-                            continue
-
-                        # TODO: should really be using self.code_graph.add_edge
-                        self.code_graph._graph.add_edge(
-                            child_node.id,
-                            cluster_node.id,
-                            kind=ClusterEdgeKind.ClusterToCluster,
-                        )
-                        generated_child_clusters.append(child_node.id)
+                        mark_done(cluster_id)
+                        continue
 
-                # TODO: if more, we dont really care, can prune
-                if len(og_clusters) > len(generated_child_clusters):
-                    missing = set(og_clusters) - set(generated_child_clusters)
-                    raise LLMValidationError(
-                        f"Missing clusters from generated categories: {list(missing)}"
+                    future = executor.submit(
+                        self._summarize_cluster, self._pack_children(children)
                     )
-                else:
+                    futures[future] = (cluster_id, summary_hash)
+
+            submit_ready()
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    cluster_id, summary_hash = futures.pop(future)
+                    try:
+                        summary_data = future.result()
+                    except Exception as e:
+                        # Let the running clusters finish so their summaries are kept
+                        error = error or e
+                        continue
+
+                    print("updating node: ", cluster_id, "with summary: ", summary_data)
+                    self._update_summary(cluster_id, summary_data, summary_hash)
+                    if self.summary_cache:
+                        self.summary_cache.put(summary_hash, summary_data.dict())
+
+                    if not error:
+                        mark_done(cluster_id)
+                        submit_ready()
+
+        logger.info(
+            f"Summarized {len(clusters)} clusters: {unchanged} unchanged, "
+            f"{cached} from cache"
+        )
+
+        if error:
+            raise error
+
+    def _update_summary(self, cluster_id, summary_data: CodeSummary, summary_hash: str):
+        cluster_node = ClusterNode(
+            id=cluster_id, summary_hash=summary_hash, **summary_data.dict()
+        )
+        self.code_graph.update_node(cluster_node)
+
+    def _summarize_cluster(self, parts: List[str]) -> CodeSummary:
+        """
+        Summarizes each part of a cluster, then the summaries of the parts if
+        there is more than one
+        """
+        summaries = [self._summarize_text(part) for part in parts]
+        if len(summaries) == 1:
+            return summaries[0]
+
+        return self._summarize_text(
+            "\n".join(f"{summary.title}: {summary.summary}" for summary in summaries)
+        )
+
+    @retry(
+        wait=wait_random_exponential(min=1, max=30),
+        reraise=True,
+        stop=stop_after_attempt(SUMMARY_RETRIES),
+        retry=retry_if_not_exception_type(
+            (ContextLengthExceeded, CostLimitExceededError)
+        ),
+    )
+    def _summarize_text(self, child_content: str) -> CodeSummary:
+        return summarize_llm(
+            child_content, limiter=self.rate_limiter, user=self.user
+        ).parsed
+
+    def _pack_children(self, children: List) -> List[str]:
+        """
+        Packs the content of a cluster's children into parts of at most
+        SUMMARY_TOKEN_BUDGET tokens, using the token counts stored on the chunks. A
+        cluster that fits is a single part with all its content. Otherwise child
+        cluster summaries go first, then chunks by how often they are imported or
+        called, and children that don't fit in MAX_SUMMARY_PARTS are left out
+        """
+        tokens = [self._child_tokens(child) for child in children]
+        if sum(tokens) <= SUMMARY_TOKEN_BUDGET:
+            return ["\n".join(child.get_content() for child in children)]
+
+        # sorted is stable, so equal priorities keep the order of the children
+        order = sorted(
+            range(len(children)), key=lambda i: self._child_priority(children[i])
+        )
+
+        parts = [[]]
+        part_tokens = 0
+        for i in order:
+            content = children[i].get_content()
+            if tokens[i] > SUMMARY_TOKEN_BUDGET:
+                content = trim_to_tokens(content, SUMMARY_TOKEN_BUDGET)
+                tokens[i] = SUMMARY_TOKEN_BUDGET
+
+            if parts[-1] and part_tokens + tokens[i] > SUMMARY_TOKEN_BUDGET:
+                if len(parts) == MAX_SUMMARY_PARTS:
                     break
+                parts.append([])
+                part_tokens = 0
+
+            parts[-1].append(content)
+            part_tokens += tokens[i]
+
+        packed = sum(len(part) for part in parts)
+        logger.info(
+            f"Summarizing cluster in {len(parts)} parts, "
+            f"left out {len(children) - packed} of {len(children)} children"
+        )
+        return ["\n".join(part) for part in parts]
+
+    def _child_tokens(self, child) -> int:
+        if child.kind == NodeKind.Chunk:
+            return child.metadata.tokens
+        return num_tokens_from_string(child.get_content())
+
+    def _child_priority(self, child):
+        if child.kind == NodeKind.Cluster:
+            return (0, 0)
+
+        references = sum(
+            1
+            for _, _, kind in self.code_graph._graph.in_edges(child.id, data="kind")
+            if kind in (ChunkEdgeKind.ImportFrom, ChunkEdgeKind.CallTo)
+        )
+        return (1, -references)
+
+    def gen_categories(self):
+        """
+        Groups the clusters into categories. Clusters are sent in batches of at
+        most CATEGORIZE_TOKEN_BUDGET tokens, concurrently, and categories with the
+        same title in different batches are merged. Clusters the LLM left out are
+        assigned with follow-up prompts that only contain the missing clusters and
+        the existing categories, until all clusters are accounted for.
+        """
+        metadata = get_cluster_metadata(self.code_graph)
+        if metadata and metadata.get("hierarchical"):
+            # Clusters already form a tree from hierarchical clustering
+            return
+
+        clusters = self.code_graph.filter_nodes({"kind": NodeKind.Cluster})
+        titles: Dict[str, List[ClusterNode]] = defaultdict(list)
+        for cluster_node in clusters:
+            titles[cluster_node.title].append(cluster_node)
+
+        categories: Dict[str, List[str]] = {}
+
+        def add_categories(generated_clusters: ClusterList):
+            for category in generated_clusters.clusters:
+                # why do I still get empty clusters?
+                if not category.children:
+                    continue
+
+                children = categories.setdefault(category.category, [])
+                for child in category.children:
+                    if child not in titles:
+                        print("Childnode not found: ", child)
+                    elif child not in children:
+                        children.append(child)
+
+        batches = self._category_batches(clusters)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for generated_clusters in executor.map(
+                lambda batch: self._categorize(self._clusters_to_yaml(batch)),
+                batches,
+            ):
+                add_categories(generated_clusters)
+
+        retries = CATEGORIZE_RETRIES
+        while True:
+            assigned = {child for children in categories.values() for child in children}
+            missing = [c for c in clusters if c.title not in assigned]
+            if not missing:
+                break
+
+            if retries == 0:
+                raise Exception(
+                    "Failed to generate categories, missing clusters: "
+                    f"{[c.title for c in missing]}"
+                )
+            retries -= 1
 
-            except LLMValidationError as e:
-                cluster_yaml, og_clusters = cluster_yaml_str(
-                    [self.code_graph.get_node(c) for c in generated_child_clusters]
+            add_categories(
+                self._categorize_missing(
+                    self._clusters_to_yaml(missing), list(categories)
                 )
-                previous_clusters = [
-                    cluster.category for cluster in generated_clusters.clusters
-                ]
-                retries -= 1
-                if retries == 0:
-                    raise Exception("Failed to generate categories")
+            )
+
+        for category, children in categories.items():
+            category_nodes = titles.get(category)
+            if category_nodes:
+                category_node = category_nodes[0]
+            else:
+                category_node = ClusterNode(
+                    id=get_cluster_id(),
+                    title=category,
+                    kind=NodeKind.Cluster,
+                )
+                self.code_graph.add_node(category_node)
+                titles[category].append(category_node)
+
+            for child in children:
+                for child_node in titles[child]:
+                    # TODO: should really be using self.code_graph.add_edge
+                    self.code_graph._graph.add_edge(
+                        child_node.id,
+                        category_node.id,
+                        kind=ClusterEdgeKind.ClusterToCluster,
+                    )
+
+    def _category_batches(self, clusters: List[ClusterNode]) -> List[List[ClusterNode]]:
+        batches = [[]]
+        batch_tokens = 0
+        for cluster_node in clusters:
+            tokens = num_tokens_from_string(self._clusters_to_yaml([cluster_node]))
+            if batches[-1] and batch_tokens + tokens > CATEGORIZE_TOKEN_BUDGET:
+                batches.append([])
+                batch_tokens = 0
 
-            except Exception as e:
-                raise e
+            batches[-1].append(cluster_node)
+            batch_tokens += tokens
+
+        return batches
+
+    @retry(
+        wait=wait_random_exponential(min=1, max=30),
+        reraise=True,
+        stop=stop_after_attempt(SUMMARY_RETRIES),
+        retry=retry_if_not_exception_type(
+            (ContextLengthExceeded, CostLimitExceededError)
+        ),
+    )
+    def _categorize(self, clusters_yaml: str) -> ClusterList:
+        return recategorize_llm(
+            clusters_yaml, limiter=self.rate_limiter, user=self.user
+        ).parsed
+
+    @retry(
+        wait=wait_random_exponential(min=1, max=30),
+        reraise=True,
+        stop=stop_after_attempt(SUMMARY_RETRIES),
+        retry=retry_if_not_exception_type(
+            (ContextLengthExceeded, CostLimitExceededError)
+        ),
+    )
+    def _categorize_missing(
+        self, clusters_yaml: str, categories: List[str]
+    ) -> ClusterList:
+        return categorize_missing(
+            clusters_yaml, categories, limiter=self.rate_limiter, user=self.user
+        ).parsed
 
     def to_json(self):
         cluster_nodes = [
@@ -145,24 +435,36 @@ class Summarizer:
 
         return self._clusters_to_json(cluster_nodes)
 
+    def _clusters_bottom_up(self) -> List:
+        clusters = [
+            node
+            for node, data in self.code_graph._graph.nodes(data=True)
+            if data["kind"] == NodeKind.Cluster
+        ]
+        # ClusterToCluster edges point from child to parent, so children come first
+        # and parents are summarized from their children's summaries
+        return list(nx.topological_sort(self.code_graph._graph.subgraph(clusters)))
+
     def _iterate_clusters_with_text(self):
+        for cluster in self._clusters_bottom_up():
+            yield (cluster, self._cluster_text(cluster))
+
+    def _cluster_text(self, cluster) -> str:
         """
         Concatenates the content of all children of a cluster node
         """
-        for cluster in [
-            node
-            for node, data in self.code_graph._graph.nodes(data=True)
-            if data["kind"] == NodeKind.Cluster
-        ]:
-            child_content = "\n".join(
-                [
-                    self.code_graph.get_node(c).get_content()
-                    for c in self.code_graph.children(cluster)
-                    if self.code_graph.get_node(c).kind
-                    in [NodeKind.Chunk, NodeKind.Cluster]
-                ]
+        return "\n".join(
+            child.get_content() for child in self._cluster_children(cluster)
+        )
+
+    def _cluster_children(self, cluster) -> List:
+        return [
+            child
+            for child in map(
+                self.code_graph.get_node, self.code_graph.children(cluster)
             )
-            yield (cluster, child_content)
+            if child.kind in [NodeKind.Chunk, NodeKind.Cluster]
+        ]
 
     def _clusters_to_json(self, cluster_nodes: List[ClusterNode]):
         def dfs_cluster(cluster_node: ClusterNode):
@@ -196,15 +498,16 @@ class Summarizer:
 
         return [dfs_cluster(node) for node in cluster_nodes]
 
-    def _clusters_to_yaml(self, cluster_nodes: List[ClusterNode]):
-        clusters_json = self._clusters_to_json(cluster_nodes)
-        for cluster in clusters_json:
-            print(cluster["title"])
-            del cluster["chunks"]
-            del cluster["key_variables"]
-
+    def _clusters_to_yaml(self, cluster_nodes: List[ClusterNode]) -> str:
         return yaml.dump(
-            clusters_json,
+            [
+                {
+                    "id": cluster_node.id,
+                    "title": cluster_node.title,
+                    "summary": cluster_node.summary,
+                }
+                for cluster_node in cluster_nodes
+            ],
             Dumper=VerboseSafeDumper,
             sort_keys=False,
-        ), [cluster["id"] for cluster in clusters_json]
+        )
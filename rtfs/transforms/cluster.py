@@ -1,61 +1,338 @@
 from infomap import Infomap
 import networkx as nx
+from collections import OrderedDict, defaultdict
+from hashlib import sha256
 from logging import getLogger
-from typing import List, Tuple, Dict
+from typing import Any, Callable, Dict, Iterable, Optional, Set, Tuple
+import json
 
 from rtfs.chunk_resolution.graph import (
     ClusterNode,
     ClusterEdgeKind,
     ClusterEdge,
+    ChunkEdgeKind,
     ChunkNodeID,
+    NodeKind,
 )
 from rtfs.graph import CodeGraph
 
 logger = getLogger(__name__)
 
+# Weight of each chunk edge kind in the network that is clustered. Parallel edges
+# between the same chunks add up
+EDGE_WEIGHTS = {
+    ChunkEdgeKind.ImportFrom: 1.0,
+    ChunkEdgeKind.CallTo: 1.0,
+}
 
-def cluster_infomap(network: CodeGraph) -> Dict[str, int]:
-    # Initialize Infomap
-    infomap = Infomap("--seed 42 --two-level", silent=True)
+# Bump when the cluster nodes written by cluster() change, so graphs clustered by
+# an older version are reclustered
+CLUSTER_VERSION = "1"
 
-    # Taking the first element of the tuple as the node id
-    node_id_map = {node: idx for idx, node in enumerate(network._graph.nodes())}
+# Key in the graph metadata holding the algorithm, params and hash of the clustering
+CLUSTER_METADATA_KEY = "clustering"
+
+# Number of clusterings kept in memory, keyed by network_hash
+CLUSTER_CACHE_SIZE = 32
+
+_cluster_cache: "OrderedDict[str, Dict[ChunkNodeID, int]]" = OrderedDict()
+
+
+def chunk_network(graph: CodeGraph) -> nx.DiGraph:
+    """
+    Weighted graph of the chunk to chunk edges in graph, without the cluster nodes.
+    Nodes keep the order of graph, since Infomap results depend on it
+    """
+    network = nx.DiGraph()
+    network.add_nodes_from(
+        node
+        for node, kind in graph._graph.nodes(data="kind")
+        if kind != NodeKind.Cluster
+    )
+    for src, dst, kind in graph._graph.edges(data="kind"):
+        weight = EDGE_WEIGHTS.get(kind)
+        if weight is None:
+            continue
+
+        if network.has_edge(src, dst):
+            network[src][dst]["weight"] += weight
+        else:
+            network.add_edge(src, dst, weight=weight)
+
+    return network
+
+
+def network_hash(network: nx.DiGraph, alg: str, params: Dict) -> str:
+    """
+    Hashes the edges in insertion order, since the clustering depends on it
+    """
+    h = sha256(json.dumps([alg, sorted(params.items())], default=str).encode())
+    for src, dst, weight in network.edges(data="weight"):
+        h.update(f"{src}\0{dst}\0{weight}\n".encode())
+    return h.hexdigest()
+
+
+def _undirected(network: nx.DiGraph) -> nx.Graph:
+    # Chunks without edges are left unclustered, like with Infomap
+    undirected = nx.Graph()
+    for src, dst, weight in network.edges(data="weight"):
+        if undirected.has_edge(src, dst):
+            undirected[src][dst]["weight"] += weight
+        else:
+            undirected.add_edge(src, dst, weight=weight)
+    return undirected
+
+
+def _communities_to_clusters(
+    network: nx.DiGraph, communities: Iterable[Set]
+) -> Dict[ChunkNodeID, int]:
+    # Number communities by their first node so the ids don't depend on set order
+    order = {node: i for i, node in enumerate(network.nodes())}
+    communities = sorted(communities, key=lambda c: min(order[n] for n in c))
+
+    cluster_dict = {}
+    for cluster_id, community in enumerate(communities, start=1):
+        for node in community:
+            cluster_dict[node] = cluster_id
+    return cluster_dict
+
+
+def _run_infomap(network: nx.DiGraph, args: str) -> Dict[ChunkNodeID, Tuple[int, ...]]:
+    infomap = Infomap(args, silent=True)
+
+    node_id_map = {node: idx for idx, node in enumerate(network.nodes())}
     reverse_node_id_map = {idx: node for node, idx in node_id_map.items()}
 
     # Add nodes and edges to Infomap using integer IDs
-    for edge in network._graph.edges():
-        infomap.addLink(node_id_map[edge[0]], node_id_map[edge[1]])
+    for src, dst, weight in network.edges(data="weight"):
+        infomap.add_link(node_id_map[src], node_id_map[dst], weight)
 
     # Run Infomap clustering
     infomap.run()
 
-    cluster_dict: Dict[int, List] = {}
     # node_id, path
     # 1 (1, 2, 2)
-    for node, levels in infomap.get_multilevel_modules().items():
-        node_id = reverse_node_id_map[node]
-        cluster_dict[node_id] = levels[-1]
+    return {
+        reverse_node_id_map[node]: levels
+        for node, levels in infomap.get_multilevel_modules().items()
+    }
 
-    # replace leaf nodes with their original id
-    return cluster_dict
 
+def cluster_infomap(network: nx.DiGraph, seed: int = 42) -> Dict[ChunkNodeID, int]:
+    modules = _run_infomap(network, f"--seed {seed} --two-level")
+    return {node: levels[-1] for node, levels in modules.items()}
+
+
+def cluster_infomap_hierarchy(
+    network: nx.DiGraph, seed: int = 42
+) -> Dict[ChunkNodeID, Tuple[int, ...]]:
+    return {
+        node: tuple(levels)
+        for node, levels in _run_infomap(network, f"--seed {seed}").items()
+    }
+
+
+def cluster_louvain(
+    network: nx.DiGraph, seed: int = 42, resolution: float = 1.0
+) -> Dict[ChunkNodeID, int]:
+    communities = nx.community.louvain_communities(
+        _undirected(network), weight="weight", resolution=resolution, seed=seed
+    )
+    return _communities_to_clusters(network, communities)
+
+
+def cluster_label_propagation(
+    network: nx.DiGraph, seed: int = 42
+) -> Dict[ChunkNodeID, int]:
+    communities = nx.community.asyn_lpa_communities(
+        _undirected(network), weight="weight", seed=seed
+    )
+    return _communities_to_clusters(network, communities)
+
+
+def cluster_louvain_hierarchy(
+    network: nx.DiGraph, seed: int = 42, resolution: float = 1.0
+) -> Dict[ChunkNodeID, Tuple[int, ...]]:
+    paths = defaultdict(tuple)
+    # Partitions go from the finest to the coarsest level
+    for partition in nx.community.louvain_partitions(
+        _undirected(network), weight="weight", resolution=resolution, seed=seed
+    ):
+        for node, cluster_id in _communities_to_clusters(network, partition).items():
+            paths[node] = (cluster_id,) + paths[node]
+    return dict(paths)
+
+
+# Flat algorithms map each chunk to a cluster
+CLUSTER_ALGS: Dict[str, Callable[..., Dict[ChunkNodeID, int]]] = {
+    "infomap": cluster_infomap,
+    "louvain": cluster_louvain,
+    "label_propagation": cluster_label_propagation,
+}
+
+# Hierarchical algorithms map each chunk to its path of modules, from the top level
+# down to its own cluster
+HIERARCHICAL_CLUSTER_ALGS: Dict[str, Callable[..., Dict[ChunkNodeID, Tuple]]] = {
+    "infomap": cluster_infomap_hierarchy,
+    "louvain": cluster_louvain_hierarchy,
+}
 
-def cluster(graph: CodeGraph, alg: str = "infomap") -> Dict[ChunkNodeID, Tuple]:
+
+def _get_algs(hierarchical: bool) -> Dict[str, Callable]:
+    return HIERARCHICAL_CLUSTER_ALGS if hierarchical else CLUSTER_ALGS
+
+
+def _cluster_tree(
+    paths: Dict[ChunkNodeID, Tuple[int, ...]]
+) -> Tuple[Dict[ChunkNodeID, int], Dict[int, int]]:
     """
-    Entry method for cluster construction on ChunkGraph
+    Turns the module path of each chunk into a tree of clusters. Every distinct path
+    prefix is a cluster, except for prefixes with a single child and no chunks of
+    their own. Returns the cluster of each chunk and the parent of each cluster
     """
-    if alg == "infomap":
-        cluster_dict = cluster_infomap(graph)
+    leaves = set(paths.values())
+    children = defaultdict(set)
+    for path in leaves:
+        for depth in range(1, len(path)):
+            children[path[:depth]].add(path[: depth + 1])
+
+    cluster_ids: Dict[Tuple, int] = {}
+    cluster_parents: Dict[int, int] = {}
+    cluster_dict: Dict[ChunkNodeID, int] = {}
+    for node, path in paths.items():
+        parent = None
+        for depth in range(1, len(path) + 1):
+            prefix = path[:depth]
+            if len(children[prefix]) == 1 and prefix not in leaves:
+                continue
+
+            if prefix not in cluster_ids:
+                cluster_ids[prefix] = len(cluster_ids) + 1
+                if parent is not None:
+                    cluster_parents[cluster_ids[prefix]] = parent
+            parent = cluster_ids[prefix]
+
+        cluster_dict[node] = parent
+
+    return cluster_dict, cluster_parents
+
+
+def _get_clusters(
+    network: nx.DiGraph, key: str, alg: str, hierarchical: bool, params: Dict
+) -> Dict[ChunkNodeID, Any]:
+    cluster_dict = _cluster_cache.get(key)
+    if cluster_dict is not None:
+        _cluster_cache.move_to_end(key)
+        logger.info(f"Using cached {alg} clusters for {len(cluster_dict)} chunks")
     else:
+        cluster_dict = _get_algs(hierarchical)[alg](network, **params)
+        _cluster_cache[key] = cluster_dict
+        if len(_cluster_cache) > CLUSTER_CACHE_SIZE:
+            _cluster_cache.popitem(last=False)
+
+    return dict(cluster_dict)
+
+
+def _network_hash(
+    network: nx.DiGraph, alg: str, hierarchical: bool, params: Dict
+) -> str:
+    if hierarchical:
+        params = {**params, "hierarchical": True}
+    return network_hash(network, alg, params)
+
+
+def get_clusters(
+    graph: CodeGraph, alg: str = "infomap", hierarchical: bool = False, **params
+) -> Dict[ChunkNodeID, Any]:
+    """
+    Clusters the chunks in graph, or returns the cached clusters if the same chunk
+    edges were clustered with the same algorithm and params before. Hierarchical
+    algorithms return the module path of each chunk instead of its cluster
+    """
+    if alg not in _get_algs(hierarchical):
         raise Exception(f"{alg} not supported")
 
-    for chunk_node, cluster in cluster_dict.items():
-        if not graph.has_node(cluster):
-            graph.add_node(ClusterNode(id=cluster))
+    network = chunk_network(graph)
+    key = _network_hash(network, alg, hierarchical, params)
+    return _get_clusters(network, key, alg, hierarchical, params)
 
-        cluster_edge = ClusterEdge(
-            src=chunk_node, dst=cluster, kind=ClusterEdgeKind.ChunkToCluster
-        )
+
+def get_cluster_metadata(graph: CodeGraph) -> Optional[Dict]:
+    return graph._graph.graph.get(CLUSTER_METADATA_KEY)
+
+
+def get_cluster_assignments(graph: CodeGraph) -> Dict[ChunkNodeID, int]:
+    return {
+        src: dst
+        for src, dst, kind in graph._graph.edges(data="kind")
+        if kind == ClusterEdgeKind.ChunkToCluster
+    }
+
+
+def cluster(
+    graph: CodeGraph, alg: str = "infomap", hierarchical: bool = False, **params
+) -> Dict[ChunkNodeID, int]:
+    """
+    Entry method for cluster construction on ChunkGraph. If the graph was already
+    clustered from the same chunk edges with the same algorithm and params, the
+    existing clusters (and their summaries) are kept. Otherwise all cluster nodes
+    are replaced by the new clusters.
+
+    With hierarchical, the levels found by the algorithm are added as
+    ClusterToCluster edges, so the clusters form a tree without categorizing them
+    """
+    if alg not in _get_algs(hierarchical):
+        raise Exception(f"{alg} not supported")
+
+    network = chunk_network(graph)
+    key = _network_hash(network, alg, hierarchical, params)
+
+    metadata = get_cluster_metadata(graph)
+    if metadata and metadata["version"] == CLUSTER_VERSION and metadata["hash"] == key:
+        logger.info(f"Graph is already clustered with {alg}, skipping")
+        return get_cluster_assignments(graph)
+
+    cluster_dict = _get_clusters(network, key, alg, hierarchical, params)
+    if hierarchical:
+        cluster_dict, cluster_parents = _cluster_tree(cluster_dict)
+    else:
+        cluster_parents = {}
+
+    # Build the new clusters before touching the graph, so a failure leaves the
+    # previous clusters in place
+    cluster_ids = list(
+        dict.fromkeys([*cluster_parents.values(), *cluster_dict.values()])
+    )
+    cluster_nodes = [ClusterNode(id=c) for c in cluster_ids]
+    cluster_edges = [
+        ClusterEdge(src=chunk_node, dst=cluster, kind=ClusterEdgeKind.ChunkToCluster)
+        for chunk_node, cluster in cluster_dict.items()
+    ] + [
+        ClusterEdge(src=child, dst=parent, kind=ClusterEdgeKind.ClusterToCluster)
+        for child, parent in cluster_parents.items()
+    ]
+
+    # Removing the cluster nodes also removes their ChunkToCluster edges and the
+    # ClusterToCluster edges of categories built on top of them
+    graph._graph.remove_nodes_from(
+        [
+            node
+            for node, kind in graph._graph.nodes(data="kind")
+            if kind == NodeKind.Cluster
+        ]
+    )
+    for cluster_node in cluster_nodes:
+        graph.add_node(cluster_node)
+    for cluster_edge in cluster_edges:
         graph.add_edge(cluster_edge)
 
+    graph._cluster_roots = [c for c in cluster_ids if c not in cluster_parents]
+    graph._graph.graph[CLUSTER_METADATA_KEY] = {
+        "version": CLUSTER_VERSION,
+        "alg": alg,
+        "params": params,
+        "hierarchical": hierarchical,
+        "hash": key,
+    }
+
     return cluster_dict
@@ -43,6 +43,53 @@ REPOS_ROOT = Path(CODESEARCH_DIR) / "repo"
 INDEX_ROOT = Path(CODESEARCH_DIR) / "index"
 GRAPH_ROOT = Path(CODESEARCH_DIR) / "graphs"
 SUMMARIES_ROOT = Path(CODESEARCH_DIR) / "summaries"
+SUMMARY_CACHE_ROOT = Path(CODESEARCH_DIR) / "summary_cache"
+
+# Max size on disk of the CodeIndexes kept loaded in memory, see src.index.cache
+INDEX_CACHE_MAX_BYTES = config(
+    "INDEX_CACHE_MAX_BYTES", cast=int, default=4 * 1024 * 1024 * 1024
+)
+
+# Embedding model for new indexes: "local:<sentence-transformers model>" to embed on
+# the CPU, "hash" for offline feature hashing, else an OpenAI model. See
+# src.index.embedding
+EMBED_MODEL = config("EMBED_MODEL", default="text-embedding-3-small")
+# Threads embedding batches with the hash model, local models use torch threads
+EMBED_THREADS = config("EMBED_THREADS", cast=int, default=os.cpu_count() or 1)
+EMBED_MAX_BATCH_SIZE = config("EMBED_MAX_BATCH_SIZE", cast=int, default=256)
+NODE_EMBEDDING_CACHE_PATH = Path(CODESEARCH_DIR) / "embedding_cache" / "embeddings.db"
+NODE_EMBEDDING_CACHE_MAX_BYTES = config(
+    "NODE_EMBEDDING_CACHE_MAX_BYTES", cast=int, default=8 * 1024 * 1024 * 1024
+)
+
+# Query embedding and search result caches, see src.search.cache
+EMBEDDING_CACHE_SIZE = config("EMBEDDING_CACHE_SIZE", cast=int, default=10_000)
+EMBEDDING_CACHE_TTL = config("EMBEDDING_CACHE_TTL", cast=int, default=24 * 60 * 60)
+SEARCH_CACHE_SIZE = config("SEARCH_CACHE_SIZE", cast=int, default=1000)
+SEARCH_CACHE_TTL = config("SEARCH_CACHE_TTL", cast=int, default=10 * 60)
+
+# Task queue, see src.queue.core
+TASK_DB_PATH = Path(CODESEARCH_DIR) / "tasks.db"
+TASK_WORKERS = config("TASK_WORKERS", cast=int, default=2)
+TASK_MAX_PER_USER = config("TASK_MAX_PER_USER", cast=int, default=1)
+TASK_MAX_ATTEMPTS = config("TASK_MAX_ATTEMPTS", cast=int, default=2)
+TASK_POLL_INTERVAL = config("TASK_POLL_INTERVAL", cast=float, default=0.5)
+# Workers refresh the heartbeat of their task every TASK_HEARTBEAT_INTERVAL seconds,
+# tasks without one for TASK_HEARTBEAT_TIMEOUT seconds are requeued
+TASK_HEARTBEAT_INTERVAL = config("TASK_HEARTBEAT_INTERVAL", cast=float, default=5)
+TASK_HEARTBEAT_TIMEOUT = config("TASK_HEARTBEAT_TIMEOUT", cast=float, default=60)
+# Seconds finished tasks are kept for status polling
+TASK_RETENTION = config("TASK_RETENTION", cast=int, default=7 * 24 * 60 * 60)
+
+# Graph expansion of search hits, see src.search.graph
+GRAPH_RETRIEVER_CACHE_SIZE = config("GRAPH_RETRIEVER_CACHE_SIZE", cast=int, default=16)
+GRAPH_RETRIEVAL_DEPTH = config("GRAPH_RETRIEVAL_DEPTH", cast=int, default=2)
+SEARCH_CONTEXT_MAX_TOKENS = config("SEARCH_CONTEXT_MAX_TOKENS", cast=int, default=4000)
+
+# Clustering settings, see rtfs.transforms.cluster
+CLUSTER_ALG = config("CLUSTER_ALG", default="infomap")
+# Build the cluster hierarchy from the clustering instead of categorizing with the LLM
+CLUSTER_HIERARCHICAL = config("CLUSTER_HIERARCHICAL", cast=bool, default=False)
 
 AWS_REGION = "us-east-2"
 ANON_LOGIN = True
@@ -3,6 +3,8 @@ from src.models import HTTPSuccess
 from src.auth.service import get_current_user
 from src.auth.models import User
 
+from rtfs.llm_governor import llm_governor
+
 
 health_router = APIRouter()
 
@@ -10,3 +12,9 @@ health_router = APIRouter()
 @health_router.get("/health")
 async def health():
     return HTTPSuccess()
+
+
+# Spend and rate limits only, per user costs are aggregated, but still not public
+@health_router.get("/health/llm")
+async def llm_metrics(curr_user: User = Depends(get_current_user)):
+    return llm_governor.metrics()
@@ -0,0 +1,128 @@
+import os
+import threading
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from hashlib import sha256
+from logging import getLogger
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+from moatless.index import CodeIndex
+
+logger = getLogger(__name__)
+
+
+def dir_version(path: str) -> Tuple:
+    """
+    Names, sizes and modification times of the files in path, which change whenever
+    the index is persisted again or deleted
+    """
+    version = []
+    for root, _, files in os.walk(path):
+        for name in files:
+            stat = os.stat(os.path.join(root, name))
+            version.append((os.path.join(root, name), stat.st_size, stat.st_mtime_ns))
+    return tuple(sorted(version))
+
+
+@dataclass
+class CachedIndex:
+    code_index: CodeIndex
+    version: Tuple
+    size: int
+    refs: int = 0
+
+
+class IndexCache:
+    """
+    In-process cache of loaded CodeIndexes keyed by their persist dir. Once the
+    cached indexes take up more than max_bytes on disk, a rough proxy for their
+    memory footprint, the least recently used ones are evicted. Indexes in use by a
+    request are never evicted, and an index is reloaded when the files in its
+    persist dir change
+    """
+
+    def __init__(self, load: Callable[[str, str], CodeIndex], max_bytes: int):
+        self.load = load
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        self._indexes: "OrderedDict[str, CachedIndex]" = OrderedDict()
+        self._load_locks: Dict[str, threading.Lock] = defaultdict(threading.Lock)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def use(self, repo_path: str, persist_dir: str) -> Iterator[CodeIndex]:
+        """
+        Yields the index of the repo, which is kept in the cache until the block exits
+        """
+        entry = self._acquire(repo_path, persist_dir)
+        try:
+            yield entry.code_index
+        finally:
+            with self._lock:
+                entry.refs -= 1
+                self._evict()
+
+    def version(self, code_index: CodeIndex) -> Optional[str]:
+        """
+        Hash of the files code_index was loaded from, or None if it was replaced by
+        a reload since, so results from a stale index aren't cached as current
+        """
+        with self._lock:
+            for entry in self._indexes.values():
+                if entry.code_index is code_index:
+                    return sha256(repr(entry.version).encode()).hexdigest()
+        return None
+
+    def invalidate(self, persist_dir: str):
+        with self._lock:
+            self._indexes.pop(os.path.abspath(persist_dir), None)
+
+    def _acquire(self, repo_path: str, persist_dir: str) -> CachedIndex:
+        key = os.path.abspath(persist_dir)
+        with self._lock:
+            load_lock = self._load_locks[key]
+
+        # Concurrent requests for the same repo wait for a single load
+        with load_lock:
+            version = dir_version(key)
+            with self._lock:
+                entry = self._indexes.get(key)
+                if entry and entry.version == version:
+                    self._indexes.move_to_end(key)
+                    entry.refs += 1
+                    self.hits += 1
+                    return entry
+                self.misses += 1
+
+            code_index = self.load(repo_path, persist_dir)
+            # Creating the index persists it, so read the version again
+            version = dir_version(key)
+            entry = CachedIndex(
+                code_index=code_index,
+                version=version,
+                size=sum(size for _, size, _ in version),
+                refs=1,
+            )
+            logger.info(f"Loaded index {key} ({entry.size / 1024 / 1024:.1f}MB)")
+
+            # Requests still using a replaced index keep their reference to it
+            with self._lock:
+                self._indexes[key] = entry
+                self._indexes.move_to_end(key)
+                self._evict()
+            return entry
+
+    def _evict(self):
+        total = sum(entry.size for entry in self._indexes.values())
+        for key, entry in list(self._indexes.items()):
+            if total <= self.max_bytes:
+                break
+            if entry.refs > 0:
+                continue
+
+            del self._indexes[key]
+            total -= entry.size
+            logger.info(f"Evicted index {key} from cache")
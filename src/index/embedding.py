@@ -0,0 +1,463 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from logging import getLogger
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+from llama_index.core.base.embeddings.base import BaseEmbedding, Embedding
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.schema import BaseNode, MetadataMode
+
+from src.config import (
+    EMBED_MAX_BATCH_SIZE,
+    EMBED_THREADS,
+    NODE_EMBEDDING_CACHE_MAX_BYTES,
+    NODE_EMBEDDING_CACHE_PATH,
+)
+
+logger = getLogger(__name__)
+
+LOCAL_PREFIX = "local:"
+HASH_MODEL = "hash"
+
+# Errors torch raises when it runs out of CPU or GPU memory
+OUT_OF_MEMORY_MESSAGES = ("can't allocate memory", "not enough memory", "out of memory")
+
+# Model tiktoken counts the tokens of chunks embedded by local models with
+TOKENIZER_MODEL = "text-embedding-3-small"
+
+
+class NodeEmbeddingCache:
+    """
+    Persistent cache of node embeddings in SQLite, keyed by the embedding model and
+    the node hash, which for a CodeNode only covers its content and metadata. Least
+    recently used embeddings are evicted once they take up more than max_bytes. The
+    database is opened on first use
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def get_many(self, model: str, hashes: Sequence[str]) -> Dict[str, Embedding]:
+        embeddings = {}
+        with self._lock:
+            conn = self._connect()
+            # Stay under the SQLite limit on the number of query parameters
+            for i in range(0, len(hashes), 500):
+                batch = list(hashes[i : i + 500])
+                rows = conn.execute(
+                    "SELECT hash, embedding FROM embeddings WHERE model = ? AND hash IN "
+                    f"({', '.join('?' * len(batch))})",
+                    (model, *batch),
+                )
+                for node_hash, blob in rows:
+                    embeddings[node_hash] = np.frombuffer(blob, np.float32).tolist()
+
+            conn.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE model = ? AND hash = ?",
+                [(time.time(), model, node_hash) for node_hash in embeddings],
+            )
+            conn.commit()
+            self.hits += len(embeddings)
+            self.misses += len(set(hashes)) - len(embeddings)
+        return embeddings
+
+    def put_many(self, model: str, embeddings: Dict[str, Embedding]):
+        now = time.time()
+        rows = []
+        for node_hash, embedding in embeddings.items():
+            blob = np.asarray(embedding, np.float32).tobytes()
+            rows.append((model, node_hash, blob, len(blob), now))
+
+        with self._lock:
+            conn = self._connect()
+            conn.executemany(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?)", rows
+            )
+            self._evict(conn)
+            conn.commit()
+
+    def _evict(self, conn: sqlite3.Connection):
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()
+        excess = total[0] - self.max_bytes
+        if excess <= 0:
+            return
+
+        evicted = []
+        for model, node_hash, size in conn.execute(
+            "SELECT model, hash, size FROM embeddings ORDER BY last_used"
+        ):
+            evicted.append((model, node_hash))
+            excess -= size
+            if excess <= 0:
+                break
+
+        conn.executemany("DELETE FROM embeddings WHERE model = ? AND hash = ?", evicted)
+        logger.info(f"Evicted {len(evicted)} embeddings from cache {self.path}")
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            dirname = os.path.dirname(self.path)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    model TEXT NOT NULL,
+                    hash TEXT NOT NULL,
+                    embedding BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_used REAL NOT NULL,
+                    PRIMARY KEY (model, hash)
+                )
+                """
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS embeddings_last_used "
+                "ON embeddings (last_used)"
+            )
+        return self._conn
+
+
+class BatchSizeTuner:
+    """
+    Finds the batch size with the best embedding throughput. The batch size is
+    doubled as long as the texts embedded per second keep improving, then settles
+    on the best one seen. Running out of memory halves it
+    """
+
+    # Relative throughput gain needed to keep growing the batch size
+    MIN_GAIN = 0.1
+
+    def __init__(self, batch_size: int = 8, max_batch_size: int = 256):
+        self.batch_size = min(batch_size, max_batch_size)
+        self.max_batch_size = max_batch_size
+        self.tuned = False
+
+        self._best_throughput = 0.0
+        self._best_batch_size = self.batch_size
+        self._lock = threading.Lock()
+
+    def record(self, batch_size: int, elapsed: float):
+        """
+        Records the time taken to embed a full batch of batch_size texts
+        """
+        with self._lock:
+            if self.tuned or batch_size != self.batch_size:
+                return
+
+            throughput = batch_size / max(elapsed, 1e-9)
+            if throughput > self._best_throughput * (1 + self.MIN_GAIN):
+                self._best_throughput = throughput
+                self._best_batch_size = batch_size
+                if batch_size < self.max_batch_size:
+                    self.batch_size = min(batch_size * 2, self.max_batch_size)
+                    return
+
+            self.batch_size = self._best_batch_size
+            self.tuned = True
+            logger.info(
+                f"Tuned embedding batch size to {self.batch_size} "
+                f"({self._best_throughput:.1f} texts/s)"
+            )
+
+    def shrink(self, batch_size: int):
+        """
+        Halves the batch size after embedding batch_size texts ran out of memory.
+        Batches that failed concurrently at the same size only halve it once
+        """
+        with self._lock:
+            if batch_size == 1:
+                raise MemoryError("Out of memory embedding a single text")
+            if self.batch_size < batch_size:
+                return
+
+            self.batch_size = self.max_batch_size = batch_size // 2
+            self._best_batch_size = min(self._best_batch_size, self.batch_size)
+            logger.warning(f"Out of memory, lowered batch size to {self.batch_size}")
+
+
+class BatchedEmbedding(BaseEmbedding):
+    """
+    Base class for embedding models run in process. Texts are embedded in batches
+    sized by a BatchSizeTuner, first one at a time while the batch size is tuned,
+    then on num_threads threads. Batches that run out of memory are split and
+    embedded again at the lowered batch size
+    """
+
+    num_threads: int = 1
+
+    _tuner: BatchSizeTuner = PrivateAttr()
+
+    def __init__(self, max_batch_size: int = EMBED_MAX_BATCH_SIZE, **kwargs):
+        # Batching is left to _get_text_embeddings, so it gets as many texts as
+        # llama_index allows
+        super().__init__(embed_batch_size=2048, **kwargs)
+        self._tuner = BatchSizeTuner(max_batch_size=max_batch_size)
+
+    @property
+    def dimensions(self) -> int:
+        raise NotImplementedError
+
+    def _embed(self, texts: List[str]) -> List[Embedding]:
+        raise NotImplementedError
+
+    def _embed_batch(self, texts: List[str]) -> List[Embedding]:
+        starttime = time.perf_counter()
+        embeddings = self._embed(texts)
+        self._tuner.record(len(texts), time.perf_counter() - starttime)
+        return embeddings
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        embeddings = []
+        while len(embeddings) < len(texts) and not self._tuner.tuned:
+            batch = texts[len(embeddings) : len(embeddings) + self._tuner.batch_size]
+            try:
+                embeddings.extend(self._embed_batch(batch))
+            except MemoryError:
+                self._tuner.shrink(len(batch))
+
+        remaining = texts[len(embeddings) :]
+        if not remaining:
+            return embeddings
+
+        batch_size = self._tuner.batch_size
+        batches = [
+            remaining[i : i + batch_size] for i in range(0, len(remaining), batch_size)
+        ]
+        with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+            for batch_embeddings in executor.map(self._embed_or_split, batches):
+                embeddings.extend(batch_embeddings)
+        return embeddings
+
+    def _embed_or_split(self, texts: List[str]) -> List[Embedding]:
+        try:
+            return self._embed(texts)
+        except MemoryError:
+            self._tuner.shrink(len(texts))
+
+        batch_size = self._tuner.batch_size
+        embeddings = []
+        for i in range(0, len(texts), batch_size):
+            embeddings.extend(self._embed_or_split(texts[i : i + batch_size]))
+        return embeddings
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        return self._embed([text])[0]
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        return self._embed([query])[0]
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        return self._get_query_embedding(query)
+
+
+class LocalEmbedding(BatchedEmbedding):
+    """
+    sentence-transformers model run on the CPU, so repos can be indexed without
+    network access once the model is downloaded. model_name can be a local path.
+    torch already spreads each batch over all cores, so batches are embedded on a
+    single thread by default
+    """
+
+    _model: Any = PrivateAttr()
+
+    def __init__(
+        self,
+        model_name: str,
+        num_threads: int = 1,
+        max_batch_size: int = EMBED_MAX_BATCH_SIZE,
+    ):
+        # Optional dependency, pulls in torch
+        from sentence_transformers import SentenceTransformer
+
+        super().__init__(
+            model_name=model_name,
+            num_threads=num_threads,
+            max_batch_size=max_batch_size,
+        )
+        self._model = SentenceTransformer(model_name, device="cpu")
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "LocalEmbedding"
+
+    @property
+    def dimensions(self) -> int:
+        return self._model.get_sentence_embedding_dimension()
+
+    def _embed(self, texts: List[str]) -> List[Embedding]:
+        try:
+            return self._model.encode(
+                texts,
+                batch_size=len(texts),
+                normalize_embeddings=True,
+                convert_to_numpy=True,
+            ).tolist()
+        except RuntimeError as e:
+            # torch reports running out of memory as a RuntimeError, which has to be
+            # a MemoryError for the batch to be split
+            if any(message in str(e) for message in OUT_OF_MEMORY_MESSAGES):
+                raise MemoryError(str(e)) from e
+            raise
+
+
+class HashEmbedding(BatchedEmbedding):
+    """
+    Bag of identifier parts hashed into a fixed number of dimensions. Needs neither
+    a model nor network access, for tests and air-gapped environments
+    """
+
+    embed_dim: int = 512
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "HashEmbedding"
+
+    @property
+    def dimensions(self) -> int:
+        return self.embed_dim
+
+    def _tokens(self, text: str) -> List[str]:
+        # Split snake_case and camelCase identifiers into their parts
+        words = re.findall(r"[A-Za-z][a-z]*|[A-Z]+(?![a-z])|\d+", text)
+        return [word.lower() for word in words]
+
+    def _embed(self, texts: List[str]) -> List[Embedding]:
+        vectors = np.zeros((len(texts), self.embed_dim), np.float32)
+        for row, text in enumerate(texts):
+            for token in self._tokens(text):
+                digest = sha256(token.encode()).digest()
+                col = int.from_bytes(digest[:4], "little") % self.embed_dim
+                vectors[row, col] += 1.0 if digest[4] & 1 else -1.0
+
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return (vectors / np.maximum(norms, 1e-9)).tolist()
+
+
+class CachedNodeEmbedding(BaseEmbedding):
+    """
+    Embeds nodes during ingestion with embed_model, except for those whose hash is
+    in the node embedding cache, so unchanged chunks are never embedded again
+    """
+
+    _embed_model: BaseEmbedding = PrivateAttr()
+    _cache: NodeEmbeddingCache = PrivateAttr()
+
+    def __init__(self, embed_model: BaseEmbedding, cache: NodeEmbeddingCache):
+        super().__init__(
+            model_name=embed_model.model_name,
+            embed_batch_size=embed_model.embed_batch_size,
+        )
+        self._embed_model = embed_model
+        self._cache = cache
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedNodeEmbedding"
+
+    @property
+    def dimensions(self) -> Optional[int]:
+        """
+        Dimensions of the embeddings, None to use the IndexSettings default
+        """
+        return getattr(self._embed_model, "dimensions", None)
+
+    def __call__(self, nodes: List[BaseNode], **kwargs: Any) -> List[BaseNode]:
+        hashes = [node.hash for node in nodes]
+        cached = self._cache.get_many(self.model_name, hashes)
+
+        missing: Dict[str, BaseNode] = {}
+        for node, node_hash in zip(nodes, hashes):
+            if node_hash not in cached:
+                missing.setdefault(node_hash, node)
+
+        if missing:
+            embeddings = self._embed_model.get_text_embedding_batch(
+                [
+                    node.get_content(metadata_mode=MetadataMode.EMBED)
+                    for node in missing.values()
+                ],
+                **kwargs,
+            )
+            new = dict(zip(missing.keys(), embeddings))
+            self._cache.put_many(self.model_name, new)
+            cached.update(new)
+
+        logger.info(
+            f"Embedded {len(missing)} of {len(nodes)} nodes with {self.model_name}"
+        )
+        for node, node_hash in zip(nodes, hashes):
+            node.embedding = cached[node_hash]
+        return nodes
+
+    async def acall(self, nodes: List[BaseNode], **kwargs: Any) -> List[BaseNode]:
+        return self(nodes, **kwargs)
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        return self._embed_model.get_query_embedding(query)
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        return await self._embed_model.aget_query_embedding(query)
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        return self._embed_model.get_text_embedding(text)
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        return self._embed_model.get_text_embedding_batch(texts)
+
+
+node_embedding_cache = NodeEmbeddingCache(
+    str(NODE_EMBEDDING_CACHE_PATH), NODE_EMBEDDING_CACHE_MAX_BYTES
+)
+
+# Loading a local model takes seconds, so models are shared by all indexes
+_embed_models: Dict[str, CachedNodeEmbedding] = {}
+_lock = threading.Lock()
+
+
+def _create_embed_model(embed_model: str) -> BaseEmbedding:
+    if embed_model.startswith(LOCAL_PREFIX):
+        return LocalEmbedding(embed_model[len(LOCAL_PREFIX) :])
+    if embed_model == HASH_MODEL:
+        return HashEmbedding(model_name=HASH_MODEL, num_threads=EMBED_THREADS)
+
+    from llama_index.embeddings.openai import OpenAIEmbedding
+
+    return OpenAIEmbedding(model=embed_model)
+
+
+def tokenizer_model(embed_model: str) -> str:
+    """
+    Model name moatless counts the tokens of chunks embedded with embed_model for,
+    which has to be one tiktoken knows
+    """
+    if embed_model.startswith(LOCAL_PREFIX) or embed_model == HASH_MODEL:
+        return TOKENIZER_MODEL
+    return embed_model
+
+
+def get_embed_model(embed_model: str) -> CachedNodeEmbedding:
+    """
+    Embedding model by name, "local:<sentence-transformers model>" to embed on the
+    CPU, "hash" for feature hashing, or an OpenAI embedding model
+    """
+    with _lock:
+        if embed_model not in _embed_models:
+            _embed_models[embed_model] = CachedNodeEmbedding(
+                _create_embed_model(embed_model), node_embedding_cache
+            )
+        return _embed_models[embed_model]
@@ -9,25 +9,59 @@ from moatless.index.epic_split import EpicSplitter
 import os
 import fnmatch
 import mimetypes
-from typing import Dict, List
+from typing import Dict, List, Optional
 from pathlib import Path
 
 from llama_index.core import SimpleDirectoryReader
 
+from src.config import EMBED_MODEL, INDEX_CACHE_MAX_BYTES
+from src.search.cache import cache_query_embeddings
+from src.search.lexical import load_or_create_lexical_index
+from .cache import IndexCache
+from .embedding import get_embed_model, tokenizer_model
 
-def get_or_create_index(repo_path: str, persist_dir: str):
+
+class EmbedIndexSettings(IndexSettings):
+    """
+    IndexSettings that record the embedding model the index was created with in
+    embed_backend. moatless counts tokens with tiktoken for embed_model, so for
+    local models that is set to a model tiktoken knows
+    """
+
+    embed_backend: Optional[str] = None
+
+    @property
+    def backend(self) -> str:
+        # Indexes created before embed_backend was added only have embed_model
+        return self.embed_backend or self.embed_model
+
+
+def load_or_create_index(repo_path: str, persist_dir: str):
     """
-    Gets or creates the code embeddings/docstore for the repo
+    Loads or creates the code embeddings/docstore for the repo
     """
     file_repo = FileRepository(repo_path)
-    index_settings = IndexSettings(embed_model="text-embedding-3-small")
 
     if os.path.exists(persist_dir) and os.listdir(persist_dir):
-        code_index = CodeIndex.from_persist_dir(persist_dir, file_repo=file_repo)
+        # Queries have to be embedded with the model the index was created with
+        index_settings = EmbedIndexSettings.from_persist_dir(persist_dir)
+        code_index = CodeIndex.from_persist_dir(
+            persist_dir,
+            file_repo=file_repo,
+            embed_model=get_embed_model(index_settings.backend),
+        )
     else:
+        embed_model = get_embed_model(EMBED_MODEL)
+        index_settings = EmbedIndexSettings(
+            embed_model=tokenizer_model(EMBED_MODEL), embed_backend=EMBED_MODEL
+        )
+        if embed_model.dimensions:
+            index_settings.dimensions = embed_model.dimensions
+
         code_index = CodeIndex(
             file_repo=file_repo,
             settings=index_settings,
+            embed_model=embed_model,
             # cluster_list=cluster_json if cluster_json else {},
             use_summaries=False,
             summary_anthropic_model=True,
@@ -36,9 +70,26 @@ def get_or_create_index(repo_path: str, persist_dir: str):
         code_index.run_ingestion()
         code_index.persist(persist_dir)
 
+    cache_query_embeddings(code_index)
+    code_index.lexical_index = load_or_create_lexical_index(
+        code_index, repo_path, persist_dir
+    )
     return code_index
 
 
+index_cache = IndexCache(load_or_create_index, INDEX_CACHE_MAX_BYTES)
+
+
+def get_or_create_index(repo_path: str, persist_dir: str):
+    """
+    Gets or creates the code embeddings/docstore for the repo, from index_cache if
+    it was loaded before. Use index_cache.use() instead to keep it from being evicted
+    while it is in use
+    """
+    with index_cache.use(repo_path, persist_dir) as code_index:
+        return code_index
+
+
 def get_or_create_chunks(repo_path: str, persist_dir: str):
     code_index = get_or_create_index(repo_path, persist_dir)
     return code_index._docstore.docs.values()
@@ -1,22 +1,47 @@
 from .models import Task, TaskStatus
+from .store import FINISHED, TaskStore
+from .worker import run_worker
 
 from fastapi import Request
-from threading import Lock, Event
-from collections import defaultdict
-from typing import List, Dict, Callable, Any
-from concurrent.futures import ThreadPoolExecutor, Future
+import asyncio
+import atexit
+import multiprocessing
+import threading
+import time
+from logging import getLogger
+from typing import List, Dict, Any, Optional
+
+from src.config import (
+    TASK_DB_PATH,
+    TASK_HEARTBEAT_INTERVAL,
+    TASK_HEARTBEAT_TIMEOUT,
+    TASK_MAX_ATTEMPTS,
+    TASK_MAX_PER_USER,
+    TASK_POLL_INTERVAL,
+    TASK_RETENTION,
+    TASK_WORKERS,
+)
+
+logger = getLogger(__name__)
+
+
+class TaskFailedError(Exception):
+    pass
 
 
 class TaskQueue:
     """
-    A set of queues separated by user_id
+    Queue of tasks run by a pool of worker processes, so heavy work like building
+    graphs doesn't compete with the API for the GIL. Task state is kept in a
+    TaskStore, where pending tasks survive restarts and workers claim them fairly
+    across users, at most TASK_MAX_PER_USER at a time per user
     """
 
     _instance = None
 
     def __new__(cls, *args, **kwargs):
         if not isinstance(cls._instance, cls):
-            print("Creating new TaskQueue instance")
+            logger.info("Creating new TaskQueue instance")
             cls._instance = super(TaskQueue, cls).__new__(cls, *args, **kwargs)
             cls._instance._initialized = False
 
@@ -25,110 +50,155 @@ class TaskQueue:
     def __init__(self):
         if not self._initialized:
             # Initialize instance variables only once
-            self.queue: Dict[str, List[Task]] = defaultdict(list)
-            self.locks = defaultdict(list)
-            self.executor = ThreadPoolExecutor(
-                max_workers=5
-            )  # Adjust max_workers as needed
+            self.store = TaskStore(str(TASK_DB_PATH))
+            # Stopping a worker holds the store lock for seconds, so the monitor has
+            # its own connection and lock
+            self._monitor_store = TaskStore(str(TASK_DB_PATH))
+            self.store.requeue_orphans(
+                time.time() - TASK_HEARTBEAT_TIMEOUT, TASK_MAX_ATTEMPTS
+            )
+            self.store.delete_finished(time.time() - TASK_RETENTION)
+
+            # Spawned so workers don't inherit the locks and threads of the API.
+            # Workers are not daemons, since tasks like chunking start processes
+            self._context = multiprocessing.get_context("spawn")
+            self._workers: Dict[int, multiprocessing.Process] = {}
+            self._lock = threading.Lock()
+            self._stopped = threading.Event()
+            for _ in range(TASK_WORKERS):
+                self._start_worker()
+
+            threading.Thread(
+                target=self._monitor, name="task-monitor", daemon=True
+            ).start()
+            atexit.register(self.shutdown)
             self._initialized = True  # Mark as initialized
 
-    def _acquire_lock(self, user_id: int):
-        if self.locks.get(user_id, None) is None:
-            self.locks[user_id] = Lock()
-        return self.locks.get(user_id)
-
-    def get(self, task_id: str) -> Task:
-        for user_queue in self.queue.values():
-            task = next((t for t in user_queue if t.task_id == task_id), None)
-            if task:
-                return task
-        return None
-
-    def put(self, user_id: int, task: Task):
-        with self._acquire_lock(user_id):
-            if task.status != TaskStatus.PENDING.value:
-                raise ValueError("Task must be in PENDING state to be added to queue")
-
-            self.queue[user_id].append(task)
-            self.executor.submit(self._execute_and_complete, task, user_id)
-
-    def put_and_wait(self, user_id: int, task: Task) -> Any:
-        with self._acquire_lock(user_id):
-            if task.status != TaskStatus.PENDING.value:
-                raise ValueError("Task must be in PENDING state to be added to queue")
-
-            self.queue[user_id].append(task)
-            completion_event = Event()
-            future = self.executor.submit(
-                self._execute_and_complete_with_event, task, user_id, completion_event
-            )
+    def get(self, task_id: str) -> Optional[Task]:
+        return self.store.get(task_id)
+
+    def owner(self, task_id: str) -> Optional[str]:
+        return self.store.owner(task_id)
+
+    def put(self, user_id: int, task: Task, user_email: str):
+        if task.status != TaskStatus.PENDING.value:
+            raise ValueError("Task must be in PENDING state to be added to queue")
+
+        self.store.add(user_id, task, user_email)
+
+    async def put_and_wait(self, user_id: int, task: Task, user_email: str) -> Any:
+        """
+        Adds the task and returns its result once it completes. The store is polled
+        from a thread, so waiting for it doesn't block the event loop
+        """
+        await asyncio.to_thread(self.put, user_id, task, user_email)
 
-        # Wait for the task to complete
-        completion_event.wait()
-
-        # Get the result or raise the exception if one occurred
-        try:
-            return future.result()
-        except Exception as e:
-            raise e
-
-    def _execute_and_complete_with_event(
-        self, task: Task, user_id: int, completion_event: Event
-    ) -> Any:
-        try:
-            result = self._execute_and_complete(task, user_id)
-            return result
-        finally:
-            completion_event.set()
-
-    def _execute_and_complete(self, task: Task, user_id: int) -> Any:
-        with self._acquire_lock(user_id):
-            task.status = TaskStatus.STARTED.value
-
-        try:
-            print("Started task: ", task.task_id)
-            task.result = task.task(**task.task_args)
-            task.status = TaskStatus.COMPLETE.value
-            return task.result
-        except Exception as e:
-            print("Task failed with : ", e)
-            task.result = str(e)
-            task.status = TaskStatus.FAILED.value
-            raise e
-        finally:
-            with self._acquire_lock(user_id):
-                for i in range(len(self.queue[user_id])):
-                    if self.queue[user_id][i].task_id == task.task_id:
-                        self.queue[user_id].pop(i)
-                        break
-
-    def get_all(self, user_id: int) -> List[Task]:
-        if len(self.queue[user_id]) == 0:
-            return []
-
-        tasks = []
-        for t in filter(
-            lambda t: t.status == TaskStatus.PENDING.value, self.queue[user_id]
-        ):
-            t.status = TaskStatus.STARTED.value
-            tasks.append(t.task)
-
-        return tasks
+        while True:
+            task = await asyncio.to_thread(self.store.get, task.task_id)
+            if task.status in FINISHED:
+                break
+            await asyncio.sleep(TASK_POLL_INTERVAL)
+
+        if task.status != TaskStatus.COMPLETE.value:
+            raise TaskFailedError(f"Task {task.task_id} {task.status}: {task.result}")
+        return task.result
+
+    def cancel(self, task_id: str) -> Optional[str]:
+        """
+        Cancels the task, stopping its worker if it already started. Returns the
+        status of the task
+        """
+        return self.store.cancel(task_id)
 
     def peak(self, user_id: int, n: int) -> List[Task]:
         """
         Get the first n tasks in queue without removing
         """
-        if len(self.queue[user_id]) == 0:
-            return []
-
-        return [t.task for t in self.queue[user_id][:n]]
+        return self.store.list(user_id, n)
+
+    def shutdown(self):
+        self._stopped.set()
+        with self._lock:
+            for worker in self._workers.values():
+                worker.terminate()
+            for worker in self._workers.values():
+                worker.join(timeout=5)
+            self._workers.clear()
+
+    def _start_worker(self):
+        worker = self._context.Process(
+            target=run_worker,
+            args=(
+                str(TASK_DB_PATH),
+                TASK_MAX_PER_USER,
+                TASK_POLL_INTERVAL,
+                TASK_HEARTBEAT_INTERVAL,
+            ),
+            name="task-worker",
+        )
+        worker.start()
+        self._workers[worker.pid] = worker
+
+    def _stop_worker(self, worker: multiprocessing.Process):
+        worker.terminate()
+        worker.join(timeout=5)
+        del self._workers[worker.pid]
+
+    def _monitor(self):
+        """
+        Stops the workers of cancelled tasks, and replaces workers that exited
+        """
+        while not self._stopped.wait(TASK_POLL_INTERVAL):
+            try:
+                for task_id, worker_pid in self._monitor_store.cancel_requests():
+                    with self._lock:
+                        worker = self._workers.get(worker_pid)
+                        if worker is None:
+                            # Worker of another API process
+                            continue
+
+                        if self._monitor_store.stop_cancelled(
+                            task_id, worker_pid, lambda: self._stop_worker(worker)
+                        ):
+                            self._start_worker()
+                            logger.info(f"Cancelled task {task_id}")
+
+                dead_workers = []
+                with self._lock:
+                    if self._stopped.is_set():
+                        return
+                    for pid, worker in list(self._workers.items()):
+                        if not worker.is_alive():
+                            logger.warning(f"Task worker {pid} exited, restarting")
+                            dead_workers.append(pid)
+                            del self._workers[pid]
+                            self._start_worker()
+
+                self._monitor_store.requeue_orphans(
+                    time.time() - TASK_HEARTBEAT_TIMEOUT,
+                    TASK_MAX_ATTEMPTS,
+                    dead_workers,
+                )
+            except Exception:
+                logger.exception("Task monitor failed")
 
 
 def get_queue(request: Request):
     return request.state.task_queue
 
 
+def get_user_email(request: Request) -> str:
+    """
+    Email of the user from the JWT, without the db lookup of get_current_user
+    """
+    from src.auth.service import InvalidCredentialException, extract_user_email_jwt
+
+    user_email = extract_user_email_jwt(request=request)
+    if not user_email:
+        raise InvalidCredentialException
+    return user_email
+
+
 def get_token_registry(request: Request):
     from main import token_registry
 
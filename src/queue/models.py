@@ -14,6 +14,7 @@ class TaskStatus(Enum):
     STARTED = "STARTED"
     COMPLETE = "COMPLETE"
     FAILED = "FAILED"
+    CANCELLED = "CANCELLED"
 
 
 class Task(BaseModel):
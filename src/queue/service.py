@@ -1,4 +1,4 @@
-from cowboy_lib.api.runner.shared import Task
+from src.queue.models import Task
 
 from typing import Optional, List, Dict
 
@@ -11,15 +11,39 @@ def list_tasks(*, task_queue: TaskQueue, user_id: int, n: int) -> Optional[List[
     return task_queue.peak(user_id, n)
 
 
-def enqueue_task(*, task_queue: TaskQueue, task: Task, user_id: int):
+def enqueue_task(
+    *,
+    task_queue: TaskQueue,
+    task: Task,
+    user_id: int,
+    user_email: str,
+):
+    """Enqueue a task to the specified queue."""
+    task_queue.put(user_id, task, user_email)
+
+
+async def enqueue_task_and_wait(
+    *,
+    task_queue: TaskQueue,
+    task: Task,
+    user_id: int,
+    user_email: str,
+):
     """Enqueue a task to the specified queue and wait for its completion."""
-    task_queue.put(user_id, task)
+    return await task_queue.put_and_wait(user_id, task, user_email)
 
 
-def enqueue_task_and_wait(*, task_queue: TaskQueue, task: Task, user_id: int):
-    """Enqueue a task to the specified queue and wait for its completion."""
-    return task_queue.put_and_wait(user_id, task)
+def get_task(*, task_queue: TaskQueue, task_id: str, user_email: str) -> Optional[Task]:
+    """Get a task of the user, without touching the db."""
+    if task_queue.owner(task_id) != user_email:
+        return None
+    return task_queue.get(task_id)
 
 
-async def get_task(*, task_queue: TaskQueue, task_id: str) -> Optional[Task]:
-    return task_queue.get(task_id)
+def cancel_task(
+    *, task_queue: TaskQueue, task_id: str, user_email: str
+) -> Optional[str]:
+    """Cancel a task of the user, returns its status."""
+    if task_queue.owner(task_id) != user_email:
+        return None
+    return task_queue.cancel(task_id)
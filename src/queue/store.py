@@ -0,0 +1,348 @@
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from logging import getLogger
+from typing import Callable, Iterable, List, Optional, Set, Tuple
+
+from .models import Task, TaskStatus
+
+logger = getLogger(__name__)
+
+FINISHED = (
+    TaskStatus.COMPLETE.value,
+    TaskStatus.FAILED.value,
+    TaskStatus.CANCELLED.value,
+)
+
+# Next pending task whose user runs the fewest tasks, below the per user cap, then
+# the user served least recently, so one user's backlog doesn't starve the others
+CLAIM_QUERY = """
+WITH running AS (
+    SELECT user_id, COUNT(*) AS n FROM tasks WHERE status = 'STARTED' GROUP BY user_id
+), served AS (
+    SELECT user_id, MAX(started_at) AS last_started FROM tasks GROUP BY user_id
+)
+SELECT t.task_id, t.task FROM tasks t
+LEFT JOIN running r ON r.user_id = t.user_id
+LEFT JOIN served s ON s.user_id = t.user_id
+WHERE t.status = 'PENDING' AND COALESCE(r.n, 0) < ?
+ORDER BY COALESCE(r.n, 0), COALESCE(s.last_started, 0), t.created_at
+LIMIT 1
+"""
+
+
+class TaskStore:
+    """
+    Durable task state in a SQLite file shared by the API and worker processes, so
+    tasks survive restarts. Tasks are pickled with their args and looked up by id
+    through the primary key. The database is opened on first use
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def add(self, user_id: int, task: Task, user_email: str):
+        with self._lock:
+            self._connect().execute(
+                "INSERT INTO tasks (task_id, user_id, user_email, type, task, status, "
+                "created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    task.task_id,
+                    user_id,
+                    user_email,
+                    task.type.value,
+                    pickle.dumps(task),
+                    TaskStatus.PENDING.value,
+                    time.time(),
+                ),
+            )
+
+    def get(self, task_id: str) -> Optional[Task]:
+        with self._lock:
+            row = (
+                self._connect()
+                .execute(
+                    "SELECT task, status, result FROM tasks WHERE task_id = ?",
+                    (task_id,),
+                )
+                .fetchone()
+            )
+        return self._to_task(row) if row else None
+
+    def owner(self, task_id: str) -> Optional[str]:
+        with self._lock:
+            row = (
+                self._connect()
+                .execute("SELECT user_email FROM tasks WHERE task_id = ?", (task_id,))
+                .fetchone()
+            )
+        return row[0] if row else None
+
+    def list(self, user_id: int, n: int) -> List[Task]:
+        """
+        First n unfinished tasks of the user
+        """
+        with self._lock:
+            rows = (
+                self._connect()
+                .execute(
+                    "SELECT task, status, result FROM tasks WHERE user_id = ? AND "
+                    "status IN (?, ?) ORDER BY created_at LIMIT ?",
+                    (
+                        user_id,
+                        TaskStatus.PENDING.value,
+                        TaskStatus.STARTED.value,
+                        n,
+                    ),
+                )
+                .fetchall()
+            )
+        return [self._to_task(row) for row in rows]
+
+    def claim(self, worker_pid: int, max_per_user: int) -> Optional[Task]:
+        """
+        Marks the next task to run as started by the worker and returns it
+        """
+        with self._lock:
+            conn = self._connect()
+            # Take the write lock up front, so two workers can't claim the same task
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(CLAIM_QUERY, (max_per_user,)).fetchone()
+                if row:
+                    now = time.time()
+                    conn.execute(
+                        "UPDATE tasks SET status = ?, worker_pid = ?, started_at = ?, "
+                        "heartbeat_at = ?, attempts = attempts + 1 WHERE task_id = ?",
+                        (TaskStatus.STARTED.value, worker_pid, now, now, row[0]),
+                    )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+        if not row:
+            return None
+
+        task = pickle.loads(row[1])
+        task.status = TaskStatus.STARTED.value
+        return task
+
+    def heartbeat(self, task_id: str, worker_pid: int):
+        with self._lock:
+            self._connect().execute(
+                "UPDATE tasks SET heartbeat_at = ? "
+                "WHERE task_id = ? AND worker_pid = ? AND status = ?",
+                (time.time(), task_id, worker_pid, TaskStatus.STARTED.value),
+            )
+
+    def finish(self, task_id: str, status: TaskStatus, result):
+        """
+        Records the outcome of a started task, unless it was cancelled meanwhile
+        """
+        with self._lock:
+            self._connect().execute(
+                "UPDATE tasks SET status = ?, result = ?, finished_at = ? "
+                "WHERE task_id = ? AND status = ?",
+                (
+                    status.value,
+                    json.dumps(result, default=str),
+                    time.time(),
+                    task_id,
+                    TaskStatus.STARTED.value,
+                ),
+            )
+
+    def cancel(self, task_id: str) -> Optional[str]:
+        """
+        Cancels a pending task right away, and flags a started one for its worker to
+        be stopped. Returns the status of the task, None if it doesn't exist
+        """
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "UPDATE tasks SET status = ?, finished_at = ? "
+                "WHERE task_id = ? AND status = ?",
+                (
+                    TaskStatus.CANCELLED.value,
+                    time.time(),
+                    task_id,
+                    TaskStatus.PENDING.value,
+                ),
+            )
+            conn.execute(
+                "UPDATE tasks SET cancel_requested = 1 WHERE task_id = ? AND status = ?",
+                (task_id, TaskStatus.STARTED.value),
+            )
+            row = conn.execute(
+                "SELECT status FROM tasks WHERE task_id = ?", (task_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def cancel_requests(self) -> List[Tuple[str, int]]:
+        """
+        Started tasks flagged for cancellation, and the pids of their workers
+        """
+        with self._lock:
+            return (
+                self._connect()
+                .execute(
+                    "SELECT task_id, worker_pid FROM tasks "
+                    "WHERE status = ? AND cancel_requested = 1",
+                    (TaskStatus.STARTED.value,),
+                )
+                .fetchall()
+            )
+
+    def stop_cancelled(
+        self, task_id: str, worker_pid: int, stop: Callable[[], None]
+    ) -> bool:
+        """
+        Calls stop to kill the worker of a cancelled task and marks the task
+        cancelled, if the worker is still running it. The write lock is held
+        meanwhile, so the worker can't finish the task and claim another one before
+        it is stopped. Returns whether the worker was stopped
+        """
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                running = conn.execute(
+                    "SELECT 1 FROM tasks WHERE task_id = ? AND worker_pid = ? "
+                    "AND status = ?",
+                    (task_id, worker_pid, TaskStatus.STARTED.value),
+                ).fetchone()
+                if running:
+                    stop()
+                    conn.execute(
+                        "UPDATE tasks SET status = ?, finished_at = ? "
+                        "WHERE task_id = ?",
+                        (TaskStatus.CANCELLED.value, time.time(), task_id),
+                    )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return bool(running)
+
+    def requeue_orphans(
+        self,
+        stale_before: float,
+        max_attempts: int,
+        dead_workers: Iterable[int] = (),
+    ):
+        """
+        Tasks whose worker died, after a restart or a crash, run again until they
+        were attempted max_attempts times. A worker is dead if it is in dead_workers
+        or its last heartbeat is from before stale_before. Pids aren't checked
+        directly, since they are reused after the host restarts
+        """
+        dead_workers = set(dead_workers)
+        with self._lock:
+            conn = self._connect()
+            # So no heartbeat lands between reading the tasks and requeueing them
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._requeue_orphans(conn, stale_before, max_attempts, dead_workers)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    def _requeue_orphans(
+        self,
+        conn: sqlite3.Connection,
+        stale_before: float,
+        max_attempts: int,
+        dead_workers: Set[int],
+    ):
+        rows = conn.execute(
+            "SELECT task_id, worker_pid, attempts, cancel_requested, "
+            "heartbeat_at FROM tasks WHERE status = ?",
+            (TaskStatus.STARTED.value,),
+        ).fetchall()
+
+        for task_id, worker_pid, attempts, cancel_requested, heartbeat_at in rows:
+            if worker_pid not in dead_workers and (heartbeat_at or 0) >= stale_before:
+                continue
+
+            if cancel_requested:
+                status, result = TaskStatus.CANCELLED, None
+            elif attempts < max_attempts:
+                status, result = TaskStatus.PENDING, None
+            else:
+                status, result = TaskStatus.FAILED, "Worker exited"
+
+            logger.warning(
+                f"Task {task_id} lost worker {worker_pid}, now {status.value}"
+            )
+            conn.execute(
+                "UPDATE tasks SET status = ?, result = ?, worker_pid = NULL "
+                "WHERE task_id = ? AND status = ?",
+                (
+                    status.value,
+                    json.dumps(result),
+                    task_id,
+                    TaskStatus.STARTED.value,
+                ),
+            )
+
+    def delete_finished(self, before: float):
+        with self._lock:
+            self._connect().execute(
+                f"DELETE FROM tasks WHERE status IN ({', '.join('?' * len(FINISHED))}) "
+                "AND finished_at < ?",
+                (*FINISHED, before),
+            )
+
+    def _to_task(self, row) -> Task:
+        task = pickle.loads(row[0])
+        task.status = row[1]
+        task.result = json.loads(row[2]) if row[2] else None
+        return task
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            dirname = os.path.dirname(self.path)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+
+            # Autocommit, claims open their own transaction
+            self._conn = sqlite3.connect(
+                self.path, timeout=30, isolation_level=None, check_same_thread=False
+            )
+            # Readers don't block the writer, so polling doesn't hold up workers
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS tasks (
+                    task_id TEXT PRIMARY KEY,
+                    user_id INTEGER NOT NULL,
+                    user_email TEXT NOT NULL,
+                    type TEXT NOT NULL,
+                    task BLOB NOT NULL,
+                    status TEXT NOT NULL,
+                    result TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    cancel_requested INTEGER NOT NULL DEFAULT 0,
+                    worker_pid INTEGER,
+                    heartbeat_at REAL,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL
+                )
+                """
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, created_at)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS tasks_user ON tasks (user_id, status)"
+            )
+        return self._conn
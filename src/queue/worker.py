@@ -0,0 +1,54 @@
+import logging
+import os
+import threading
+import time
+
+from .models import TaskStatus
+from .store import TaskStore
+
+logger = logging.getLogger(__name__)
+
+
+def run_worker(
+    store_path: str,
+    max_per_user: int,
+    poll_interval: float,
+    heartbeat_interval: float,
+):
+    """
+    Entry point of a worker process. Runs the tasks claimed from the store one at a
+    time, until the process that started it exits. The heartbeat of the running
+    task is refreshed from a thread, so it keeps going while the task holds the
+    main thread
+    """
+    parent_pid = os.getppid()
+    pid = os.getpid()
+    store = TaskStore(store_path)
+    running = {}
+
+    def heartbeat():
+        while True:
+            time.sleep(heartbeat_interval)
+            task_id = running.get("task_id")
+            if task_id:
+                store.heartbeat(task_id, pid)
+
+    threading.Thread(target=heartbeat, name="task-heartbeat", daemon=True).start()
+
+    while os.getppid() == parent_pid:
+        task = store.claim(pid, max_per_user)
+        if not task:
+            time.sleep(poll_interval)
+            continue
+
+        logger.info(f"Started task {task.task_id}")
+        running["task_id"] = task.task_id
+        try:
+            result = task.task(**(task.task_args or {}))
+        except Exception as e:
+            logger.exception(f"Task {task.task_id} failed")
+            store.finish(task.task_id, TaskStatus.FAILED, str(e))
+        else:
+            store.finish(task.task_id, TaskStatus.COMPLETE, result)
+        finally:
+            running.pop("task_id", None)
@@ -5,12 +5,14 @@ from enum import Enum
 
 from moatless.index import CodeIndex
 
-from src.index.service import get_or_create_index
+from src.index.service import index_cache
 from rtfs.summarize.summarize import Summarizer
+from rtfs.summarize.cache import SummaryCache
 from rtfs.transforms.cluster import cluster
 from rtfs.chunk_resolution.chunk_graph import ChunkGraph
 from rtfs.aider_graph.aider_graph import AiderGraph
 from src.utils import rm_tree
+from src.config import CLUSTER_ALG, CLUSTER_HIERARCHICAL, SUMMARY_CACHE_ROOT
 
 from logging import getLogger
 
@@ -45,6 +47,8 @@ def get_or_create_chunk_graph(
             elif type == GraphType.AIDER:
                 cg = AiderGraph.from_chunks(repo_path, nodes)
 
+            # Saved clustered, so later cluster() calls on the loaded graph are no-ops
+            cluster(cg, CLUSTER_ALG, hierarchical=CLUSTER_HIERARCHICAL)
             with open(graph_path, "w") as f:
                 json.dump(cg.to_json(), f)
 
@@ -62,14 +66,17 @@ def summarize(
     repo_path: str,
     graph_path: str,
     graph_type: GraphType = GraphType.STANDARD,
+    user: str = None,
 ):
-    code_index = get_or_create_index(repo_path, index_path)
-    cg = get_or_create_chunk_graph(code_index, repo_path, graph_path, graph_type)
+    with index_cache.use(repo_path, index_path) as code_index:
+        cg = get_or_create_chunk_graph(code_index, repo_path, graph_path, graph_type)
 
-    cluster(cg)
+    cluster(cg, CLUSTER_ALG, hierarchical=CLUSTER_HIERARCHICAL)
 
     # TODO: move summarizer to ClusterGraph
-    summarizer = Summarizer(cg)
+    summarizer = Summarizer(
+        cg, summary_cache=SummaryCache(SUMMARY_CACHE_ROOT), user=user
+    )
     summarizer.summarize()
     summarizer.gen_categories()
 
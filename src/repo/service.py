@@ -1,5 +1,6 @@
 from src.auth.models import User
 from src.utils import rm_tree
+from src.index.service import index_cache
 
 from .repository import GitRepo
 from .models import Repo
@@ -53,6 +54,7 @@ def delete(*, db_session, curr_user: User, owner: str, repo_name: str) -> Repo:
                 rm_tree(g)
 
             rm_tree(repo.index_path)
+            index_cache.invalidate(repo.index_path)
             if repo.summary_path:
                 rm_tree(repo.summary_path)
 
@@ -1,5 +1,5 @@
 from src.queue.models import Task, TaskType
-from src.index.service import get_or_create_index
+from src.index.service import index_cache
 import json
 
 from .graph import get_or_create_chunk_graph, GraphType
@@ -16,10 +16,12 @@ class InitIndexGraphTask(Task):
         save_graph_path,
         graph_type=GraphType.STANDARD
     ):
-        code_index = get_or_create_index(
-            str(repo_dst),
-            str(index_persist_dir),
-        )
-        return get_or_create_chunk_graph(
-            code_index, repo_dst, save_graph_path, graph_type
-        )
+        """
+        Runs in a worker process, so returns the chunk files instead of the graph,
+        which is saved clustered to save_graph_path
+        """
+        with index_cache.use(str(repo_dst), str(index_persist_dir)) as code_index:
+            cg = get_or_create_chunk_graph(
+                code_index, repo_dst, save_graph_path, graph_type
+            )
+        return cg.get_chunk_files()
@@ -5,15 +5,23 @@ from src.auth.service import get_current_user
 from src.auth.models import User
 from src.queue.core import get_queue, TaskQueue
 from src.queue.models import TaskResponse
-from src.index.service import get_or_create_index
+from src.index.service import index_cache
 from src.queue.service import enqueue_task, enqueue_task_and_wait
 from src.exceptions import ClientActionException
 from src.models import HTTPSuccess
-from src.config import REPOS_ROOT, INDEX_ROOT, GRAPH_ROOT, ENV
+from src.config import (
+    REPOS_ROOT,
+    INDEX_ROOT,
+    GRAPH_ROOT,
+    ENV,
+    CLUSTER_ALG,
+    CLUSTER_HIERARCHICAL,
+    SUMMARY_CACHE_ROOT,
+)
 
 from rtfs.summarize.summarize import Summarizer
+from rtfs.summarize.cache import SummaryCache
 from rtfs.transforms.cluster import cluster
-from rtfs.cluster.graph import ClusterGraph
 
 from .service import list_repos, delete, get_repo
 from .repository import GitRepo, PrivateRepoError, RepoSizeExceededError
@@ -95,10 +103,12 @@ async def create_repo(
                 "save_graph_path": save_graph_path,
             }
         )
-        cg: ClusterGraph = enqueue_task_and_wait(
-            task_queue=task_queue, user_id=curr_user.id, task=task
+        cluster_files = await enqueue_task_and_wait(
+            task_queue=task_queue,
+            user_id=curr_user.id,
+            user_email=curr_user.email,
+            task=task,
         )
-        cluster(cg)
 
         # TODO: should maybe turn this into task as well
         # would need asyncSession to perform db_updates though
@@ -111,7 +121,7 @@ async def create_repo(
             index_path=str(index_persist_dir),
             graph_path=str(save_graph_path),
             users=[curr_user],
-            cluster_files=cg.get_chunk_files(),
+            cluster_files=cluster_files,
         )
 
         db_session.add(repo)
@@ -207,13 +217,17 @@ async def summarize_repo(
             return json.loads(f.read())
 
     # summarization logic
-    code_index = get_or_create_index(repo.file_path, repo.index_path)
-    cg = get_or_create_chunk_graph(
-        code_index, repo.file_path, repo.graph_path, request.graph_type
-    )
-    cluster(cg)
+    with index_cache.use(repo.file_path, repo.index_path) as code_index:
+        cg = get_or_create_chunk_graph(
+            code_index, repo.file_path, repo.graph_path, request.graph_type
+        )
+    cluster(cg, CLUSTER_ALG, hierarchical=CLUSTER_HIERARCHICAL)
 
-    summarizer = Summarizer(cg)
+    summarizer = Summarizer(
+        cg,
+        summary_cache=SummaryCache(SUMMARY_CACHE_ROOT),
+        user=current_user.email,
+    )
     # try:
     summarizer.summarize()
     summarizer.gen_categories()
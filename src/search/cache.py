@@ -0,0 +1,146 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, List, Optional
+
+from llama_index.core.base.embeddings.base import BaseEmbedding, Embedding
+from llama_index.core.bridge.pydantic import PrivateAttr
+
+from src.config import (
+    EMBEDDING_CACHE_SIZE,
+    EMBEDDING_CACHE_TTL,
+    SEARCH_CACHE_SIZE,
+    SEARCH_CACHE_TTL,
+)
+
+
+def normalize_query(query: str) -> str:
+    """
+    Queries that only differ in case or whitespace share cache entries
+    """
+    return re.sub(r"\s+", " ", query).strip().lower()
+
+
+class TTLCache:
+    """
+    In-memory LRU cache whose entries expire ttl seconds after they were added
+    """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: Hashable, value: Any):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class CachedEmbedding(BaseEmbedding):
+    """
+    Embedding model that serves query embeddings from cache, keyed by the model and
+    the normalized query. Text embeddings for ingestion go straight to the model
+    """
+
+    _embed_model: BaseEmbedding = PrivateAttr()
+    _cache: TTLCache = PrivateAttr()
+
+    def __init__(self, embed_model: BaseEmbedding, cache: TTLCache, **kwargs):
+        super().__init__(
+            model_name=embed_model.model_name,
+            embed_batch_size=embed_model.embed_batch_size,
+            **kwargs,
+        )
+        self._embed_model = embed_model
+        self._cache = cache
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    def _key(self, query: str):
+        return (self.model_name, normalize_query(query))
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        key = self._key(query)
+        embedding = self._cache.get(key)
+        if embedding is None:
+            embedding = self._embed_model.get_query_embedding(query)
+            self._cache.put(key, embedding)
+        return embedding
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        key = self._key(query)
+        embedding = self._cache.get(key)
+        if embedding is None:
+            embedding = await self._embed_model.aget_query_embedding(query)
+            self._cache.put(key, embedding)
+        return embedding
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        return self._embed_model.get_text_embedding(text)
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        return self._embed_model.get_text_embedding_batch(texts)
+
+    async def _aget_text_embedding(self, text: str) -> Embedding:
+        return await self._embed_model.aget_text_embedding(text)
+
+
+embedding_cache = TTLCache(EMBEDDING_CACHE_SIZE, EMBEDDING_CACHE_TTL)
+
+# Search responses keyed by (index version, normalized query, store type)
+search_cache = TTLCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+
+
+def cache_query_embeddings(code_index):
+    """
+    Swaps the embedding model of code_index for one that caches query embeddings
+    """
+    embed_model = getattr(code_index, "_embed_model", None)
+    if embed_model is not None and not isinstance(embed_model, CachedEmbedding):
+        code_index._embed_model = CachedEmbedding(embed_model, embedding_cache)
+
+
+def cached_search(
+    code_index,
+    query: str,
+    store_type,
+    index_version: Optional[str],
+    search: Optional[Callable[[], Any]] = None,
+):
+    """
+    code_index.search, or search if given, served from search_cache for the same
+    version of the index
+    """
+    if search is None:
+        search = lambda: code_index.search(query, store_type=store_type)
+    if index_version is None:
+        return search()
+
+    key = (index_version, normalize_query(query), store_type)
+    results = search_cache.get(key)
+    if results is None:
+        results = search()
+        search_cache.put(key, results)
+    return results
@@ -0,0 +1,62 @@
+import json
+import os
+from typing import Dict, List, Optional
+
+from moatless.index.types import SearchCodeResponse
+
+from rtfs.chunk_resolution.retrieval import GraphRetriever, RetrievedChunk
+from src.config import (
+    GRAPH_RETRIEVAL_DEPTH,
+    GRAPH_RETRIEVER_CACHE_SIZE,
+    SEARCH_CONTEXT_MAX_TOKENS,
+)
+from src.repo.graph import GraphType
+
+from .cache import TTLCache
+
+# Number of top search hits the graph is walked from
+SEED_HITS = 4
+
+# Retrievers keyed by the path and modification time of their graph, so a rebuilt
+# graph gets a new one. Entries don't expire, they are only evicted for new graphs
+graph_retriever_cache = TTLCache(GRAPH_RETRIEVER_CACHE_SIZE, float("inf"))
+
+
+def get_graph_retriever(graph_path: Optional[str]) -> Optional[GraphRetriever]:
+    """
+    Retriever for the chunk graph saved at graph_path, or None if the graph wasn't
+    built yet
+    """
+    if not graph_path:
+        return None
+
+    path = f"{graph_path}_{GraphType.STANDARD}.json"
+    try:
+        key = (path, os.stat(path).st_mtime_ns)
+    except FileNotFoundError:
+        return None
+
+    retriever = graph_retriever_cache.get(key)
+    if retriever is None:
+        with open(path, "r") as f:
+            retriever = GraphRetriever.from_json(json.load(f))
+        graph_retriever_cache.put(key, retriever)
+    return retriever
+
+
+def expand_hits(
+    results: SearchCodeResponse, retriever: GraphRetriever
+) -> List[RetrievedChunk]:
+    """
+    Chunks of the top hits and the chunks related to them through calls, imports
+    and clusters, the most relevant first, within SEARCH_CONTEXT_MAX_TOKENS
+    """
+    seeds: Dict[str, float] = {}
+    for rank, hit in enumerate(results.hits[:SEED_HITS]):
+        for span in hit.spans:
+            for chunk_id in retriever.chunks_for_span(hit.file_path, span.span_id):
+                seeds[chunk_id] = max(seeds.get(chunk_id, 0.0), 1 / (rank + 1))
+
+    return retriever.retrieve(
+        seeds, max_depth=GRAPH_RETRIEVAL_DEPTH, max_tokens=SEARCH_CONTEXT_MAX_TOKENS
+    )
@@ -0,0 +1,111 @@
+import re
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from moatless.index import CodeIndex
+from moatless.index.simple_faiss import VectorStoreType
+from moatless.index.types import SearchCodeHit, SearchCodeResponse, SpanHit
+
+from .lexical import LexicalDoc
+
+# Dampens the weight of the top ranks in reciprocal rank fusion, 60 is the value
+# from the original paper
+RRF_K = 60
+MAX_SPANS = 50
+
+# Search cache key for fused results, alongside the vector store types
+HYBRID = "hybrid"
+
+IDENTIFIER_WORD = re.compile(r"`?[A-Za-z_][\w.]*(\(\))?`?")
+
+# (file path, span id), span id is None for chunks that span a whole file
+SpanKey = Tuple[str, Optional[str]]
+
+
+def is_identifier_query(query: str) -> bool:
+    """
+    Queries made up only of identifiers, like "import_to_export_scope" or
+    "`RepoGraph.scopes_map`", which the lexical index answers without embedding
+    """
+    words = query.split()
+    return bool(words) and all(_is_identifier(word) for word in words)
+
+
+def _is_identifier(word: str) -> bool:
+    if not IDENTIFIER_WORD.fullmatch(word):
+        return False
+    return bool(
+        word.startswith("`")
+        or word.endswith("()")
+        or "_" in word
+        or "." in word
+        or re.search(r"[a-z][A-Z]", word)
+    )
+
+
+def vector_ranking(response: SearchCodeResponse) -> List[SpanKey]:
+    ranking = []
+    for hit in response.hits:
+        if not hit.spans:
+            ranking.append((hit.file_path, None))
+        for span in hit.spans:
+            ranking.append((hit.file_path, span.span_id))
+    return ranking
+
+
+def lexical_ranking(results: List[Tuple[LexicalDoc, float]]) -> List[SpanKey]:
+    ranking = []
+    for doc, _ in results:
+        if not doc.span_ids:
+            ranking.append((doc.file_path, None))
+        for span_id in doc.span_ids:
+            ranking.append((doc.file_path, span_id))
+    return ranking
+
+
+def reciprocal_rank_fusion(
+    rankings: List[List[SpanKey]], k: int = RRF_K
+) -> List[SpanKey]:
+    """
+    Orders spans by the sum of 1 / (k + rank) over the rankings they appear in, so
+    spans ranked well by both searches come first without comparing their scores
+    """
+    scores: Dict[SpanKey, float] = defaultdict(float)
+    for ranking in rankings:
+        seen = set()
+        for key in ranking:
+            if key in seen:
+                continue
+            seen.add(key)
+            scores[key] += 1 / (k + len(seen))
+
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+def to_response(ranking: List[SpanKey]) -> SearchCodeResponse:
+    """
+    Groups the ranked spans by file, files ordered by their best span
+    """
+    hits: Dict[str, SearchCodeHit] = {}
+    for rank, (file_path, span_id) in enumerate(ranking[:MAX_SPANS]):
+        hit = hits.setdefault(file_path, SearchCodeHit(file_path=file_path, spans=[]))
+        if span_id:
+            hit.spans.append(SpanHit(span_id=span_id, rank=rank))
+    return SearchCodeResponse(hits=list(hits.values()))
+
+
+def hybrid_search(code_index: CodeIndex, query: str) -> SearchCodeResponse:
+    """
+    Code search fusing the lexical and vector hits with reciprocal rank fusion.
+    Identifier queries with lexical hits skip the vector search
+    """
+    lexical_index = getattr(code_index, "lexical_index", None)
+    if lexical_index is None:
+        return code_index.search(query, store_type=VectorStoreType.CODE)
+
+    lexical = lexical_ranking(lexical_index.search(query))
+    if lexical and is_identifier_query(query):
+        return to_response(reciprocal_rank_fusion([lexical]))
+
+    vector = vector_ranking(code_index.search(query, store_type=VectorStoreType.CODE))
+    return to_response(reciprocal_rank_fusion([vector, lexical]))
@@ -0,0 +1,252 @@
+import json
+import math
+import os
+import re
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from logging import getLogger
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from llama_index.core.schema import BaseNode
+
+from rtfs.build_scopes import build_scope_graph
+from rtfs.config import LANGUAGE
+from rtfs.fs import RepoFs
+
+logger = getLogger(__name__)
+
+LEXICAL_INDEX_FILE = "lexical_index.json"
+# Bump when tokenization changes so persisted indexes are rebuilt
+LEXICAL_INDEX_VERSION = 1
+
+IDENTIFIER = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+IDENTIFIER_PART = re.compile(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+")
+
+# Identifiers defined in a chunk count this many times over identifiers it uses
+SYMBOL_WEIGHT = 3
+
+# Query words that don't say anything about the code being searched for
+STOPWORDS = set(
+    "a an and are as at be by code does do for from how in is it of on or show the "
+    "this to used uses what when where which who why with".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Identifiers in text, lowercased, followed by their snake_case and camelCase
+    parts, so both import_to_export_scope and "export scope" match it
+    """
+    tokens = []
+    for identifier in IDENTIFIER.findall(text):
+        tokens.append(identifier.lower())
+        parts = IDENTIFIER_PART.findall(identifier)
+        if len(parts) > 1:
+            tokens.extend(part.lower() for part in parts)
+    return tokens
+
+
+def trigrams(term: str) -> Set[str]:
+    padded = f"  {term} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+def symbols_by_file(repo_path: str) -> Dict[str, List[Tuple[str, int]]]:
+    """
+    Names and lines of the classes and functions defined in each file of the repo,
+    from the same scope graphs RepoGraph resolves imports with. Files that fail to
+    parse are skipped
+    """
+    symbols = {}
+    for path, content in RepoFs(Path(repo_path)).get_files_content():
+        try:
+            scope_graph = build_scope_graph(content, language=LANGUAGE)
+        except Exception as e:
+            logger.warning(f"Failed to parse {path} for symbols: {e}")
+            continue
+
+        symbols[str(path)] = [
+            (definition.name, definition.range.start_point.row + 1)
+            for scope in scope_graph.scopes()
+            for definition in scope_graph.definitions(scope)
+            if definition.data.get("def_type") in ("class", "function")
+        ]
+    return symbols
+
+
+@dataclass
+class LexicalDoc:
+    node_id: str
+    file_path: str
+    span_ids: List[str]
+    terms: Dict[str, int]
+    length: int = field(init=False)
+
+    def __post_init__(self):
+        self.length = sum(self.terms.values())
+
+
+class LexicalIndex:
+    """
+    BM25 inverted index over the identifiers in the chunks of a repo. Query terms
+    that aren't in the index are matched to indexed terms sharing most of their
+    trigrams, which catches misspelled and partial identifiers
+    """
+
+    K1 = 1.2
+    B = 0.75
+    # Min Jaccard similarity of trigrams for a term to stand in for a query term
+    MIN_TRIGRAM_SIMILARITY = 0.5
+    MAX_EXPANSIONS = 3
+
+    def __init__(self, docs: List[LexicalDoc]):
+        self.docs = docs
+        self.avg_length = sum(doc.length for doc in docs) / len(docs) if docs else 0
+
+        self._postings: Dict[str, Dict[int, int]] = defaultdict(dict)
+        for i, doc in enumerate(docs):
+            for term, tf in doc.terms.items():
+                self._postings[term][i] = tf
+
+        self._trigrams: Dict[str, Set[str]] = defaultdict(set)
+        for term in self._postings:
+            for trigram in trigrams(term):
+                self._trigrams[trigram].add(term)
+
+    @classmethod
+    def from_nodes(
+        cls,
+        nodes: Iterable[BaseNode],
+        repo_path: str,
+        symbols: Optional[Dict[str, List[Tuple[str, int]]]] = None,
+    ) -> "LexicalIndex":
+        """
+        Indexes the text, span ids and file path of each node, and the symbols
+        defined within its lines
+        """
+        symbols = symbols or {}
+
+        docs = []
+        for node in nodes:
+            file_path = node.metadata.get("file_path", "")
+            span_ids = node.metadata.get("span_ids", [])
+
+            terms = Counter(tokenize(node.get_content()))
+            terms.update(tokenize(file_path))
+
+            defined = [span_id.split(".")[-1] for span_id in span_ids]
+            start_line = node.metadata.get("start_line", 0)
+            end_line = node.metadata.get("end_line", math.inf)
+            rel_path = (
+                os.path.relpath(file_path, repo_path)
+                if os.path.isabs(file_path)
+                else file_path
+            )
+            defined.extend(
+                name
+                for name, line in symbols.get(rel_path, [])
+                if start_line <= line <= end_line
+            )
+            for token in tokenize(" ".join(defined)):
+                terms[token] += SYMBOL_WEIGHT
+
+            docs.append(LexicalDoc(node.node_id, file_path, span_ids, dict(terms)))
+
+        return cls(docs)
+
+    def search(self, query: str, top_k: int = 50) -> List[Tuple[LexicalDoc, float]]:
+        """
+        Docs matching the query by descending BM25 score
+        """
+        weights: Dict[str, float] = defaultdict(float)
+        for token in tokenize(query):
+            if token in STOPWORDS:
+                continue
+            for term, weight in self._expand(token):
+                weights[term] = max(weights[term], weight)
+
+        scores: Dict[int, float] = defaultdict(float)
+        for term, weight in weights.items():
+            postings = self._postings.get(term, {})
+            idf = math.log(
+                1 + (len(self.docs) - len(postings) + 0.5) / (len(postings) + 0.5)
+            )
+            for i, tf in postings.items():
+                norm = self.K1 * (
+                    1 - self.B + self.B * self.docs[i].length / self.avg_length
+                )
+                scores[i] += weight * idf * tf * (self.K1 + 1) / (tf + norm)
+
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        return [(self.docs[i], score) for i, score in ranked[:top_k]]
+
+    def _expand(self, token: str) -> List[Tuple[str, float]]:
+        if token in self._postings:
+            return [(token, 1.0)]
+
+        token_trigrams = trigrams(token)
+        shared = Counter(
+            term
+            for trigram in token_trigrams
+            for term in self._trigrams.get(trigram, ())
+        )
+        candidates = []
+        for term, count in shared.items():
+            similarity = count / (len(token_trigrams) + len(trigrams(term)) - count)
+            if similarity >= self.MIN_TRIGRAM_SIMILARITY:
+                candidates.append((term, similarity))
+
+        candidates.sort(key=lambda item: item[1], reverse=True)
+        return candidates[: self.MAX_EXPANSIONS]
+
+    def persist(self, path: str):
+        data = {
+            "version": LEXICAL_INDEX_VERSION,
+            "docs": [
+                {
+                    "node_id": doc.node_id,
+                    "file_path": doc.file_path,
+                    "span_ids": doc.span_ids,
+                    "terms": doc.terms,
+                }
+                for doc in self.docs
+            ],
+        }
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def from_persist_path(cls, path: str) -> Optional["LexicalIndex"]:
+        """
+        Persisted index, or None if it is missing or from an older version
+        """
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+
+        if data.get("version") != LEXICAL_INDEX_VERSION:
+            return None
+        return cls([LexicalDoc(**doc) for doc in data["docs"]])
+
+
+def load_or_create_lexical_index(
+    code_index, repo_path: str, persist_dir: str
+) -> LexicalIndex:
+    """
+    Loads the lexical index persisted next to code_index, building it from the
+    chunks in the docstore for new or outdated indexes
+    """
+    path = os.path.join(persist_dir, LEXICAL_INDEX_FILE)
+    lexical_index = LexicalIndex.from_persist_path(path)
+    if lexical_index is None:
+        lexical_index = LexicalIndex.from_nodes(
+            code_index._docstore.docs.values(), repo_path, symbols_by_file(repo_path)
+        )
+        lexical_index.persist(path)
+        logger.info(f"Built lexical index of {len(lexical_index.docs)} chunks")
+    return lexical_index
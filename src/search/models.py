@@ -4,6 +4,8 @@ from typing import List, Optional
 class SearchRequest(BaseModel):
     repo_name: str
     query: str
+    # Stream the answer as server-sent events instead of a single JSON response
+    stream: bool = False
 
 class SpanInfo(BaseModel):
     span_id: str
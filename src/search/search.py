@@ -6,9 +6,14 @@ from moatless.codeblocks.module import Module
 from moatless.file_context import FileContext
 
 from src.oai import OpenAIModel
+from src.search.cache import cached_search
+from src.search.hybrid import HYBRID, hybrid_search
+from src.search.graph import expand_hits
+from rtfs.chunk_resolution.retrieval import GraphRetriever
 from src.config import REPOS_ROOT, INDEX_ROOT, SUMMARIES_ROOT
 
 from pathlib import Path
+from typing import AsyncIterator, Optional
 import os
 import json
 
@@ -25,7 +30,7 @@ queries = [
 ]
 
 
-async def answer(query, code_context):
+def answer_prompt(query, code_context):
     good_prompt = """
 You are an AI assistant tasked with answering queries about a codebase using provided code contexts. Your goal is to provide a clear, concise, and unified response that directly addresses the query.
 
@@ -60,11 +65,21 @@ Start your first sentence by responding to the query directly
     # Now give an answer to the query based on the code_context provided
     # """.format(query=query, code_context=code_context)
 
-    model = OpenAIModel()
-    res = await model.query(good_prompt)
+    return good_prompt
+
+
+async def answer(query, code_context, user=None):
+    model = OpenAIModel(user=user)
+    res = await model.query(answer_prompt(query, code_context))
     return res
 
 
+async def answer_stream(query, code_context, user=None) -> AsyncIterator[str]:
+    model = OpenAIModel(user=user)
+    async for delta in model.query_stream(answer_prompt(query, code_context)):
+        yield delta
+
+
 def read_cluster_file(cluster_file):
     if not cluster_file:
         return {}
@@ -97,8 +112,30 @@ def persist_code_index(file_repo, persist_dir, cluster_json):
     return code_index
 
 
-def search_code(query: str, code_index: CodeIndex, workspace: Workspace) -> FileContext:
-    code_results = code_index.search(query, store_type=VectorStoreType.CODE)
+def search_code(
+    query: str,
+    code_index: CodeIndex,
+    workspace: Workspace,
+    index_version: Optional[str] = None,
+    retriever: Optional[GraphRetriever] = None,
+) -> FileContext:
+    code_results = cached_search(
+        code_index,
+        query,
+        HYBRID,
+        index_version,
+        search=lambda: hybrid_search(code_index, query),
+    )
+
+    # Only the spans of the hits and the chunks related to them in the chunk graph,
+    # instead of every span of every hit
+    chunks = expand_hits(code_results, retriever) if retriever else []
+    if chunks:
+        file_context = workspace.create_file_context()
+        for chunk in chunks:
+            for span_id in chunk.span_ids:
+                file_context.add_span_to_context(chunk.file_path, span_id)
+        return file_context.get_contexts().items()
     file_context = workspace.create_file_context(files_with_spans=code_results.hits)
 
     # Uncomment and modify as needed
@@ -120,8 +157,15 @@ def search_code(query: str, code_index: CodeIndex, workspace: Workspace) -> File
     return file_context.get_contexts().items()
 
 
-def search_cluster(query: str, code_index: CodeIndex, workspace: Workspace):
-    cluster_results = code_index.search(query, store_type=VectorStoreType.CLUSTER)
+def search_cluster(
+    query: str,
+    code_index: CodeIndex,
+    workspace: Workspace,
+    index_version: Optional[str] = None,
+):
+    cluster_results = cached_search(
+        code_index, query, VectorStoreType.CLUSTER, index_version
+    )
     file_context = workspace.create_file_context(files_with_spans=cluster_results.hits)
 
     for hit in cluster_results.hits:
@@ -1,11 +1,14 @@
-from fastapi import APIRouter, Depends
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import JSONResponse, StreamingResponse
 from sqlalchemy.orm import Session
-from typing import List
+from starlette.concurrency import run_in_threadpool
+from typing import AsyncIterator, List, Optional
+import json
+import logging
 import os
 
 from .models import SearchRequest, SearchResponse, SearchResult, FileContext, SpanInfo
-from .search import search_code, search_cluster, answer
+from .search import search_code, search_cluster, answer, answer_stream
 
 from src.database.core import get_db
 from src.auth.service import get_current_user
@@ -14,7 +17,10 @@ from src.repo.service import get_no_auth
 from src.config import REPOS_ROOT, INDEX_ROOT
 from moatless import FileRepository
 from moatless.workspace import Workspace
-from src.index import get_or_create_index
+from src.index.service import index_cache
+from src.search.graph import get_graph_retriever
+
+logger = logging.getLogger(__name__)
 
 search_router = APIRouter()
 
@@ -30,15 +36,66 @@ async def search(
     if not repo:
         raise HTTPException(status_code=404, detail="Repository not found")
 
+    if request.stream:
+        return StreamingResponse(
+            stream_answer(request, current_user.email, repo.graph_path),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    # Loads the index and embeds the query, off the event loop
+    result = await run_in_threadpool(search_context, request, repo.graph_path)
+    a = await answer(request.query, result, user=current_user.email)
+
+    # search_result = SearchResult(
+    #     code_results=format_results(code_results),
+    #     # cluster_results=format_results(cluster_results)
+    # )
+
+    return JSONResponse(content={"answer": a})
+
+
+async def stream_answer(
+    request: SearchRequest, user: str, graph_path: Optional[str] = None
+) -> AsyncIterator[str]:
+    """
+    Streams the answer as server-sent events: a data event per delta, then a done
+    event, or an error event if the answer failed midway
+    """
+    # Send the headers before searching, so the first byte doesn't wait on it
+    yield ": searching\n\n"
+
+    try:
+        result = await run_in_threadpool(search_context, request, graph_path)
+        async for delta in answer_stream(request.query, result, user=user):
+            yield f"data: {json.dumps({'delta': delta})}\n\n"
+    except Exception:
+        # Details stay in the logs, errors can contain paths and keys
+        logger.exception(f"Failed to stream answer for {request.repo_name}")
+        detail = "Failed to generate answer"
+        yield f"event: error\ndata: {json.dumps({'detail': detail})}\n\n"
+        return
+
+    yield "event: done\ndata: {}\n\n"
+
+
+def search_context(request: SearchRequest, graph_path: Optional[str] = None) -> str:
     # Set up the search environment
     repo_dir = os.path.join(REPOS_ROOT, request.repo_name)
     persist_dir = os.path.join(INDEX_ROOT, request.repo_name)
     file_repo = FileRepository(repo_path=repo_dir)
-    code_index = get_or_create_index(request.repo_name, {})
-    workspace = Workspace(file_repo=file_repo, code_index=code_index)
+    with index_cache.use(repo_dir, persist_dir) as code_index:
+        workspace = Workspace(file_repo=file_repo, code_index=code_index)
 
-    # Perform the search
-    code_results = search_code(request.query, code_index, workspace)
+        # Perform the search, cached per version of the index
+        index_version = index_cache.version(code_index)
+        code_results = search_code(
+            request.query,
+            code_index,
+            workspace,
+            index_version=index_version,
+            retriever=get_graph_retriever(graph_path),
+        )
     # cluster_results = search_cluster(request.query, code_index, workspace)
 
     # Format the results
@@ -52,15 +109,7 @@ async def search(
             #     print(span)
         return span_set
 
-    result = format_results(code_results)
-    a = await answer(request.query, result)
-
-    # search_result = SearchResult(
-    #     code_results=format_results(code_results),
-    #     # cluster_results=format_results(cluster_results)
-    # )
-
-    return JSONResponse(content={"answer": a})
+    return format_results(code_results)
 
 
 # Don't forget to include this router in your main FastAPI app
@@ -0,0 +1,32 @@
+from rtfs.moatless.codeblocks import CodeBlock, CodeBlockType
+from rtfs.moatless.parser.python import PythonParser
+
+SOURCE = """
+class Square:
+    def __init__(self, side):
+        self.side = side
+
+    def area(self):
+        return self.side * self.side
+"""
+
+
+def test_assigning_fields_does_not_grow_fields_set():
+    block = CodeBlock.construct_block(type=CodeBlockType.CODE, content="x = 1")
+    fields_set = set(block.model_fields_set)
+
+    block.identifier = "x"
+    block.next = CodeBlock.construct_block(type=CodeBlockType.CODE, content="y = 2")
+
+    assert block.identifier == "x"
+    assert block.next.content == "y = 2"
+    assert block.model_fields_set == fields_set
+
+
+def test_parsed_module_is_indexed():
+    module = PythonParser().parse(SOURCE, file_path="square.py")
+    module.build_index()
+
+    area = module.find_by_path(["Square", "area"])
+    assert area.parent.identifier == "Square"
+    assert module.find_first_by_start_line(area.start_line) is area
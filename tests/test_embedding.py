@@ -0,0 +1,122 @@
+import sys
+from types import SimpleNamespace
+from typing import List
+
+import pytest
+from llama_index.core.bridge.pydantic import Field
+
+from src.index.embedding import (
+    HASH_MODEL,
+    TOKENIZER_MODEL,
+    BatchedEmbedding,
+    BatchSizeTuner,
+    LocalEmbedding,
+    tokenizer_model,
+)
+
+
+class LimitedEmbedding(BatchedEmbedding):
+    """
+    Embeds each text as its length, running out of memory on batches of more than
+    limit texts
+    """
+
+    limit: int = 4
+    batch_sizes: List[int] = Field(default_factory=list)
+
+    def _embed(self, texts):
+        self.batch_sizes.append(len(texts))
+        if len(texts) > self.limit:
+            raise MemoryError
+        return [[float(len(text))] for text in texts]
+
+
+def expected(texts):
+    return [[float(len(text))] for text in texts]
+
+
+def test_shrink_halves_batch_size():
+    tuner = BatchSizeTuner(batch_size=16, max_batch_size=64)
+
+    tuner.shrink(16)
+    assert tuner.batch_size == tuner.max_batch_size == 8
+
+    # Another batch of 16 failing concurrently does not halve it again
+    tuner.shrink(16)
+    assert tuner.batch_size == 8
+
+
+def test_shrink_single_text_raises():
+    with pytest.raises(MemoryError):
+        BatchSizeTuner(batch_size=1).shrink(1)
+
+
+def test_oversized_batch_is_split_and_embedded_again():
+    model = LimitedEmbedding(limit=4, max_batch_size=16)
+    model._tuner.batch_size = 16
+    texts = ["x" * i for i in range(16)]
+
+    assert model._embed_or_split(texts) == expected(texts)
+    assert model._tuner.batch_size == 4
+    # The second half is split at the batch size lowered by the first
+    assert model.batch_sizes == [16, 8, 4, 4, 8, 4, 4]
+
+
+def test_embeddings_keep_order_after_running_out_of_memory():
+    model = LimitedEmbedding(limit=4, num_threads=2, max_batch_size=16)
+    texts = ["x" * i for i in range(50)]
+
+    assert model.get_text_embedding_batch(texts) == expected(texts)
+    assert model._tuner.tuned
+    assert model._tuner.batch_size == 4
+
+
+class FakeSentenceTransformer:
+    def __init__(self, model_name, device):
+        self.error = None
+
+    def encode(self, texts, **kwargs):
+        if len(texts) > 1 and self.error:
+            raise RuntimeError(self.error)
+        return SimpleNamespace(tolist=lambda: expected(texts))
+
+
+@pytest.fixture
+def local_model(monkeypatch):
+    monkeypatch.setitem(
+        sys.modules,
+        "sentence_transformers",
+        SimpleNamespace(SentenceTransformer=FakeSentenceTransformer),
+    )
+    return LocalEmbedding("fake")
+
+
+def test_local_embedding_splits_batch_on_torch_out_of_memory(local_model):
+    local_model._model.error = (
+        "[enforce fail at alloc_cpu.cpp:114] . DefaultCPUAllocator: can't allocate "
+        "memory: you tried to allocate 1073741824 bytes. Error code 12 (Cannot "
+        "allocate memory)"
+    )
+    texts = ["a", "bb"]
+
+    assert local_model._embed_or_split(texts) == expected(texts)
+    assert local_model._tuner.batch_size == 1
+
+
+def test_local_embedding_raises_other_errors(local_model):
+    local_model._model.error = "Expected all tensors to be on the same device"
+
+    with pytest.raises(RuntimeError):
+        local_model._embed_or_split(["a", "bb"])
+
+
+@pytest.mark.parametrize(
+    "embed_model, expected_model",
+    [
+        ("text-embedding-3-large", "text-embedding-3-large"),
+        ("local:all-MiniLM-L6-v2", TOKENIZER_MODEL),
+        (HASH_MODEL, TOKENIZER_MODEL),
+    ],
+)
+def test_tokenizer_model(embed_model, expected_model):
+    assert tokenizer_model(embed_model) == expected_model
@@ -0,0 +1,76 @@
+import random
+
+import pytest
+
+from rtfs.moatless.codeblocks import CodeBlock, CodeBlockType
+from rtfs.moatless.epic_split import EpicSplitter, count_chunk_tokens
+from rtfs.moatless.settings import MergeStrategy
+
+
+def random_chunks(rng: random.Random):
+    chunks = []
+    for i in range(rng.randint(1, 300)):
+        chunk = []
+        for j in range(rng.randint(1, 4)):
+            chunk.append(
+                CodeBlock(
+                    type=CodeBlockType.CODE,
+                    identifier=f"block_{i}_{j}",
+                    content="",
+                    tokens=rng.choice([1, 5, 20, 80, 300, 900]),
+                )
+            )
+        chunks.append(chunk)
+    return chunks
+
+
+def boundaries(chunks):
+    ends = set()
+    position = 0
+    for chunk in chunks:
+        position += len(chunk)
+        ends.add(position)
+    return ends
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_greedy_merge_matches_legacy_guarantees(seed):
+    rng = random.Random(seed)
+    chunks = random_chunks(rng)
+    settings = dict(
+        min_chunk_size=rng.choice([50, 100, 256]),
+        hard_token_limit=rng.choice([1000, 2000, 6000]),
+        max_chunks=rng.choice([5, 50, 200]),
+    )
+
+    legacy = EpicSplitter(merge_strategy=MergeStrategy.LEGACY, **settings)
+    greedy = EpicSplitter(merge_strategy=MergeStrategy.GREEDY, **settings)
+
+    legacy_chunks = legacy._merge_chunks([list(chunk) for chunk in chunks])
+    greedy_chunks = greedy._merge_chunks([list(chunk) for chunk in chunks])
+
+    flattened = [block for chunk in chunks for block in chunk]
+    assert [b for chunk in greedy_chunks for b in chunk] == flattened
+    assert [b for chunk in legacy_chunks for b in chunk] == flattened
+
+    # Both only merge whole input chunks, so their boundaries are input boundaries
+    assert boundaries(greedy_chunks) <= boundaries(chunks)
+    assert boundaries(legacy_chunks) <= boundaries(chunks)
+
+    assert sum(count_chunk_tokens(c) for c in greedy_chunks) == sum(
+        count_chunk_tokens(c) for c in legacy_chunks
+    )
+
+    largest_input = max(count_chunk_tokens(c) for c in chunks)
+    for chunk in greedy_chunks:
+        tokens = count_chunk_tokens(chunk)
+        assert tokens <= max(settings["hard_token_limit"], largest_input)
+
+    # Undersized chunks are only left when merging with a neighbour would exceed the limit
+    tokens = [count_chunk_tokens(c) for c in greedy_chunks]
+    for left, right in zip(tokens, tokens[1:]):
+        if left < settings["min_chunk_size"] or right < settings["min_chunk_size"]:
+            assert left + right > settings["hard_token_limit"]
+
+    if len(legacy_chunks) <= settings["max_chunks"]:
+        assert len(greedy_chunks) <= settings["max_chunks"]
@@ -0,0 +1,81 @@
+import networkx as nx
+import pytest
+
+from rtfs.chunk_resolution.graph import ChunkEdgeKind, ClusterEdgeKind, NodeKind
+from rtfs.chunk_resolution.retrieval import GraphRetriever
+
+
+def add_chunk(graph, chunk_id, tokens=100):
+    graph.add_node(
+        chunk_id,
+        kind=NodeKind.Chunk,
+        metadata={
+            "file_path": f"{chunk_id}.py",
+            "span_ids": [f"{chunk_id}_span"],
+            "tokens": tokens,
+        },
+    )
+
+
+@pytest.fixture
+def retriever():
+    """
+    a calls b calls c calls d, a and e are in cluster k, g is unrelated
+    """
+    graph = nx.MultiDiGraph()
+    for chunk_id in "abcdeg":
+        add_chunk(graph, chunk_id)
+    graph.add_node("k", kind=NodeKind.Cluster)
+
+    for src, dst in ["ab", "bc", "cd"]:
+        graph.add_edge(src, dst, kind=ChunkEdgeKind.CallTo)
+    for chunk_id in "ae":
+        graph.add_edge(chunk_id, "k", kind=ClusterEdgeKind.ChunkToCluster)
+
+    return GraphRetriever(graph)
+
+
+def retrieved_ids(retriever, seeds, **kwargs):
+    return [chunk.id for chunk in retriever.retrieve(seeds, **kwargs)]
+
+
+def test_retrieve_is_bounded_by_depth(retriever):
+    assert set(retrieved_ids(retriever, {"a": 1.0}, max_depth=1)) == {"a", "b", "e"}
+    assert set(retrieved_ids(retriever, {"a": 1.0}, max_depth=2)) == {
+        "a",
+        "b",
+        "c",
+        "e",
+    }
+    assert set(retrieved_ids(retriever, {"a": 1.0}, max_depth=0)) == {"a"}
+
+
+def test_retrieve_ranks_seed_and_closer_chunks_first(retriever):
+    chunks = retriever.retrieve({"a": 1.0}, max_depth=3, max_tokens=10_000)
+
+    assert chunks[0].id == "a"
+    scores = {chunk.id: chunk.score for chunk in chunks}
+    assert scores["b"] > scores["c"] > scores["d"]
+    assert "g" not in scores
+
+
+def test_retrieve_cuts_at_max_tokens(retriever):
+    ranked = retrieved_ids(retriever, {"a": 1.0}, max_depth=3, max_tokens=10_000)
+    cut = retriever.retrieve({"a": 1.0}, max_depth=3, max_tokens=250)
+
+    assert [chunk.id for chunk in cut] == ranked[:2]
+    assert sum(chunk.tokens for chunk in cut) <= 250
+
+
+def test_retrieve_keeps_seed_over_max_tokens(retriever):
+    assert retrieved_ids(retriever, {"a": 1.0}, max_tokens=50) == ["a"]
+
+
+def test_retrieve_ignores_unknown_seeds(retriever):
+    assert retriever.retrieve({"missing": 1.0}) == []
+    assert retriever.retrieve({"a": 0.0}) == []
+
+
+def test_chunks_for_span(retriever):
+    assert retriever.chunks_for_span("b.py", "b_span") == ["b"]
+    assert retriever.chunks_for_span("b.py", "missing") == []
@@ -0,0 +1,109 @@
+import pytest
+from moatless.index.types import SearchCodeHit, SearchCodeResponse, SpanHit
+
+from src.search.hybrid import (
+    hybrid_search,
+    is_identifier_query,
+    reciprocal_rank_fusion,
+    to_response,
+)
+from src.search.lexical import LexicalDoc
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        "import_to_export_scope",
+        "`RepoGraph.scopes_map`",
+        "RepoGraph.scopes_map",
+        "getChunkFiles",
+        "build_scope_graph()",
+        "iter_chunks ChunkGraph.from_chunks",
+    ],
+)
+def test_identifier_queries(query):
+    assert is_identifier_query(query)
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        "",
+        "scope",
+        "how are imports resolved",
+        "where is import_to_export_scope called",
+    ],
+)
+def test_natural_language_queries(query):
+    assert not is_identifier_query(query)
+
+
+def test_rrf_ranks_spans_found_by_both_searches_first():
+    vector = [("a.py", "a"), ("b.py", "b"), ("c.py", "c")]
+    lexical = [("c.py", "c"), ("a.py", "a"), ("d.py", "d")]
+
+    assert reciprocal_rank_fusion([vector, lexical]) == [
+        ("a.py", "a"),
+        ("c.py", "c"),
+        ("b.py", "b"),
+        ("d.py", "d"),
+    ]
+
+
+def test_rrf_counts_a_span_once_per_ranking():
+    repeated = [("a.py", "a"), ("a.py", "a"), ("b.py", "b")]
+
+    # Counted twice, a would outrank b, which is found by both rankings
+    assert reciprocal_rank_fusion([repeated, [("b.py", "b")]]) == [
+        ("b.py", "b"),
+        ("a.py", "a"),
+    ]
+
+
+def test_to_response_groups_spans_by_file():
+    response = to_response([("a.py", "x"), ("b.py", None), ("a.py", "y")])
+
+    assert [hit.file_path for hit in response.hits] == ["a.py", "b.py"]
+    assert [span.span_id for span in response.hits[0].spans] == ["x", "y"]
+    assert response.hits[1].spans == []
+
+
+class FakeLexicalIndex:
+    def search(self, query):
+        return [(LexicalDoc("1", "rtfs/chunker.py", ["iter_chunks"], {}), 1.0)]
+
+
+class FakeCodeIndex:
+    lexical_index = FakeLexicalIndex()
+
+    def __init__(self):
+        self.queries = []
+
+    def search(self, query, store_type=None):
+        self.queries.append(query)
+        return SearchCodeResponse(
+            hits=[
+                SearchCodeHit(
+                    file_path="rtfs/fs.py", spans=[SpanHit(span_id="RepoFs", rank=0)]
+                )
+            ]
+        )
+
+
+def test_identifier_query_skips_vector_search():
+    code_index = FakeCodeIndex()
+    response = hybrid_search(code_index, "iter_chunks")
+
+    assert code_index.queries == []
+    assert [hit.file_path for hit in response.hits] == ["rtfs/chunker.py"]
+
+
+def test_natural_language_query_fuses_both_searches():
+    code_index = FakeCodeIndex()
+    response = hybrid_search(code_index, "how are files chunked")
+
+    assert code_index.queries == ["how are files chunked"]
+    assert {hit.file_path for hit in response.hits} == {
+        "rtfs/chunker.py",
+        "rtfs/fs.py",
+    }
@@ -0,0 +1,62 @@
+import json
+import os
+
+import pytest
+
+from src.index import embedding, service
+from src.index.embedding import HASH_MODEL, TOKENIZER_MODEL, NodeEmbeddingCache
+
+SOURCE = """
+class Shape:
+    def area(self):
+        raise NotImplementedError
+
+
+class Square(Shape):
+    def __init__(self, side):
+        self.side = side
+
+    def area(self):
+        return self.side * self.side
+
+
+def total_area(shapes):
+    return sum(shape.area() for shape in shapes)
+"""
+
+
+@pytest.fixture
+def hash_model(tmp_path, monkeypatch):
+    monkeypatch.setattr(service, "EMBED_MODEL", HASH_MODEL)
+    monkeypatch.setattr(
+        embedding,
+        "node_embedding_cache",
+        NodeEmbeddingCache(str(tmp_path / "embeddings.db"), 1024 * 1024),
+    )
+    monkeypatch.setattr(embedding, "_embed_models", {})
+
+
+@pytest.fixture
+def repo_path(tmp_path):
+    repo = tmp_path / "repo"
+    repo.mkdir()
+    (repo / "shapes.py").write_text(SOURCE)
+    return str(repo)
+
+
+def test_ingestion_with_hash_embedding(hash_model, repo_path, tmp_path):
+    persist_dir = str(tmp_path / "index")
+
+    code_index = service.load_or_create_index(repo_path, persist_dir)
+
+    assert code_index._docstore.docs
+    with open(os.path.join(persist_dir, "settings.json")) as f:
+        settings = json.load(f)
+    # moatless counts tokens for embed_model with tiktoken, which has no "hash"
+    assert settings["embed_model"] == TOKENIZER_MODEL
+    assert settings["embed_backend"] == HASH_MODEL
+    assert settings["dimensions"] == 512
+
+    # Queries are embedded with the model the index was created with
+    loaded = service.load_or_create_index(repo_path, persist_dir)
+    assert loaded._embed_model.model_name == HASH_MODEL
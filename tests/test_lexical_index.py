@@ -0,0 +1,94 @@
+import pytest
+from llama_index.core.schema import TextNode
+
+from src.search.lexical import LexicalIndex, tokenize
+
+
+def chunk(node_id, file_path, span_ids, text):
+    return TextNode(
+        id_=node_id,
+        text=text,
+        metadata={"file_path": file_path, "span_ids": span_ids},
+    )
+
+
+@pytest.fixture
+def lexical_index():
+    return LexicalIndex.from_nodes(
+        [
+            chunk(
+                "scopes",
+                "rtfs/scope_resolution/graph.py",
+                ["ScopeGraph.import_to_export_scope"],
+                "def import_to_export_scope(self, scope):\n"
+                "    return self.scopes[scope]",
+            ),
+            chunk(
+                "chunker",
+                "rtfs/chunker.py",
+                ["iter_chunks"],
+                "def iter_chunks(repo_path):\n"
+                "    reader = SimpleDirectoryReader(repo_path)",
+            ),
+            chunk(
+                "store",
+                "src/queue/store.py",
+                ["TaskStore.claim"],
+                "def claim(self, worker_pid):\n    return conn.execute(CLAIM_QUERY)",
+            ),
+            chunk(
+                "caller",
+                "rtfs/repo_resolution/repo_graph.py",
+                ["RepoGraph.resolve"],
+                "def resolve(self, scope):\n"
+                "    return self.scope_graph.import_to_export_scope(scope)",
+            ),
+        ],
+        repo_path="",
+    )
+
+
+def test_tokenize_splits_identifiers():
+    assert tokenize("importToExport_scope") == [
+        "importtoexport_scope",
+        "import",
+        "to",
+        "export",
+        "scope",
+    ]
+    assert tokenize("HTTPResponse") == ["httpresponse", "http", "response"]
+
+
+def test_search_matches_identifier_parts(lexical_index):
+    results = lexical_index.search("export scope")
+
+    assert results[0][0].node_id == "scopes"
+    assert [score for _, score in results] == sorted(
+        (score for _, score in results), reverse=True
+    )
+
+
+def test_search_ranks_definition_above_usage(lexical_index):
+    ranked = [doc.node_id for doc, _ in lexical_index.search("import_to_export_scope")]
+
+    assert ranked.index("scopes") < ranked.index("caller")
+
+
+def test_search_expands_misspelled_identifier(lexical_index):
+    results = lexical_index.search("claimm")
+
+    assert [doc.node_id for doc, _ in results] == ["store"]
+
+
+def test_search_ignores_unrelated_terms(lexical_index):
+    assert lexical_index.search("what is the xylophone") == []
+
+
+def test_persist_roundtrip(lexical_index, tmp_path):
+    path = str(tmp_path / "lexical_index.json")
+    lexical_index.persist(path)
+
+    loaded = LexicalIndex.from_persist_path(path)
+    assert [(doc.node_id, score) for doc, score in loaded.search("iter chunks")] == [
+        (doc.node_id, score) for doc, score in lexical_index.search("iter chunks")
+    ]
@@ -0,0 +1,127 @@
+import time
+
+import pytest
+
+from src.queue.models import Task, TaskStatus, TaskType
+from src.queue.store import TaskStore
+
+
+class EchoTask(Task):
+    type: TaskType = TaskType.INIT_GRAPH
+
+    def task(self, *, value):
+        return value
+
+
+@pytest.fixture
+def store(tmp_path):
+    return TaskStore(str(tmp_path / "tasks.db"))
+
+
+def add(store, user_id, value):
+    task = EchoTask(task_args={"value": value})
+    store.add(user_id, task, f"user{user_id}@example.com")
+    return task
+
+
+def claim_value(store, max_per_user, worker_pid=1):
+    task = store.claim(worker_pid, max_per_user)
+    return task.task_args["value"] if task else None
+
+
+def test_claim_respects_per_user_cap(store):
+    for i in range(3):
+        add(store, 1, f"u1-{i}")
+
+    assert claim_value(store, max_per_user=2) == "u1-0"
+    assert claim_value(store, max_per_user=2) == "u1-1"
+    assert claim_value(store, max_per_user=2) is None
+
+
+def test_claim_prefers_users_with_fewer_running_tasks(store):
+    for i in range(3):
+        add(store, 1, f"u1-{i}")
+    add(store, 2, "u2-0")
+
+    assert claim_value(store, max_per_user=2) == "u1-0"
+    # Queued after user 1's backlog, but user 2 has nothing running
+    assert claim_value(store, max_per_user=2) == "u2-0"
+    assert claim_value(store, max_per_user=2) == "u1-1"
+    assert claim_value(store, max_per_user=2) is None
+
+
+def test_claim_alternates_between_users(store):
+    for i in range(3):
+        add(store, 1, f"u1-{i}")
+    for i in range(3):
+        add(store, 2, f"u2-{i}")
+
+    claimed = []
+    while True:
+        task = store.claim(1, max_per_user=1)
+        if not task:
+            break
+        claimed.append(task.task_args["value"])
+        store.finish(task.task_id, TaskStatus.COMPLETE, None)
+
+    assert claimed == ["u1-0", "u2-0", "u1-1", "u2-1", "u1-2", "u2-2"]
+
+
+def test_claim_marks_task_started(store):
+    task = add(store, 1, "value")
+
+    claimed = store.claim(42, max_per_user=1)
+
+    assert claimed.task_id == task.task_id
+    assert store.get(task.task_id).status == TaskStatus.STARTED.value
+    assert store.list(1, 10)[0].status == TaskStatus.STARTED.value
+
+
+def test_cancelled_task_is_not_claimed(store):
+    task = add(store, 1, "value")
+
+    assert store.cancel(task.task_id) == TaskStatus.CANCELLED.value
+    assert store.claim(1, max_per_user=1) is None
+
+
+def test_requeue_orphans(store):
+    stale = add(store, 1, "stale")
+    alive = add(store, 2, "alive")
+    dead = add(store, 3, "dead")
+    store.claim(1, max_per_user=1)
+    store.claim(2, max_per_user=1)
+    store.claim(3, max_per_user=1)
+    store._connect().execute(
+        "UPDATE tasks SET heartbeat_at = 0 WHERE task_id = ?", (stale.task_id,)
+    )
+
+    store.requeue_orphans(time.time() - 60, max_attempts=2, dead_workers=[3])
+
+    assert store.get(stale.task_id).status == TaskStatus.PENDING.value
+    assert store.get(alive.task_id).status == TaskStatus.STARTED.value
+    assert store.get(dead.task_id).status == TaskStatus.PENDING.value
+
+    # Lost again after max_attempts attempts, the task fails
+    assert claim_value(store, max_per_user=1, worker_pid=4) == "stale"
+    assert claim_value(store, max_per_user=1, worker_pid=5) == "dead"
+    store.requeue_orphans(time.time() - 60, max_attempts=2, dead_workers=[5])
+    assert store.get(dead.task_id).status == TaskStatus.FAILED.value
+
+
+def test_owner(store):
+    task = add(store, 1, "value")
+
+    assert store.owner(task.task_id) == "user1@example.com"
+    assert store.owner("missing") is None
+
+
+def test_stop_cancelled_only_stops_worker_running_the_task(store):
+    task = add(store, 1, "value")
+    store.claim(1, max_per_user=1)
+    store.cancel(task.task_id)
+
+    stopped = []
+    assert not store.stop_cancelled(task.task_id, 2, lambda: stopped.append(2))
+    assert store.stop_cancelled(task.task_id, 1, lambda: stopped.append(1))
+    assert stopped == [1]
+    assert store.get(task.task_id).status == TaskStatus.CANCELLED.value